@@ -3,6 +3,7 @@ import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from mongo_observer import conf
+from mongo_observer.coalescing import DebouncingOperationHandler
 from mongo_observer.observer import Observer
 from mongo_observer.operation_handlers import BuyboxChangeNotifier
 
@@ -12,7 +13,8 @@ async def run():
     oplog_db = client[conf.OPLOG_DATABASE]
     seller_db = client[conf.SELLER_DATABASE]
 
-    handler = await BuyboxChangeNotifier.init_async(seller_db['price_rank'])
+    notifier = await BuyboxChangeNotifier.init_async(seller_db['price_rank'])
+    handler = DebouncingOperationHandler(notifier)
     # now = bson.Timestamp(datetime.now(), 1)
     observer = await Observer.init_async(oplog=oplog_db[conf.OPLOG_COLLECTION],
                                          operation_handler=handler,
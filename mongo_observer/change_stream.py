@@ -0,0 +1,202 @@
+from typing import Callable, Coroutine, Dict, Any, List, Optional
+
+from pymongo.errors import ConnectionFailure
+
+from mongo_observer import conf
+from mongo_observer.checkpoints import CheckpointStore
+from mongo_observer.models import Operations
+from mongo_observer.observer import ShouldStopObservation
+from mongo_observer.operation_handlers import OperationHandler
+from mongo_observer.reconnect import ReconnectScheduler
+
+
+# Change event `operationType`s corresponding to each oplog `op` type
+CHANGE_OPERATION_TYPES = {
+    Operations.INSERT: ('insert',),
+    Operations.UPDATE: ('update', 'replace'),
+    Operations.DELETE: ('delete',),
+}
+
+
+def to_oplog_entry(change: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Converts a change stream event into the oplog entry shape expected by
+    an `OperationHandler`.
+
+    :return: A dict with `ts`, `ns`, `op`, `o` and `o2` keys, or None if the
+    event doesn't correspond to a document operation
+    """
+    ns = change.get('ns', {})
+    entry = {'ts': change.get('clusterTime'),
+             'ns': f"{ns.get('db')}.{ns.get('coll')}"}
+    operation_type = change['operationType']
+
+    if operation_type == 'insert':
+        entry['op'] = Operations.INSERT
+        entry['o'] = change['fullDocument']
+    elif operation_type == 'update':
+        description = change['updateDescription']
+        update = {}
+        if description.get('updatedFields'):
+            update['$set'] = description['updatedFields']
+        if description.get('removedFields'):
+            update['$unset'] = dict.fromkeys(description['removedFields'], True)
+        entry['op'] = Operations.UPDATE
+        entry['o'] = update
+        entry['o2'] = change['documentKey']
+    elif operation_type == 'replace':
+        entry['op'] = Operations.UPDATE
+        entry['o'] = change['fullDocument']
+        entry['o2'] = change['documentKey']
+    elif operation_type == 'delete':
+        entry['op'] = Operations.DELETE
+        entry['o'] = change['documentKey']
+    else:
+        return None
+    return entry
+
+
+def buffered(stream) -> bool:
+    """
+    :return: True if `stream` has change events buffered locally, which
+    `try_next` returns without a getMore
+    """
+    # motor change streams create their pymongo delegate on the first fetch
+    delegate = getattr(stream, 'delegate', None)
+    cursor = getattr(delegate, '_cursor', None)
+    return cursor is not None and cursor._has_next()
+
+
+class ChangeStreamObserver:
+    def __init__(self,
+                 watched,
+                 operation_handler: OperationHandler,
+                 namespace_filter: str=None,
+                 pipeline: List[Dict[str, Any]]=None,
+                 resume_after: Dict[str, Any]=None,
+                 on_nothing_to_fetch_on_cursor: Callable[..., Coroutine]=None,
+                 batch_size: int=None,
+                 checkpoint_store: CheckpointStore=None,
+                 reconnect_scheduler: ReconnectScheduler=None):
+        """
+        :param watched: Collection, database or client to be watched
+        :param operation_handler: Delegate object responsible of handling
+        operations
+        :param namespace_filter: `database.collection` affected by the
+        operation. Unnecessary if `watched` is a collection
+        :param pipeline: Aggregation stages appended to the `$match` stage
+        generated from the filters
+        :param resume_after: Resume token of the last handled change event
+        :param on_nothing_to_fetch_on_cursor: Coroutine awaited when the stream
+        has no data to be fetched
+        :param batch_size: Maximum number of change events handled as a
+        single batch. Defaults to `conf.CHANGE_STREAM_BATCH_SIZE`
+        :param checkpoint_store: Store where the resume token is checkpointed
+        after each handled batch. Unless `resume_after` is provided, the
+        stream resumes after the stored token
+        :param reconnect_scheduler: Schedules new streams when the current one
+        dies or its connection fails
+        """
+        self.watched = watched
+        self.operation_handler = operation_handler
+        self.namespace_filter = namespace_filter
+        self.pipeline = [{'$match': self.get_match()}] + list(pipeline or [])
+        self.resume_token = resume_after
+        self.on_nothing_to_fetch_on_cursor = on_nothing_to_fetch_on_cursor
+        self.batch_size = batch_size or conf.CHANGE_STREAM_BATCH_SIZE
+        self.checkpoint_store = checkpoint_store
+
+        self.logger = conf.logger
+        self.reconnect_scheduler = reconnect_scheduler or ReconnectScheduler()
+
+    def get_match(self) -> Dict[str, Any]:
+        """
+        Builds the server side `$match` stage filter for the namespace and the
+        `op` types required by the operation handler
+        """
+        match = {}
+        if self.namespace_filter is not None:
+            db, coll = self.namespace_filter.split('.', 1)
+            match['ns.db'] = db
+            match['ns.coll'] = coll
+
+        operation_types = self.operation_handler.operation_types
+        if operation_types is not None:
+            match['operationType'] = {'$in': sorted(
+                change_type
+                for op in operation_types
+                for change_type in CHANGE_OPERATION_TYPES.get(op, ())
+            )}
+        return match
+
+    def get_new_stream(self):
+        return self.watched.watch(
+            self.pipeline,
+            resume_after=self.resume_token,
+            batch_size=self.batch_size,
+            max_await_time_ms=conf.CHANGE_STREAM_MAX_AWAIT_TIME_MS
+        )
+
+    async def fetch_batch(self, stream) -> List[Dict[str, Any]]:
+        """
+        Fetches the change events buffered by `stream`, up to `batch_size`
+        events, running a getMore only if none is buffered. Returns an empty
+        list if there's nothing to be fetched
+        """
+        batch = []
+        while len(batch) < self.batch_size:
+            change = await stream.try_next()
+            if change is None:
+                break
+            batch.append(change)
+            if not buffered(stream):
+                # another `try_next` would await data for up to
+                # `CHANGE_STREAM_MAX_AWAIT_TIME_MS`
+                break
+        return batch
+
+    async def observe_changes(self):
+        if self.resume_token is None and self.checkpoint_store is not None:
+            self.resume_token = await self.checkpoint_store.load()
+
+        stream = self.get_new_stream()
+        try:
+            while True:
+                if not stream.alive:
+                    await self.reconnect_scheduler.wait()
+                    stream = self.get_new_stream()
+
+                try:
+                    changes = await self.fetch_batch(stream)
+                except ConnectionFailure as e:
+                    self.logger.warning({
+                        'info': 'change stream failed',
+                        'attempts': self.reconnect_scheduler.attempts,
+                        'error': repr(e)
+                    })
+                    await self.reconnect_scheduler.wait()
+                    stream = self.get_new_stream()
+                    continue
+                self.reconnect_scheduler.reset()
+
+                if not changes:
+                    await self.operation_handler.check()
+                    if self.on_nothing_to_fetch_on_cursor:
+                        await self.on_nothing_to_fetch_on_cursor()
+                    continue
+
+                operations = [entry for entry in map(to_oplog_entry, changes)
+                              if entry is not None]
+                if operations:
+                    await self.operation_handler.handle_batch(operations)
+                self.resume_token = changes[-1]['_id']
+                if self.checkpoint_store is not None:
+                    await self.checkpoint_store.checkpoint(self.resume_token,
+                                                           len(changes))
+        except ShouldStopObservation:
+            self.logger.debug('Stopping observer')
+        finally:
+            await stream.close()
+            await self.operation_handler.stop()
+            if self.checkpoint_store is not None:
+                await self.checkpoint_store.flush()
@@ -0,0 +1,130 @@
+import abc
+import asyncio
+import os
+import time
+from typing import Any
+
+import bson
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from mongo_observer import conf
+
+
+class CheckpointStore(metaclass=abc.ABCMeta):
+    """
+    Persists the position of the last handled operation, usually the
+    `last_timestamp` of an `OperationHandler`, so that observation may be
+    resumed after a restart.
+
+    Checkpoints are coalesced: they are only written once `interval` seconds
+    have passed or `max_operations` operations were handled since the last
+    write. `flush` forces the write of the last checkpoint.
+    """
+    def __init__(self,
+                 interval: float=None,
+                 max_operations: int=None):
+        """
+        :param interval: Maximum number of seconds between writes. Defaults to
+        `conf.CHECKPOINT_INTERVAL_IN_SECONDS`
+        :param max_operations: Maximum number of operations handled between
+        writes. Defaults to `conf.CHECKPOINT_MAX_OPERATIONS`
+        """
+        if interval is None:
+            interval = conf.CHECKPOINT_INTERVAL_IN_SECONDS
+        self.interval = interval
+        self.max_operations = max_operations or conf.CHECKPOINT_MAX_OPERATIONS
+
+        self.position = None
+        self.saved_position = None
+        self.pending_operations = 0
+        self.last_save_time = time.monotonic()
+
+    async def checkpoint(self, position: Any, operations: int=1):
+        """
+        :param position: Position of the last handled operation
+        :param operations: Number of operations handled since the previous
+        checkpoint
+        """
+        self.position = position
+        self.pending_operations += operations
+        if self.pending_operations >= self.max_operations or \
+                time.monotonic() - self.last_save_time >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        if self.position is not None and self.position != self.saved_position:
+            position = self.position
+            await self.save(position)
+            self.saved_position = position
+        self.pending_operations = 0
+        self.last_save_time = time.monotonic()
+
+    @abc.abstractmethod
+    async def load(self) -> Any:
+        """
+        :return: The last saved position, or None if there's none
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def save(self, position: Any):
+        raise NotImplementedError()
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    Stores the checkpoint as a BSON document on a local file, atomically
+    replaced on every write
+    """
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    async def load(self) -> Any:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._read)
+
+    async def save(self, position: Any):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write, position)
+
+    def _read(self) -> Any:
+        try:
+            with open(self.path, 'rb') as f:
+                return bson.decode(f.read())['position']
+        except FileNotFoundError:
+            return None
+
+    def _write(self, position: Any):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bson.encode({'position': position}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class MongoCheckpointStore(CheckpointStore):
+    """
+    Stores the checkpoint as the `position` of the `checkpoint_id` document
+    on a mongo collection
+    """
+    def __init__(self,
+                 collection: AsyncIOMotorCollection,
+                 checkpoint_id: str,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.collection = collection
+        self.checkpoint_id = checkpoint_id
+
+    async def load(self) -> Any:
+        doc = await self.collection.find_one({'_id': self.checkpoint_id})
+        try:
+            return doc['position']
+        except TypeError:
+            return None
+
+    async def save(self, position: Any):
+        await self.collection.update_one({'_id': self.checkpoint_id},
+                                         {'$set': {'position': position}},
+                                         upsert=True)
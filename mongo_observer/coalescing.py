@@ -0,0 +1,404 @@
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Any, List, Set, Iterable, Optional, Tuple
+
+from bson import Timestamp
+
+from mongo_observer import conf
+from mongo_observer.conf import logger
+from mongo_observer.models import Operations, document_id, decoded
+from mongo_observer.operation_handlers import OperationHandler
+
+
+MERGEABLE_OPERATORS = {'$set', '$unset'}
+
+
+def _modifiers(operation: Dict[str, Any]) -> Optional[Dict[str, Dict]]:
+    """
+    :return: The `$set` and `$unset` of an update made only of them, or None
+    """
+    change = decoded(operation['o'])
+    operators = set(change) - {'$v'}
+    if not operators or not operators <= MERGEABLE_OPERATORS or \
+            change.get('$v', 1) != 1:
+        return None
+    return {'$set': dict(change.get('$set', {})),
+            '$unset': dict(change.get('$unset', {}))}
+
+
+def _related(path: str, other: str) -> bool:
+    """
+    :return: True if `path` and `other` are different, and one of them is a
+    parent of the other
+    """
+    if path == other:
+        return False
+    return path.startswith(other + '.') or other.startswith(path + '.')
+
+
+def _merge(previous: Dict[str, Dict], change: Dict[str, Dict]) -> bool:
+    """
+    Merges `change` into `previous`, if the result is equivalent to applying
+    both in order.
+
+    :return: False if they touch overlapping paths, and weren't merged
+    """
+    paths = [*previous['$set'], *previous['$unset']]
+    for path in (*change['$set'], *change['$unset']):
+        if any(_related(path, other) for other in paths):
+            return False
+    # a `$set` of a dotted path creates its missing parents, which are kept
+    # after the path is unset
+    for path in change['$unset']:
+        if '.' in path and path in previous['$set']:
+            return False
+
+    for path, value in change['$set'].items():
+        previous['$unset'].pop(path, None)
+        previous['$set'][path] = value
+    for path, value in change['$unset'].items():
+        previous['$set'].pop(path, None)
+        previous['$unset'][path] = value
+    return True
+
+
+def coalesce(operations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Reduces a batch of oplog entries to their net changes, per document:
+
+        * consecutive `$set`/`$unset` updates on the same document are
+        merged into a single update, at the position of the last one
+        * operations followed by a delete of the same document are dropped,
+        so that a document inserted and then deleted is reduced to the delete,
+        as it may already be in the replica when operations are replayed
+
+    Other operations are kept as they are, and are barriers to merging
+    operations before and after them on the same document. Commands are
+    barriers for every document. Entries are never mutated, and the `ts`
+    order of the batch is kept.
+    """
+    coalesced: List[Optional[Dict[str, Any]]] = []
+    # positions on `coalesced` of the operations on each document
+    positions: Dict[Any, List[int]] = {}
+    # the mergeable update of each document, if it's the last operation on it
+    pending: Dict[Any, Dict[str, Dict]] = {}
+
+    for operation in operations:
+        op = operation['op']
+        _id = document_id(operation)
+        if op == Operations.COMMAND:
+            positions.clear()
+            pending.clear()
+        if _id is None or op not in (Operations.INSERT,
+                                     Operations.UPDATE,
+                                     Operations.DELETE):
+            coalesced.append(operation)
+            continue
+
+        key = (operation.get('ns'), _id)
+        try:
+            hash(key)
+        except TypeError:
+            coalesced.append(operation)
+            continue
+
+        if op == Operations.INSERT:
+            positions[key] = [len(coalesced)]
+            pending.pop(key, None)
+            coalesced.append(operation)
+        elif op == Operations.DELETE:
+            for position in positions.pop(key, ()):
+                coalesced[position] = None
+            pending.pop(key, None)
+            coalesced.append(operation)
+        else:
+            change = _modifiers(operation)
+            previous = pending.pop(key, None)
+            if change is not None and previous is not None and \
+                    _merge(previous, change):
+                coalesced[positions[key].pop()] = None
+                operation = dict(operation,
+                                 o={operator: fields
+                                    for operator, fields in previous.items()
+                                    if fields})
+                change = previous
+            if change is not None:
+                pending[key] = change
+            positions.setdefault(key, []).append(len(coalesced))
+            coalesced.append(operation)
+
+    return [operation for operation in coalesced if operation is not None]
+
+
+class CoalescingOperationHandler(OperationHandler):
+    """
+    Hands `coalesce`d batches to the wrapped `operation_handler`, so that it
+    only sees the net change of each document within a cursor batch.
+
+    `last_timestamp` advances up to the last operation of each batch, once
+    the wrapped handler handled it.
+    """
+    def __init__(self, operation_handler: OperationHandler):
+        super().__init__()
+        self.operation_handler = operation_handler
+
+    @property
+    def operation_types(self) -> Set[str]:
+        return self.operation_handler.operation_types
+
+    @property
+    def oplog_fields(self) -> Iterable[str]:
+        oplog_fields = self.operation_handler.oplog_fields
+        if oplog_fields is None:
+            return None
+        return {'ns', 'o', 'o2', *oplog_fields}
+
+    async def handle_batch(self, operations: List[Dict[str, Any]]):
+        if not operations:
+            return
+
+        coalesced = coalesce(operations)
+        if len(coalesced) < len(operations):
+            logger.debug({'info': 'coalesced operations',
+                          'count': len(operations),
+                          'coalesced': len(coalesced)})
+        if coalesced:
+            await self.operation_handler.handle_batch(coalesced)
+
+        handled = self.operation_handler.last_timestamp
+        if coalesced and handled != coalesced[-1]['ts']:
+            # the wrapped handler is still handling the batch
+            self.last_timestamp = handled
+        else:
+            self.last_timestamp = operations[-1]['ts']
+
+    async def check(self):
+        await self.operation_handler.check()
+
+    async def stop(self):
+        await self.operation_handler.stop()
+
+    async def on_insert(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_insert(operation)
+
+    async def on_update(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_update(operation)
+
+    async def on_delete(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_delete(operation)
+
+
+class _PendingUpdate:
+    __slots__ = ('operation', 'change', 'previous_timestamp', 'first_seen',
+                 'timer')
+
+    def __init__(self,
+                 operation: Dict[str, Any],
+                 change: Dict[str, Dict],
+                 previous_timestamp: Timestamp,
+                 first_seen: float):
+        self.operation = operation
+        self.change = change
+        # `ts` of the last operation seen before the first debounced one
+        self.previous_timestamp = previous_timestamp
+        self.first_seen = first_seen
+        self.timer: asyncio.TimerHandle = None
+
+    def merged(self) -> Dict[str, Any]:
+        return dict(self.operation,
+                    o={operator: fields
+                       for operator, fields in self.change.items() if fields})
+
+
+class DebouncingOperationHandler(OperationHandler):
+    """
+    Debounces `$set`/`$unset` updates per document: the wrapped handler's
+    `on_update` is called once with the merged change of a burst of updates,
+    `window` seconds after the last one of them, and at most `max_delay`
+    seconds after the first one.
+
+    Inserts, deletes and any other updates are handled right away, after
+    the pending updates of their document. A delete discards them. At most
+    `max_pending` documents are debounced at once: the oldest one is handled
+    when a new one would exceed it.
+
+    `last_timestamp` never advances past the first pending update, so that
+    checkpoints resume before it.
+    """
+    def __init__(self,
+                 operation_handler: OperationHandler,
+                 window: float=None,
+                 max_delay: float=None,
+                 max_pending: int=None):
+        """
+        :param window: Seconds without updates to a document before its
+        merged update is handled. Defaults to `conf.DEBOUNCE_WINDOW_IN_SECONDS`
+        :param max_delay: Maximum number of seconds an update is delayed.
+        Defaults to `conf.DEBOUNCE_MAX_DELAY_IN_SECONDS`
+        :param max_pending: Maximum number of debounced documents. Defaults to
+        `conf.DEBOUNCE_MAX_PENDING_DOCUMENTS`
+        """
+        super().__init__()
+        self.operation_handler = operation_handler
+        if window is None:
+            window = conf.DEBOUNCE_WINDOW_IN_SECONDS
+        if max_delay is None:
+            max_delay = conf.DEBOUNCE_MAX_DELAY_IN_SECONDS
+        self.window = window
+        self.max_delay = max_delay
+        self.max_pending = max_pending or conf.DEBOUNCE_MAX_PENDING_DOCUMENTS
+
+        # in first seen order
+        self.pending: Dict[Tuple, _PendingUpdate] = OrderedDict()
+        # expired updates being handled, and their `previous_timestamp`
+        self.flushing: Dict[Tuple, Tuple[asyncio.Future, Timestamp]] = {}
+        self.seen_timestamp: Timestamp = None
+        self.error: Exception = None
+
+    @property
+    def operation_types(self) -> Set[str]:
+        return self.operation_handler.operation_types
+
+    @property
+    def oplog_fields(self) -> Iterable[str]:
+        oplog_fields = self.operation_handler.oplog_fields
+        if oplog_fields is None:
+            return None
+        return {'ns', 'o', 'o2', *oplog_fields}
+
+    async def handle(self, operation: Dict[str, Any]):
+        if self.error:
+            raise self.error
+
+        op = operation['op']
+        handlers = self.operation_handler.handlers
+        _id = document_id(operation)
+        key = (operation.get('ns'), _id)
+        try:
+            hash(key)
+        except TypeError:
+            # documents with compound `_id`s aren't debounced
+            _id = None
+        if op not in handlers:
+            logger.debug({'info': 'skipping operation', 'operation': operation})
+        elif _id is None:
+            await handlers[op](operation)
+        else:
+            flushing = self.flushing.get(key)
+            if flushing is not None:
+                await flushing[0]
+
+            if op == Operations.UPDATE:
+                await self._update(key, operation)
+            elif op == Operations.DELETE:
+                self._discard(key)
+                await handlers[op](operation)
+            else:
+                await self._flush(key)
+                await handlers[op](operation)
+
+        self.seen_timestamp = operation['ts']
+        self._advance()
+
+    async def _update(self, key: Tuple, operation: Dict[str, Any]):
+        change = _modifiers(operation)
+        pending = self.pending.get(key)
+        if change is not None and pending is not None and \
+                _merge(pending.change, change):
+            pending.operation = operation
+            self._schedule(key, pending)
+            return
+
+        await self._flush(key)
+        if change is None:
+            await self.operation_handler.handlers[Operations.UPDATE](operation)
+            return
+
+        if len(self.pending) >= self.max_pending:
+            await self._flush(next(iter(self.pending)))
+        loop = asyncio.get_event_loop()
+        pending = self.pending[key] = _PendingUpdate(operation,
+                                                     change,
+                                                     self.seen_timestamp,
+                                                     loop.time())
+        self._schedule(key, pending)
+
+    def _schedule(self, key: Tuple, pending: _PendingUpdate):
+        loop = asyncio.get_event_loop()
+        if pending.timer is not None:
+            pending.timer.cancel()
+        deadline = min(loop.time() + self.window,
+                       pending.first_seen + self.max_delay)
+        pending.timer = loop.call_at(deadline, self._expire, key)
+
+    def _discard(self, key: Tuple) -> Optional[_PendingUpdate]:
+        pending = self.pending.pop(key, None)
+        if pending is not None:
+            pending.timer.cancel()
+        return pending
+
+    async def _flush(self, key: Tuple):
+        pending = self._discard(key)
+        if pending is not None:
+            await self.operation_handler.handlers[Operations.UPDATE](
+                pending.merged()
+            )
+
+    def _expire(self, key: Tuple):
+        pending = self.pending.pop(key)
+        task = asyncio.ensure_future(self._handle_expired(key, pending))
+        self.flushing[key] = (task, pending.previous_timestamp)
+
+    async def _handle_expired(self, key: Tuple, pending: _PendingUpdate):
+        operation = pending.merged()
+        try:
+            await self.operation_handler.handlers[Operations.UPDATE](operation)
+        except Exception as e:
+            logger.error({'info': 'failed to handle operation',
+                          'operation': operation,
+                          'error': repr(e)})
+            self.error = e
+        finally:
+            del self.flushing[key]
+            self._advance()
+
+    def _advance(self):
+        previous = [timestamp for _, timestamp in self.flushing.values()]
+        if self.pending:
+            previous.append(next(iter(self.pending.values())).previous_timestamp)
+        if not previous:
+            self.last_timestamp = self.seen_timestamp
+        elif None not in previous:
+            self.last_timestamp = min(previous)
+
+    async def flush(self):
+        """
+        Handles every pending update right away
+        """
+        while self.pending:
+            await self._flush(next(iter(self.pending)))
+        if self.flushing:
+            await asyncio.gather(*(task for task, _ in self.flushing.values()))
+        self._advance()
+        if self.error:
+            raise self.error
+
+    async def check(self):
+        if self.error:
+            raise self.error
+        await self.operation_handler.check()
+
+    async def stop(self):
+        for pending in self.pending.values():
+            pending.timer.cancel()
+        self.pending.clear()
+        await self.operation_handler.stop()
+
+    async def on_insert(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_insert(operation)
+
+    async def on_update(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_update(operation)
+
+    async def on_delete(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_delete(operation)
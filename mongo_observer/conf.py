@@ -1,4 +1,4 @@
-from os import environ as env
+from os import environ as env, cpu_count
 
 from simple_json_logger import JsonLogger
 
@@ -15,6 +15,56 @@ MONGO_CONN_PARAMS = dict(
 
 SLEEP_TIME_BEFORE_GET_NEW_CURSOR_IN_SECONDS = float(env.get('SLEEP_TIME_BEFORE_GET_NEW_CURSOR_IN_SECONDS',
                                                           0.1))
+RECONNECT_MAX_DELAY_IN_SECONDS = float(env.get('RECONNECT_MAX_DELAY_IN_SECONDS', 30))
+RECONNECT_BACKOFF_FACTOR = float(env.get('RECONNECT_BACKOFF_FACTOR', 2))
+
+OPLOG_PREFETCH_BATCHES = int(env.get('OPLOG_PREFETCH_BATCHES', 0))
+
+HANDLER_CONCURRENCY = int(env.get('HANDLER_CONCURRENCY', 8))
+HANDLER_WORKER_QUEUE_SIZE = int(env.get('HANDLER_WORKER_QUEUE_SIZE', 1000))
+
+CATCH_UP_LAG_THRESHOLD_IN_SECONDS = float(env.get('CATCH_UP_LAG_THRESHOLD_IN_SECONDS',
+                                                  60))
+CATCH_UP_BATCH_SIZE = int(env.get('CATCH_UP_BATCH_SIZE', 10000))
+
+SHARDED_HANDLER_PROCESSES = int(env.get('SHARDED_HANDLER_PROCESSES',
+                                        cpu_count() or 1))
+SHARDED_HANDLER_MAX_PENDING_BATCHES = int(env.get('SHARDED_HANDLER_MAX_PENDING_BATCHES',
+                                                  16))
+SHARDED_HANDLER_STOP_TIMEOUT_IN_SECONDS = float(env.get('SHARDED_HANDLER_STOP_TIMEOUT_IN_SECONDS',
+                                                        5))
+
+CHANGE_STREAM_BATCH_SIZE = int(env.get('CHANGE_STREAM_BATCH_SIZE', 1000))
+CHANGE_STREAM_MAX_AWAIT_TIME_MS = int(env.get('CHANGE_STREAM_MAX_AWAIT_TIME_MS',
+                                              1000))
+
+CHECKPOINT_INTERVAL_IN_SECONDS = float(env.get('CHECKPOINT_INTERVAL_IN_SECONDS',
+                                               1.0))
+CHECKPOINT_MAX_OPERATIONS = int(env.get('CHECKPOINT_MAX_OPERATIONS', 10000))
+
+INITIAL_SYNC_PARTITIONS = int(env.get('INITIAL_SYNC_PARTITIONS', 8))
+INITIAL_SYNC_BATCH_SIZE = int(env.get('INITIAL_SYNC_BATCH_SIZE', 5000))
+INITIAL_SYNC_FETCH_BATCH_SIZE = int(env.get('INITIAL_SYNC_FETCH_BATCH_SIZE', 1000))
+INITIAL_SYNC_SAMPLES_PER_PARTITION = int(env.get('INITIAL_SYNC_SAMPLES_PER_PARTITION',
+                                                 20))
+
+SNAPSHOT_INTERVAL_IN_SECONDS = float(env.get('SNAPSHOT_INTERVAL_IN_SECONDS', 300))
+SNAPSHOT_CHUNK_SIZE = int(env.get('SNAPSHOT_CHUNK_SIZE', 1000))
+
+DEBOUNCE_WINDOW_IN_SECONDS = float(env.get('DEBOUNCE_WINDOW_IN_SECONDS', 1.0))
+DEBOUNCE_MAX_DELAY_IN_SECONDS = float(env.get('DEBOUNCE_MAX_DELAY_IN_SECONDS', 5.0))
+DEBOUNCE_MAX_PENDING_DOCUMENTS = int(env.get('DEBOUNCE_MAX_PENDING_DOCUMENTS',
+                                             10000))
+
+QUERY_PLAN_CACHE_SIZE = int(env.get('QUERY_PLAN_CACHE_SIZE', 1000))
+
+OPLOG_DUMP_BATCH_SIZE = int(env.get('OPLOG_DUMP_BATCH_SIZE', 1000))
+
+RECORD_STORAGE_MAX_CLASSES = int(env.get('RECORD_STORAGE_MAX_CLASSES', 1000))
+
+SHARED_REPLICA_SLOTS = int(env.get('SHARED_REPLICA_SLOTS', 1 << 16))
+SHARED_REPLICA_DATA_CAPACITY = int(env.get('SHARED_REPLICA_DATA_CAPACITY',
+                                           64 * 1024 * 1024))
 
 OPLOG_DATABASE = env.get('OPLOG_DATABASE', 'local')
 OPLOG_COLLECTION = env.get('OPLOG_COLLECTION', 'oplog.$main')
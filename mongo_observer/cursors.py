@@ -0,0 +1,18 @@
+from typing import Dict, Any, List
+
+
+async def fetch_batch(cursor) -> List[Dict[str, Any]]:
+    """
+    Fetches the next network batch of `cursor`, returning every document
+    buffered by it, or an empty list if there's nothing to be fetched.
+
+    Motor doesn't expose the number of buffered documents, so it relies on
+    the private `_buffer_size` of its cursors, which is also implemented by
+    `OplogDumpCursor`
+    """
+    if not await cursor.fetch_next:
+        return []
+    batch = [cursor.next_object()]
+    while cursor._buffer_size():
+        batch.append(cursor.next_object())
+    return batch
@@ -0,0 +1,401 @@
+import abc
+import itertools
+import re
+from bisect import bisect_left, bisect_right, insort
+from collections import UserList
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Any, List, Set, Tuple, Iterable, Iterator, Mapping
+
+from bson import ObjectId, Timestamp, Decimal128, Regex, MinKey, MaxKey
+
+from mongo_observer.models import path_values
+
+
+# Sorts after the key of any value
+MAX_KEY = (127,)
+RegexType = type(re.compile(''))
+# Number of items of each bucket of a `SortedList`. Buckets are split when
+# they grow to twice as much
+BUCKET_SIZE = 1000
+
+
+class _Missing:
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+def index_key(value: Any) -> Tuple:
+    """
+    :return: A hashable key of `value`, ordered by mongo's BSON comparison
+    order across types. Values of the same type are ordered as usual, and
+    keys are equal for values mongo considers equal, as `1` and `1.0`
+    """
+    if isinstance(value, MinKey):
+        return (0,)
+    if value is None:
+        return (1,)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, Decimal128):
+        return (2, value.to_decimal())
+    if isinstance(value, Decimal):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, Mapping):
+        return (4, tuple((key, index_key(item)) for key, item in value.items()))
+    if isinstance(value, (list, UserList)):
+        return (5, tuple(index_key(item) for item in value))
+    if isinstance(value, bytes):
+        return (6, value)
+    if isinstance(value, ObjectId):
+        return (7, value.binary)
+    if isinstance(value, datetime):
+        return (9, value)
+    if isinstance(value, Timestamp):
+        return (10, value.time, value.inc)
+    if isinstance(value, (Regex, RegexType)):
+        return (11, value.pattern, str(value.flags))
+    if isinstance(value, MaxKey):
+        return (126,)
+    return (12, repr(value))
+
+
+def _unpositioned(path: str) -> str:
+    return '.'.join(part for part in path.split('.') if not part.isdigit())
+
+
+def overlaps(path: str, other: str) -> bool:
+    """
+    :return: True if changing the value at `path` may change the value at
+    `other`, as they're the same, or one of them is a parent of the other.
+    Array positions are disregarded
+    """
+    path, other = _unpositioned(path), _unpositioned(other)
+    return (path == other or
+            path.startswith(other + '.') or
+            other.startswith(path + '.'))
+
+
+# (bucket, position in the bucket)
+Position = Tuple[int, int]
+
+
+class SortedList:
+    """
+    A list kept sorted, split into buckets of up to `2 * bucket_size` items,
+    so that inserting or deleting an item only shifts the items of its
+    bucket, instead of every item of the list
+    """
+    def __init__(self, bucket_size: int=BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self.buckets: List[List[Any]] = []
+        # the last item of each bucket
+        self.maxes: List[Any] = []
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[Any]:
+        return itertools.chain.from_iterable(self.buckets)
+
+    def clear(self):
+        self.buckets.clear()
+        self.maxes.clear()
+        self.length = 0
+
+    def update(self, items: Iterable[Any]):
+        """
+        Adds every item of `items`, rebuilding the buckets with a single sort
+        """
+        items = sorted(itertools.chain(self, items))
+        size = self.bucket_size
+        self.buckets = [items[i:i + size] for i in range(0, len(items), size)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.length = len(items)
+
+    def add(self, item: Any):
+        buckets, maxes = self.buckets, self.maxes
+        if not buckets:
+            buckets.append([item])
+            maxes.append(item)
+            self.length = 1
+            return
+
+        i = min(bisect_right(maxes, item), len(buckets) - 1)
+        bucket = buckets[i]
+        insort(bucket, item)
+        maxes[i] = bucket[-1]
+        self.length += 1
+
+        size = self.bucket_size
+        if len(bucket) > 2 * size:
+            buckets[i:i + 1] = [bucket[:size], bucket[size:]]
+            maxes[i:i + 1] = [bucket[size - 1], bucket[-1]]
+
+    def __getitem__(self, position: Position) -> Any:
+        i, j = position
+        return self.buckets[i][j]
+
+    def __delitem__(self, position: Position):
+        i, j = position
+        bucket = self.buckets[i]
+        del bucket[j]
+        self.length -= 1
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+
+    def bisect_left(self, item: Any) -> Position:
+        """
+        :return: The position of the first item greater than or equal to
+        `item`, which is the end if there's none
+        """
+        i = bisect_left(self.maxes, item)
+        if i == len(self.buckets):
+            return i, 0
+        return i, bisect_left(self.buckets[i], item)
+
+    def bisect_right(self, item: Any) -> Position:
+        """
+        :return: The position of the first item greater than `item`, which
+        is the end if there's none
+        """
+        i = bisect_right(self.maxes, item)
+        if i == len(self.buckets):
+            return i, 0
+        return i, bisect_right(self.buckets[i], item)
+
+    def end(self) -> Position:
+        return len(self.buckets), 0
+
+    def islice(self,
+               start: Position=(0, 0),
+               stop: Position=None,
+               reverse: bool=False) -> Iterator[Any]:
+        """
+        :return: The items from the `start` position up to, but excluding,
+        the `stop` one, in reverse order if `reverse`
+        """
+        buckets = self.buckets
+        stop_i, stop_j = self.end() if stop is None else stop
+        start_i, start_j = start
+        slices = []
+        for i in range(start_i, min(stop_i + 1, len(buckets))):
+            lower = start_j if i == start_i else 0
+            upper = stop_j if i == stop_i else len(buckets[i])
+            if lower < upper:
+                slices.append((buckets[i], lower, upper))
+        if not reverse:
+            return itertools.chain.from_iterable(
+                itertools.islice(bucket, lower, upper)
+                for bucket, lower, upper in slices
+            )
+        return itertools.chain.from_iterable(
+            (bucket[j] for j in range(upper - 1, lower - 1, -1))
+            for bucket, lower, upper in reversed(slices)
+        )
+
+
+class Index(metaclass=abc.ABCMeta):
+    """
+    A secondary index of the documents of a `ReactiveCollection`, by the
+    values at a dotted `path`. Documents are indexed by every value matched
+    by mongo queries on `path`, and by None if there's none.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def keys(self, doc: Mapping[str, Any]) -> Set[Tuple]:
+        keys = {index_key(value) for value in path_values(doc, self.path)}
+        return keys or {index_key(None)}
+
+    @abc.abstractmethod
+    def add(self, _id: Any, doc: Mapping[str, Any]):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def remove(self, _id: Any, doc: Mapping[str, Any]):
+        """
+        :param doc: The document as it was when indexed
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def lookup(self, value: Any) -> List[Any]:
+        """
+        :return: The `_id`s of the documents with `value` at `path`
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def clear(self):
+        raise NotImplementedError()
+
+    def build(self, collection: Dict[Any, Mapping[str, Any]]):
+        for _id, doc in collection.items():
+            self.add(_id, doc)
+
+
+class HashIndex(Index):
+    """
+    Serves equality lookups in O(1)
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.ids: Dict[Tuple, Set[Any]] = {}
+
+    def clear(self):
+        self.ids.clear()
+
+    def add(self, _id: Any, doc: Mapping[str, Any]):
+        ids = self.ids
+        for key in self.keys(doc):
+            if key in ids:
+                ids[key].add(_id)
+            else:
+                ids[key] = {_id}
+
+    def remove(self, _id: Any, doc: Mapping[str, Any]):
+        ids = self.ids
+        for key in self.keys(doc):
+            indexed = ids.get(key)
+            if indexed is not None:
+                indexed.discard(_id)
+                if not indexed:
+                    del ids[key]
+
+    def lookup(self, value: Any) -> List[Any]:
+        return list(self.ids.get(index_key(value), ()))
+
+
+class PrimaryIndex(Index):
+    """
+    Serves equality lookups of `_id`s in O(1) from the documents of a
+    replica, which are already kept by `_id`, so it's never maintained
+    """
+    def __init__(self, collection: Mapping[Any, Mapping[str, Any]]):
+        super().__init__('_id')
+        self.collection = collection
+
+    def clear(self):
+        pass
+
+    def build(self, collection: Dict[Any, Mapping[str, Any]]):
+        pass
+
+    def add(self, _id: Any, doc: Mapping[str, Any]):
+        pass
+
+    def remove(self, _id: Any, doc: Mapping[str, Any]):
+        pass
+
+    def lookup(self, value: Any) -> List[Any]:
+        try:
+            return [value] if value in self.collection else []
+        except TypeError:
+            # unhashable values aren't keys of the replica
+            return []
+
+
+class SortedIndex(Index):
+    """
+    Serves equality and range lookups in O(log n), and iterates documents
+    ordered by `path`. Arrays are indexed by their items only, as they're
+    sorted by mongo. Entries are kept on a `SortedList`, so maintaining them
+    costs O(log n + `BUCKET_SIZE`).
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+        # sorted (key, _id key, _id) entries. (key, _id key) pairs are
+        # unique, so `_id`s are never compared
+        self.entries = SortedList()
+
+    def keys(self, doc: Mapping[str, Any]) -> Set[Tuple]:
+        keys = {index_key(value) for value in path_values(doc, self.path)
+                if not isinstance(value, (list, UserList))}
+        return keys or {index_key(None)}
+
+    def clear(self):
+        self.entries.clear()
+
+    def build(self, collection: Dict[Any, Mapping[str, Any]]):
+        self.entries.update((key, index_key(_id), _id)
+                            for _id, doc in collection.items()
+                            for key in self.keys(doc))
+
+    def add(self, _id: Any, doc: Mapping[str, Any]):
+        id_key = index_key(_id)
+        for key in self.keys(doc):
+            self.entries.add((key, id_key, _id))
+
+    def remove(self, _id: Any, doc: Mapping[str, Any]):
+        entries, id_key = self.entries, index_key(_id)
+        for key in self.keys(doc):
+            position = entries.bisect_left((key, id_key))
+            if position != entries.end() and \
+                    entries[position][:2] == (key, id_key):
+                del entries[position]
+
+    def lookup(self, value: Any) -> List[Any]:
+        return self.range(gte=value, lte=value)
+
+    def range(self,
+              gt: Any=MISSING,
+              gte: Any=MISSING,
+              lt: Any=MISSING,
+              lte: Any=MISSING,
+              reverse: bool=False) -> List[Any]:
+        """
+        :return: The `_id`s of the documents with a value at `path` within
+        the bounds, ordered by it. As in mongo queries, bounds only match
+        values of their own type
+        """
+        entries = self.entries
+        lower = gt if gte is MISSING else gte
+        upper = lt if lte is MISSING else lte
+
+        if gte is not MISSING:
+            start = entries.bisect_left((index_key(gte),))
+        elif gt is not MISSING:
+            start = entries.bisect_right((index_key(gt), MAX_KEY))
+        elif upper is not MISSING:
+            start = entries.bisect_left(((index_key(upper)[0],),))
+        else:
+            start = (0, 0)
+
+        if lte is not MISSING:
+            stop = entries.bisect_right((index_key(lte), MAX_KEY))
+        elif lt is not MISSING:
+            stop = entries.bisect_left((index_key(lt),))
+        elif lower is not MISSING:
+            stop = entries.bisect_left(((index_key(lower)[0] + 1,),))
+        else:
+            stop = entries.end()
+
+        return list(self._ids(entries.islice(start, stop, reverse)))
+
+    def ordered(self, reverse: bool=False) -> Iterable[Any]:
+        """
+        :return: Every indexed `_id`, ordered by the value at `path`. Documents
+        with many values are ordered by the lowest one, or by the highest one
+        if `reverse`, as sorted by mongo
+        """
+        return self._ids(self.entries.islice(reverse=reverse))
+
+    @staticmethod
+    def _ids(entries: Iterable[Tuple]) -> Iterable[Any]:
+        seen = set()
+        for _, id_key, _id in entries:
+            if id_key not in seen:
+                seen.add(id_key)
+                yield _id
@@ -0,0 +1,353 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, Any, List, Callable, Set, Iterable, Optional
+
+from bson import ObjectId, Timestamp
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import DESCENDING
+
+from mongo_observer import conf
+from mongo_observer.conf import logger
+from mongo_observer.cursors import fetch_batch
+from mongo_observer.models import Document
+
+
+# `$type` aliases of the `_id` types whose ranges may be split. Range queries
+# only match `_id`s of the same type bracket as the bounds
+ID_TYPE_ALIASES = {
+    ObjectId: 'objectId',
+    str: 'string',
+    int: 'number',
+    float: 'number',
+    datetime: 'date',
+}
+
+
+async def newest_timestamp(oplog) -> Optional[Timestamp]:
+    """
+    :return: The `ts` of the newest oplog entry, or None if it's empty
+    """
+    newest = await oplog.find_one(sort=[('$natural', DESCENDING)],
+                                  projection={'ts': True})
+    if newest is None:
+        return None
+    return newest['ts']
+
+
+def restricted(filter: Dict[str, Any],
+               query: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    :return: A filter of the documents matched by both `filter` and `query`
+    """
+    if not query:
+        return filter
+    if not filter:
+        return query
+    return {'$and': [filter, query]}
+
+
+async def split_ranges(remote_collection: AsyncIOMotorCollection,
+                       partitions: int,
+                       samples_per_partition: int=None,
+                       query: Dict[str, Any]=None) -> List[Dict[str, Any]]:
+    """
+    Splits the `_id` space of `remote_collection` into `partitions` ranges of
+    about the same number of documents, by sampling `_id`s.
+
+    :param query: If given, ranges are balanced by the documents matching it
+    :return: The `find` filters of each range, which together match every
+    document. A single empty filter if it can't be split
+    """
+    if partitions <= 1:
+        return [{}]
+    samples_per_partition = (samples_per_partition or
+                             conf.INITIAL_SYNC_SAMPLES_PER_PARTITION)
+    pipeline = [
+        {'$sample': {'size': partitions * samples_per_partition}},
+        {'$project': {'_id': True}},
+    ]
+    if query:
+        pipeline.insert(0, {'$match': query})
+    cursor = remote_collection.aggregate(pipeline)
+    ids = [doc['_id'] async for doc in cursor]
+
+    id_types = {ID_TYPE_ALIASES.get(type(_id)) for _id in ids}
+    if len(id_types) != 1 or None in id_types:
+        return [{}]
+    alias = id_types.pop()
+
+    ids = sorted(set(ids))
+    step = len(ids) / partitions
+    bounds = sorted({ids[int(step * i)] for i in range(1, partitions)})
+    if not bounds:
+        return [{}]
+
+    ranges = [{'_id': {'$lt': bounds[0]}}]
+    ranges.extend({'_id': {'$gte': lower, '$lt': upper}}
+                  for lower, upper in zip(bounds, bounds[1:]))
+    ranges.append({'_id': {'$gte': bounds[-1]}})
+    # `_id`s of any other type
+    ranges.append({'_id': {'$not': {'$type': alias}}})
+    return ranges
+
+
+class InitialSyncProgress:
+    def __init__(self,
+                 total: int,
+                 on_progress: Callable[[int, int], Any]=None):
+        """
+        :param total: Estimated number of documents to be loaded
+        :param on_progress: Called with the number of loaded documents and
+        `total` after each loaded batch
+        """
+        self.total = total
+        self.loaded = 0
+        self.on_progress = on_progress
+
+    @property
+    def percentage(self) -> float:
+        if not self.total:
+            return 100.0
+        return min(100.0, 100.0 * self.loaded / self.total)
+
+    def advance(self, count: int):
+        self.loaded += count
+        if self.on_progress is not None:
+            self.on_progress(self.loaded, self.total)
+
+
+async def load_range(remote_collection: AsyncIOMotorCollection,
+                     filter: Dict[str, Any],
+                     collection: Dict[Any, Document],
+                     batch_size: int,
+                     progress: InitialSyncProgress,
+                     projection: Dict[str, Any]=None):
+    cursor = remote_collection.find(filter,
+                                    projection=projection,
+                                    batch_size=batch_size)
+    batch = await fetch_batch(cursor)
+    while batch:
+        for doc in batch:
+            collection[doc['_id']] = Document(doc)
+        progress.advance(len(batch))
+        batch = await fetch_batch(cursor)
+
+
+async def load_collection(remote_collection: AsyncIOMotorCollection,
+                          partitions: int=None,
+                          batch_size: int=None,
+                          on_progress: Callable[[int, int], Any]=None,
+                          collection: Dict[Any, Document]=None,
+                          progress: InitialSyncProgress=None,
+                          query: Dict[str, Any]=None,
+                          projection: Dict[str, Any]=None) -> Dict[Any, Document]:
+    """
+    Loads every document of `remote_collection`, splitting its `_id` space
+    into `partitions` ranges loaded concurrently.
+
+    :param partitions: Defaults to `conf.INITIAL_SYNC_PARTITIONS`
+    :param batch_size: Cursor batch size. Defaults to
+    `conf.INITIAL_SYNC_BATCH_SIZE`
+    :param on_progress: Called with the number of loaded documents and the
+    estimated total after each loaded batch
+    :param collection: Where documents are loaded into. A new dict by default
+    :param progress: Tracks loaded documents, instead of a new one created
+    with `on_progress`
+    :param query: If given, only the documents matching it are loaded
+    :param projection: If given, the fields of the loaded documents
+    """
+    partitions = partitions or conf.INITIAL_SYNC_PARTITIONS
+    batch_size = batch_size or conf.INITIAL_SYNC_BATCH_SIZE
+    if collection is None:
+        collection = {}
+    if progress is None:
+        if query:
+            total = await remote_collection.count_documents(query)
+        else:
+            total = await remote_collection.estimated_document_count()
+        progress = InitialSyncProgress(total, on_progress)
+
+    ranges = await split_ranges(remote_collection, partitions, query=query)
+    logger.info({'info': 'loading collection',
+                 'collection': remote_collection.name,
+                 'documents': progress.total,
+                 'ranges': len(ranges)})
+    await asyncio.gather(*(load_range(remote_collection,
+                                      restricted(filter, query),
+                                      collection,
+                                      batch_size,
+                                      progress,
+                                      projection)
+                           for filter in ranges))
+    return collection
+
+
+class BackgroundSync:
+    """
+    Loads a remote collection into `collection` while operations keep being
+    applied to it, and fetches documents which weren't loaded yet on demand,
+    batching concurrent lookups into a single query.
+
+    Operations applied while loading must be reported by `touch`. A loaded
+    document is only stored if no operation touched it since the query that
+    read it started, as it may be older than the applied operations. It's
+    fetched again afterwards, and `ready` is resolved once there are no such
+    documents left.
+    """
+    def __init__(self,
+                 collection: Dict[Any, Document],
+                 remote_collection: AsyncIOMotorCollection,
+                 partitions: int=None,
+                 batch_size: int=None,
+                 fetch_batch_size: int=None,
+                 on_progress: Callable[[int, int], Any]=None,
+                 projection: Dict[str, Any]=None,
+                 query: Dict[str, Any]=None):
+        """
+        :param fetch_batch_size: Maximum number of `_id`s fetched by a single
+        query. Defaults to `conf.INITIAL_SYNC_FETCH_BATCH_SIZE`
+        :param projection: If given, the fields of the loaded documents
+        :param query: If given, only the documents matching it are loaded and
+        fetched
+        """
+        self.collection = collection
+        self.remote_collection = remote_collection
+        self.partitions = partitions or conf.INITIAL_SYNC_PARTITIONS
+        self.batch_size = batch_size or conf.INITIAL_SYNC_BATCH_SIZE
+        self.fetch_batch_size = (fetch_batch_size or
+                                 conf.INITIAL_SYNC_FETCH_BATCH_SIZE)
+        self.on_progress = on_progress
+        self.projection = projection
+        self.query = query
+        self.progress: InitialSyncProgress = None
+        self.ready = asyncio.get_event_loop().create_future()
+        self.task: asyncio.Future = None
+
+        # number of operations applied while loading, and the last one that
+        # touched each document
+        self.sequence = 0
+        self.modified: Dict[Any, int] = {}
+        # documents that must be fetched again
+        self.stale: Set[Any] = set()
+        self.lookups: Dict[Any, asyncio.Future] = {}
+
+    @property
+    def loading(self) -> bool:
+        return not self.ready.done()
+
+    @property
+    def percentage(self) -> float:
+        if self.ready.done():
+            return 100.0
+        if self.progress is None:
+            return 0.0
+        return min(99.9, self.progress.percentage)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def touch(self, _id: Any):
+        self.sequence += 1
+        self.modified[_id] = self.sequence
+
+    async def run(self):
+        try:
+            remote_collection, query = self.remote_collection, self.query
+            if query:
+                total = await remote_collection.count_documents(query)
+            else:
+                total = await remote_collection.estimated_document_count()
+            self.progress = InitialSyncProgress(total, self.on_progress)
+            ranges = await split_ranges(remote_collection, self.partitions,
+                                        query=query)
+            logger.info({'info': 'loading collection in background',
+                         'collection': self.remote_collection.name,
+                         'documents': total,
+                         'ranges': len(ranges)})
+            await asyncio.gather(*(self._load_range(restricted(filter, query))
+                                   for filter in ranges))
+            while self.stale:
+                ids = [self.stale.pop()
+                       for _ in range(min(len(self.stale),
+                                          self.fetch_batch_size))]
+                await self.fetch(ids)
+        except Exception as e:
+            logger.error({'info': 'failed to load collection',
+                          'collection': self.remote_collection.name,
+                          'error': repr(e)})
+            self.ready.set_exception(e)
+        else:
+            self.modified.clear()
+            self.ready.set_result(None)
+
+    async def _load_range(self, filter: Dict[str, Any]):
+        cursor = self.remote_collection.find(filter,
+                                             projection=self.projection,
+                                             batch_size=self.batch_size)
+        while True:
+            started = self.sequence
+            batch = await fetch_batch(cursor)
+            if not batch:
+                return
+            self._store(batch, started)
+            self.progress.advance(len(batch))
+
+    def _store(self, docs: Iterable[Dict[str, Any]], started: int):
+        collection, modified = self.collection, self.modified
+        for doc in docs:
+            _id = doc['_id']
+            if modified.get(_id, 0) > started:
+                self.stale.add(_id)
+            else:
+                collection[_id] = Document(doc)
+
+    async def fetch(self, ids: List[Any]) -> Dict[Any, Document]:
+        """
+        Fetches the documents of `ids` from the remote collection, storing
+        the ones untouched since the query started
+
+        :return: The fetched documents, by `_id`
+        """
+        started = self.sequence
+        cursor = self.remote_collection.find(restricted({'_id': {'$in': ids}},
+                                                        self.query),
+                                             projection=self.projection,
+                                             batch_size=len(ids))
+        docs = {}
+        batch = await fetch_batch(cursor)
+        while batch:
+            docs.update((doc['_id'], doc) for doc in batch)
+            batch = await fetch_batch(cursor)
+        self._store(docs.values(), started)
+        return docs
+
+    async def get(self, _id: Any) -> Optional[Document]:
+        """
+        :return: The document of `_id`, fetched from the remote collection
+        along with every other one looked up on the same loop iteration
+        """
+        future = self.lookups.get(_id)
+        if future is None:
+            future = self.lookups[_id] = asyncio.get_event_loop().create_future()
+            if len(self.lookups) == 1:
+                asyncio.ensure_future(self._resolve_lookups())
+        return await asyncio.shield(future)
+
+    async def _resolve_lookups(self):
+        # lets every concurrent lookup join the batch
+        await asyncio.sleep(0)
+        lookups, self.lookups = self.lookups, {}
+        ids = list(lookups)
+        for start in range(0, len(ids), self.fetch_batch_size):
+            chunk = ids[start:start + self.fetch_batch_size]
+            try:
+                docs = await self.fetch(chunk)
+            except Exception as e:
+                for _id in chunk:
+                    lookups[_id].set_exception(e)
+                continue
+            for _id in chunk:
+                doc = self.collection.get(_id)
+                if doc is None and _id in docs:
+                    doc = Document(docs[_id])
+                lookups[_id].set_result(doc)
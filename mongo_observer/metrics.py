@@ -0,0 +1,211 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, Any, List, Iterable, Callable, Coroutine, Tuple, \
+    Optional
+
+from bson import Timestamp
+
+from mongo_observer.models import Operations
+
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+HANDLER_METHODS = {
+    Operations.INSERT: 'on_insert',
+    Operations.UPDATE: 'on_update',
+    Operations.DELETE: 'on_delete',
+}
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(sorted(buckets))
+        # the last count is the `+Inf` bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        """
+        :return: `(upper_bound, count)` pairs, where `count` is the number of
+        observed values lesser than or equal to `upper_bound`
+        """
+        bounds = [str(bucket) for bucket in self.buckets] + ['+Inf']
+        cumulative, total = [], 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {'buckets': dict(self.cumulative_counts()),
+                'sum': self.sum,
+                'count': self.count}
+
+
+class ObserverMetrics:
+    """
+    Collects throughput, replication lag, cursor batch sizes, reconnections
+    and handler latencies of an `Observer`, exposed by `snapshot` and
+    `to_prometheus`.
+
+    Handler latencies are only collected for handlers passed to `instrument`.
+    """
+    def __init__(self):
+        self.operations: Dict[Tuple[str, str], int] = defaultdict(int)
+        # `ts` of the last handled oplog entry
+        self.last_timestamp: Timestamp = None
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.handler_latencies: Dict[str, Histogram] = {}
+        self.reconnect_scheduler = None
+
+        self._last_snapshot_time = time.monotonic()
+        self._last_snapshot_operations: Dict[Tuple[str, str], int] = {}
+
+    @property
+    def reconnects(self) -> int:
+        if self.reconnect_scheduler is None:
+            return 0
+        return self.reconnect_scheduler.reconnects
+
+    @property
+    def lag(self) -> Optional[float]:
+        """
+        Seconds since the last handled oplog entry was written. It keeps
+        growing while the observer stalls
+        """
+        if self.last_timestamp is None:
+            return None
+        return time.time() - self.last_timestamp.time
+
+    def record_batch(self, batch: List[Dict[str, Any]], namespace: str=None):
+        """
+        :param batch: Handled oplog entries
+        :param namespace: Namespace of the entries whose `ns` isn't available
+        """
+        operations = self.operations
+        for operation in batch:
+            operations[(operation.get('ns', namespace), operation['op'])] += 1
+        self.batch_sizes.observe(len(batch))
+        self.last_timestamp = batch[-1]['ts']
+
+    def instrument(self, operation_handler):
+        """
+        Replaces the `on_*` handlers (and synchronous appliers, if any) of
+        `operation_handler` with ones that record their latency
+        """
+        handlers = operation_handler.handlers
+        for op, handler in list(handlers.items()):
+            handlers[op] = self._timed_coroutine(handler, self._latency(op))
+
+        appliers = getattr(operation_handler, 'appliers', None) or {}
+        for op, apply in list(appliers.items()):
+            appliers[op] = self._timed_function(apply, self._latency(op))
+
+    def _latency(self, op: str) -> Histogram:
+        method = HANDLER_METHODS.get(op, op)
+        try:
+            return self.handler_latencies[method]
+        except KeyError:
+            histogram = self.handler_latencies[method] = Histogram(LATENCY_BUCKETS)
+            return histogram
+
+    @staticmethod
+    def _timed_coroutine(handler: Callable[..., Coroutine],
+                         histogram: Histogram) -> Callable[..., Coroutine]:
+        observe = histogram.observe
+
+        async def timed_handler(operation: Dict[str, Any]):
+            start = time.perf_counter()
+            try:
+                return await handler(operation)
+            finally:
+                observe(time.perf_counter() - start)
+        return timed_handler
+
+    @staticmethod
+    def _timed_function(apply: Callable, histogram: Histogram) -> Callable:
+        observe = histogram.observe
+
+        def timed_apply(operation: Dict[str, Any]):
+            start = time.perf_counter()
+            try:
+                return apply(operation)
+            finally:
+                observe(time.perf_counter() - start)
+        return timed_apply
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        :return: Current metrics. `operations_per_second` is measured since
+        the previous snapshot
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_snapshot_time
+        operations = dict(self.operations)
+        rates = {
+            key: (count - self._last_snapshot_operations.get(key, 0)) / elapsed
+            for key, count in operations.items()
+        } if elapsed > 0 else {}
+        self._last_snapshot_time = now
+        self._last_snapshot_operations = operations
+
+        return {
+            'operations': operations,
+            'operations_per_second': rates,
+            'lag': self.lag,
+            'reconnects': self.reconnects,
+            'batch_sizes': self.batch_sizes.snapshot(),
+            'handler_latencies': {method: histogram.snapshot()
+                                  for method, histogram
+                                  in self.handler_latencies.items()}
+        }
+
+    def to_prometheus(self, prefix: str='mongo_observer') -> str:
+        """
+        :return: Metrics in the Prometheus text exposition format
+        """
+        lines = [f'# TYPE {prefix}_operations_total counter']
+        for (namespace, op), count in sorted(self.operations.items(),
+                                             key=lambda item: str(item[0])):
+            lines.append(f'{prefix}_operations_total'
+                         f'{{namespace="{namespace}",op="{op}"}} {count}')
+
+        lines.append(f'# TYPE {prefix}_replication_lag_seconds gauge')
+        lag = self.lag
+        if lag is not None:
+            lines.append(f'{prefix}_replication_lag_seconds {lag}')
+
+        lines.append(f'# TYPE {prefix}_reconnects_total counter')
+        lines.append(f'{prefix}_reconnects_total {self.reconnects}')
+
+        lines.append(f'# TYPE {prefix}_cursor_batch_size histogram')
+        lines.extend(self._histogram_lines(f'{prefix}_cursor_batch_size',
+                                           self.batch_sizes))
+
+        lines.append(f'# TYPE {prefix}_handler_latency_seconds histogram')
+        for method, histogram in sorted(self.handler_latencies.items()):
+            lines.extend(self._histogram_lines(
+                f'{prefix}_handler_latency_seconds',
+                histogram,
+                labels=f'method="{method}",'
+            ))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram_lines(name: str,
+                         histogram: Histogram,
+                         labels: str='') -> List[str]:
+        lines = [f'{name}_bucket{{{labels}le="{bound}"}} {count}'
+                 for bound, count in histogram.cumulative_counts()]
+        sum_count_labels = f'{{{labels.rstrip(",")}}}' if labels else ''
+        lines.append(f'{name}_sum{sum_count_labels} {histogram.sum}')
+        lines.append(f'{name}_count{sum_count_labels} {histogram.count}')
+        return lines
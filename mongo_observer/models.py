@@ -1,3 +1,8 @@
+from collections import UserList
+from typing import Dict, Any, Mapping, List
+
+import bson
+from bson.raw_bson import RawBSONDocument
 from pathdict.collection import PathDict, StringIndexableList
 
 
@@ -10,6 +15,70 @@ class Operations:
     NO_OP = 'n'
 
 
+def document_id(operation: Dict[str, Any]):
+    """
+    :param operation: An oplog entry
+    :return: The `_id` of the document affected by `operation`, or None if it
+    doesn't affect a single document
+    """
+    if operation['op'] == Operations.UPDATE:
+        return operation['o2'].get('_id')
+    return operation.get('o', {}).get('_id')
+
+
+def decoded(document: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    :param document: A dict or a lazily decoded `RawBSONDocument`, as
+    operations fetched by an `Observer` with `raw_bson=True`
+    :return: `document` fully decoded into nested dicts
+    """
+    if isinstance(document, RawBSONDocument):
+        return bson.decode(document.raw)
+    return document
+
+
+def plain(value: Any) -> Any:
+    """
+    :return: `value` with every nested mapping and list, such as `Document`s
+    and `NullableList`s, converted into plain dicts and lists, as
+    expected by `bson.encode`
+    """
+    if isinstance(value, Mapping):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, (list, UserList)):
+        return [plain(item) for item in value]
+    return value
+
+
+def path_values(document: Mapping[str, Any], path: str) -> List[Any]:
+    """
+    :param path: A dotted path, which may traverse arrays, either by position
+    or by the fields of their embedded documents
+    :return: Every value found at `path`, as matched by mongo queries: an
+    array is returned along with each of its items. Empty if there's none
+    """
+    values = [document]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, Mapping):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, (list, UserList)):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                found.extend(item[part] for item in value
+                             if isinstance(item, Mapping) and part in item)
+        values = found
+
+    result = []
+    for value in values:
+        result.append(value)
+        if isinstance(value, (list, UserList)):
+            result.extend(value)
+    return result
+
+
 class NullableList(StringIndexableList):
     def __delitem__(self, key):
         if isinstance(key, str):
@@ -1,11 +1,18 @@
 import asyncio
-from typing import Callable, Coroutine
+from typing import Callable, Coroutine, Dict, Any, List
 
 from bson import Timestamp
+from bson.raw_bson import RawBSONDocument
 from pymongo import CursorType, DESCENDING
+from pymongo.errors import ConnectionFailure
 
 from mongo_observer import conf
-from mongo_observer.operation_handlers import OperationHandler
+from mongo_observer.checkpoints import CheckpointStore
+from mongo_observer.cursors import fetch_batch
+from mongo_observer.metrics import ObserverMetrics
+from mongo_observer.operation_handlers import OperationHandler, \
+    NamespaceRouter
+from mongo_observer.reconnect import ReconnectScheduler
 
 
 class ShouldStopObservation(KeyboardInterrupt):
@@ -18,7 +25,13 @@ class Observer:
                  operation_handler: OperationHandler,
                  namespace_filter: str,
                  starting_timestamp: float,
-                 on_nothing_to_fetch_on_cursor: Callable[..., Coroutine]):
+                 on_nothing_to_fetch_on_cursor: Callable[..., Coroutine],
+                 prefetch_batches: int=None,
+                 checkpoint_store: CheckpointStore=None,
+                 reconnect_scheduler: ReconnectScheduler=None,
+                 catch_up_threshold: float=None,
+                 metrics: ObserverMetrics=None,
+                 raw_bson: bool=False):
         """
         :param oplog: Operation log collection
         :param operation_handler: Delegate object responsible of handling
@@ -28,6 +41,22 @@ class Observer:
         timestamp of the operation
         :param on_nothing_to_fetch_on_cursor: Coroutine awaited when cursor has
         no data to be fetched
+        :param prefetch_batches: Maximum number of cursor batches fetched ahead
+        of the handler. If greater than 0, fetching and handling run
+        concurrently. Defaults to `conf.OPLOG_PREFETCH_BATCHES`
+        :param checkpoint_store: Store where the `last_timestamp` of the
+        operation handler is checkpointed after each handled batch
+        :param reconnect_scheduler: Schedules new cursors when the current one
+        dies or its connection fails
+        :param catch_up_threshold: Number of seconds behind the newest oplog
+        entry above which the backlog is drained by `catch_up` before tailing
+        the oplog. 0 disables it. Defaults to
+        `conf.CATCH_UP_LAG_THRESHOLD_IN_SECONDS`
+        :param metrics: Collects observation metrics of handled batches
+        :param raw_bson: If True, oplog entries are fetched as
+        `RawBSONDocument`s, which are only decoded as their fields are
+        accessed. Nested documents, such as `o` and `o2`, stay undecoded until
+        accessed or `models.decoded`, and their BSON is available at `raw`
         """
         if namespace_filter is None:
             filter = {}
@@ -38,11 +67,31 @@ class Observer:
         self.filter['ts'] = {'$gt': starting_timestamp}
 
         self.operation_handler = operation_handler
+        if raw_bson:
+            codec_options = oplog.codec_options.with_options(
+                document_class=RawBSONDocument
+            )
+            oplog = oplog.with_options(codec_options=codec_options)
         self.oplog = oplog
+        self.raw_bson = raw_bson
 
         self.logger = conf.logger
-        self.sleep_time = conf.SLEEP_TIME_BEFORE_GET_NEW_CURSOR_IN_SECONDS
+        self.reconnect_scheduler = reconnect_scheduler or ReconnectScheduler()
         self.on_nothing_to_fetch_on_cursor = on_nothing_to_fetch_on_cursor
+        if prefetch_batches is None:
+            prefetch_batches = conf.OPLOG_PREFETCH_BATCHES
+        self.prefetch_batches = prefetch_batches
+        self.checkpoint_store = checkpoint_store
+        if catch_up_threshold is None:
+            catch_up_threshold = conf.CATCH_UP_LAG_THRESHOLD_IN_SECONDS
+        self.catch_up_threshold = catch_up_threshold
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.reconnect_scheduler = self.reconnect_scheduler
+        self.last_fetched_timestamp: Timestamp = None
+        self.cursor_outdated = False
+        self.projection: Dict[str, int] = None
+        self.push_down()
 
     @classmethod
     async def init_async(cls,
@@ -50,7 +99,16 @@ class Observer:
                          operation_handler: OperationHandler,
                          namespace_filter: str=None,
                          starting_timestamp: Timestamp=None,
-                         on_nothing_to_fetch_on_cursor=None):
+                         on_nothing_to_fetch_on_cursor=None,
+                         prefetch_batches: int=None,
+                         checkpoint_store: CheckpointStore=None,
+                         reconnect_scheduler: ReconnectScheduler=None,
+                         catch_up_threshold: float=None,
+                         metrics: ObserverMetrics=None,
+                         raw_bson: bool=False):
+
+        if starting_timestamp is None and checkpoint_store is not None:
+            starting_timestamp = await checkpoint_store.load()
 
         if starting_timestamp is None:
             last_doc = await oplog.find_one(sort=[('$natural', DESCENDING)])
@@ -63,29 +121,250 @@ class Observer:
                    operation_handler,
                    namespace_filter,
                    starting_timestamp,
-                   on_nothing_to_fetch_on_cursor)
+                   on_nothing_to_fetch_on_cursor,
+                   prefetch_batches=prefetch_batches,
+                   checkpoint_store=checkpoint_store,
+                   reconnect_scheduler=reconnect_scheduler,
+                   catch_up_threshold=catch_up_threshold,
+                   metrics=metrics,
+                   raw_bson=raw_bson)
+
+    def push_down(self) -> bool:
+        """
+        Pushes the `op` types and top level oplog fields required by the
+        operation handler down to the oplog query, so that unneeded entries
+        and fields never leave the server.
+
+        :return: True if the oplog query changed
+        """
+        operation_types = self.operation_handler.operation_types
+        oplog_fields = self.operation_handler.oplog_fields
+
+        if operation_types is None:
+            op_filter = None
+        else:
+            op_filter = {'$in': sorted(operation_types)}
+        if oplog_fields is None:
+            projection = None
+        else:
+            projection = dict.fromkeys(('ts', 'op', *oplog_fields), 1)
+
+        changed = (op_filter != self.filter.get('op') or
+                   projection != self.projection)
+        if op_filter is None:
+            self.filter.pop('op', None)
+        else:
+            self.filter['op'] = op_filter
+        self.projection = projection
+        return changed
+
+    @property
+    def resume_timestamp(self) -> Timestamp:
+        # Batches may be fetched ahead of the handler, so cursors resume from
+        # the last fetched operation to avoid handling it twice
+        return (self.last_fetched_timestamp or
+                self.operation_handler.last_timestamp or
+                self.filter['ts']['$gt'])
 
     def get_new_cursor(self):
-        if self.operation_handler.last_timestamp:
-            self.filter['ts']['$gt'] = self.operation_handler.last_timestamp
+        self.filter['ts']['$gt'] = self.resume_timestamp
 
+        # `oplog_replay` lets the server binary search the starting `ts`
+        # instead of scanning the capped collection from its beginning
         return self.oplog.find(self.filter,
-                               cursor_type=CursorType.TAILABLE_AWAIT)
+                               self.projection,
+                               cursor_type=CursorType.TAILABLE_AWAIT,
+                               oplog_replay=True)
+
+    def get_catch_up_cursor(self, until: Timestamp):
+        filter = dict(self.filter, ts={'$gt': self.resume_timestamp,
+                                       '$lte': until})
+        return self.oplog.find(filter,
+                               self.projection,
+                               oplog_replay=True,
+                               batch_size=conf.CATCH_UP_BATCH_SIZE)
+
+    async def catch_up(self) -> int:
+        """
+        While the observer lags behind the newest oplog entry by more than
+        `catch_up_threshold` seconds, drains the backlog up to that entry
+        with large batch, non tailable cursors. Connection failures are
+        retried by the `reconnect_scheduler`, from the last fetched operation.
+
+        :return: Number of handled operations
+        """
+        handled = 0
+        while True:
+            try:
+                newest = await self.oplog.find_one(
+                    sort=[('$natural', DESCENDING)],
+                    projection={'ts': True}
+                )
+            except ConnectionFailure as e:
+                await self._reconnect(e)
+                continue
+            if newest is None:
+                return handled
+
+            lag = newest['ts'].time - self.resume_timestamp.time
+            if lag <= self.catch_up_threshold:
+                return handled
+
+            self.logger.info({'info': 'catching up with oplog', 'lag': lag})
+            cursor = self.get_catch_up_cursor(until=newest['ts'])
+            while True:
+                try:
+                    batch = await fetch_batch(cursor)
+                except ConnectionFailure as e:
+                    await self._reconnect(e)
+                    break
+                self.reconnect_scheduler.reset()
+                if not batch:
+                    # every entry up to `newest` was read, even if none was
+                    # handled
+                    self.last_fetched_timestamp = newest['ts']
+                    break
+                self.last_fetched_timestamp = batch[-1]['ts']
+                await self.handle_batch(batch)
+                handled += len(batch)
 
     async def observe_changes(self):
+        try:
+            if self.catch_up_threshold:
+                await self.catch_up()
+            if self.prefetch_batches > 0:
+                await self._observe_changes_pipelined()
+            else:
+                await self._read_changes(self.handle_batch)
+        except ShouldStopObservation:
+            self.logger.debug('Stopping observer')
+        finally:
+            await self.operation_handler.stop()
+            if self.checkpoint_store is not None:
+                await self.checkpoint_store.flush()
+
+    async def handle_batch(self, batch: List[Dict[str, Any]]):
+        await self.operation_handler.handle_batch(batch)
+        if self.metrics is not None:
+            self.metrics.record_batch(batch, self.namespace_filter)
+        last_timestamp = self.operation_handler.last_timestamp
+        if self.checkpoint_store is not None and last_timestamp is not None:
+            await self.checkpoint_store.checkpoint(last_timestamp, len(batch))
+
+    async def _observe_changes_pipelined(self):
+        """
+        Runs a reader task, which fills a bounded queue with cursor batches,
+        and a dispatcher task, which drains it into the operation handler.
+        The reader waits while the queue is full. Once reading stops, the
+        batches already fetched are still handled, and once dispatching stops,
+        either by an error or a stop request, reading is cancelled.
+        """
+        queue = asyncio.Queue(maxsize=self.prefetch_batches)
+        reader = asyncio.ensure_future(self._read_into(queue))
+        dispatcher = asyncio.ensure_future(self._dispatch_from(queue))
+        try:
+            done, _ = await asyncio.wait((reader, dispatcher),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if dispatcher in done or reader.exception() is not None:
+                reader.cancel()
+                dispatcher.cancel()
+            for task in (reader, dispatcher):
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        finally:
+            reader.cancel()
+            dispatcher.cancel()
+
+    async def _read_into(self, queue: asyncio.Queue):
+        await self._read_changes(queue.put)
+        await queue.put(None)
+
+    async def _dispatch_from(self, queue: asyncio.Queue):
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    return
+                await self.handle_batch(batch)
+        except ShouldStopObservation:
+            self.logger.debug('Stopping observer')
+
+    async def _reconnect(self, error: ConnectionFailure):
+        self.logger.warning({'info': 'oplog cursor failed',
+                             'attempts': self.reconnect_scheduler.attempts,
+                             'error': repr(error)})
+        await self.reconnect_scheduler.wait()
+
+    async def _read_changes(self,
+                            dispatch: Callable[[List[Dict[str, Any]]], Coroutine]):
         cursor = self.get_new_cursor()
         try:
             while True:
                 if not cursor.alive:
-                    asyncio.sleep(self.sleep_time)
+                    await self.reconnect_scheduler.wait()
                     cursor = self.get_new_cursor()
+                elif self.cursor_outdated:
+                    self.cursor_outdated = False
+                    await cursor.close()
+                    cursor = self.get_new_cursor()
+
+                try:
+                    batch = await fetch_batch(cursor)
+                except ConnectionFailure as e:
+                    await self._reconnect(e)
+                    cursor = self.get_new_cursor()
+                    continue
+                self.reconnect_scheduler.reset()
 
-                empty_cursor = True
-                async for doc in cursor:
-                    empty_cursor = False
-                    await self.operation_handler.handle(operation=doc)
-                if empty_cursor and self.on_nothing_to_fetch_on_cursor:
-                    await self.on_nothing_to_fetch_on_cursor()
+                if batch:
+                    self.last_fetched_timestamp = batch[-1]['ts']
+                    await dispatch(batch)
+                else:
+                    await self.operation_handler.check()
+                    if self.on_nothing_to_fetch_on_cursor:
+                        await self.on_nothing_to_fetch_on_cursor()
         except ShouldStopObservation:
             self.logger.debug('Stopping observer')
             return
+
+
+class MultiplexObserver(Observer):
+    """
+    Observes many namespaces through a single oplog cursor, routing each
+    operation to the handler attached to its namespace on a `NamespaceRouter`.
+
+    If a `namespace_filter` (e.g.: a compiled regex) is provided, it must match
+    every namespace that may be attached, and the cursor is never renewed on
+    `attach`. Otherwise, the cursor is filtered by `{'$in': [...]}` with the
+    attached namespaces, and attaching a new one renews the cursor at the
+    next batch, from the last fetched operation.
+    """
+    def __init__(self,
+                 oplog,
+                 operation_handler: NamespaceRouter,
+                 namespace_filter,
+                 starting_timestamp: Timestamp,
+                 on_nothing_to_fetch_on_cursor: Callable[..., Coroutine],
+                 **kwargs):
+        super().__init__(oplog,
+                         operation_handler,
+                         namespace_filter,
+                         starting_timestamp,
+                         on_nothing_to_fetch_on_cursor,
+                         **kwargs)
+        if namespace_filter is None:
+            self.filter['ns'] = {'$in': sorted(operation_handler.routes)}
+
+    def attach(self, namespace: str, operation_handler: OperationHandler):
+        self.operation_handler.attach(namespace, operation_handler)
+        if self.namespace_filter is None and \
+                namespace not in self.filter['ns']['$in']:
+            self.filter['ns'] = {'$in': sorted(self.operation_handler.routes)}
+            self.cursor_outdated = True
+        if self.push_down():
+            self.cursor_outdated = True
+
+    def detach(self, namespace: str) -> OperationHandler:
+        return self.operation_handler.detach(namespace)
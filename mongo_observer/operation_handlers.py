@@ -1,16 +1,31 @@
 import abc
-from typing import Dict, Any
+from collections import deque
+from typing import Dict, Any, List, Set, Iterable, Callable, Optional, \
+    MutableMapping
 
 import asyncio
 from bson import ObjectId, Timestamp
 from motor.motor_asyncio import AsyncIOMotorCollection
 from pymongo import CursorType
 
+from mongo_observer import conf
 from mongo_observer.conf import logger
-from mongo_observer.models import Operations, Document
+from mongo_observer.initial_sync import load_collection, newest_timestamp, \
+    BackgroundSync, restricted
+from mongo_observer.indexes import Index, HashIndex, SortedIndex, MISSING, \
+    overlaps
+from mongo_observer.queries import QueryEngine, Sort, Projection, parse, \
+    paths, compile_filter
+from mongo_observer.snapshots import SnapshotFile, is_replayable
+from mongo_observer.models import Operations, Document, document_id, \
+    decoded
 
 
 class OperationHandler(metaclass=abc.ABCMeta):
+    # Top level oplog fields required by the handler, besides `ts` and `op`.
+    # None means every field
+    oplog_fields: Iterable[str] = None
+
     def __init__(self):
         self.handlers = {
             Operations.INSERT: self.on_insert,
@@ -19,6 +34,13 @@ class OperationHandler(metaclass=abc.ABCMeta):
         }
         self.last_timestamp: Timestamp = None
 
+    @property
+    def operation_types(self) -> Set[str]:
+        """
+        Oplog `op` types handled by the handler, or None for every type
+        """
+        return set(self.handlers)
+
     async def handle(self, operation: Dict[str, Any]):
         try:
             self.last_timestamp = operation['ts']
@@ -28,6 +50,28 @@ class OperationHandler(metaclass=abc.ABCMeta):
         else:
             await handler(operation)
 
+    async def handle_batch(self, operations: List[Dict[str, Any]]):
+        """
+        :param operations: Every operation fetched by the cursor on a single
+        network batch, in oplog order. Subclasses may override it to apply the
+        whole batch at once. By default, operations are handled one by one.
+        """
+        for operation in operations:
+            await self.handle(operation)
+
+    async def check(self):
+        """
+        Awaited by observers when there's nothing to fetch, so that handlers
+        applying operations in background may raise their errors while the
+        oplog is idle. Does nothing by default
+        """
+
+    async def stop(self):
+        """
+        Called by observers once observation ends, to release what handlers
+        applying operations in background hold. Does nothing by default
+        """
+
     @abc.abstractmethod
     async def on_insert(self, operation: Dict[str, Any]):
         """
@@ -75,35 +119,733 @@ class OperationHandler(metaclass=abc.ABCMeta):
         raise NotImplementedError()
 
 
+class PartitionedOperationHandler(OperationHandler):
+    """
+    Handles operations concurrently on `concurrency` workers, choosing the
+    worker by a hash of the affected document `_id`. Operations on the same
+    document are handled in oplog order, while operations on different
+    documents may be handled in parallel by the wrapped `operation_handler`.
+
+    `last_timestamp` only advances up to the newest operation for which every
+    previous operation has already been handled.
+    """
+    def __init__(self,
+                 operation_handler: OperationHandler,
+                 concurrency: int=None,
+                 worker_queue_size: int=None):
+        super().__init__()
+        self.operation_handler = operation_handler
+        self.concurrency = concurrency or conf.HANDLER_CONCURRENCY
+        self.worker_queue_size = worker_queue_size or conf.HANDLER_WORKER_QUEUE_SIZE
+        self.queues: List[asyncio.Queue] = []
+        self.workers: List[asyncio.Future] = []
+        # [timestamp, done] pairs of the operations not yet acknowledged
+        self.in_flight = deque()
+        self.error: BaseException = None
+
+    @property
+    def operation_types(self) -> Set[str]:
+        return self.operation_handler.operation_types
+
+    @property
+    def oplog_fields(self) -> Iterable[str]:
+        return self.operation_handler.oplog_fields
+
+    def start(self):
+        self.queues = [asyncio.Queue(maxsize=self.worker_queue_size)
+                       for _ in range(self.concurrency)]
+        self.workers = [asyncio.ensure_future(self._work(queue))
+                        for queue in self.queues]
+
+    async def handle_batch(self, operations: List[Dict[str, Any]]):
+        await super().handle_batch(operations)
+        await self.check()
+
+    async def check(self):
+        if self.error:
+            raise self.error
+
+    async def handle(self, operation: Dict[str, Any]):
+        if self.error:
+            raise self.error
+        if not self.workers:
+            self.start()
+
+        entry = [operation['ts'], False]
+        self.in_flight.append(entry)
+        if operation['op'] not in self.operation_handler.handlers:
+            logger.debug({'info': 'skipping operation', 'operation': operation})
+            entry[1] = True
+            self._advance()
+            return
+
+        key = document_id(operation)
+        try:
+            partition = hash(key) % self.concurrency
+        except TypeError:
+            partition = hash(repr(key)) % self.concurrency
+        await self.queues[partition].put((operation, entry))
+
+    async def _work(self, queue: asyncio.Queue):
+        handlers = self.operation_handler.handlers
+        failed = False
+        while True:
+            operation, entry = await queue.get()
+            try:
+                if failed:
+                    # later operations on the same documents would be applied
+                    # out of order, so the partition is only drained
+                    continue
+                await handlers[operation['op']](operation)
+            except asyncio.CancelledError:
+                raise
+            except (Exception, KeyboardInterrupt) as e:
+                # stop requests, as `ShouldStopObservation`, are raised on the
+                # next `handle` too, instead of killing the worker
+                logger.error({'info': 'failed to handle operation',
+                              'operation': operation,
+                              'error': repr(e)})
+                self.error = self.error or e
+                failed = True
+            else:
+                entry[1] = True
+                self._advance()
+            finally:
+                queue.task_done()
+
+    def _advance(self):
+        in_flight = self.in_flight
+        while in_flight and in_flight[0][1]:
+            self.last_timestamp = in_flight.popleft()[0]
+
+    async def join(self):
+        """
+        Waits until every operation already dispatched to a worker is handled
+        """
+        await asyncio.gather(*(queue.join() for queue in self.queues))
+        if self.error:
+            raise self.error
+
+    async def stop(self):
+        """
+        Cancels the workers, without waiting for the operations dispatched to
+        them. See `join`
+        """
+        workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def on_insert(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_insert(operation)
+
+    async def on_update(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_update(operation)
+
+    async def on_delete(self, operation: Dict[str, Any]):
+        return await self.operation_handler.on_delete(operation)
+
+
+class NamespaceRouter(OperationHandler):
+    """
+    Routes each operation to the handler attached to its `ns`. Handlers may
+    be attached and detached at any time.
+    """
+    def __init__(self, routes: Dict[str, OperationHandler]=None):
+        super().__init__()
+        self.routes = dict(routes or {})
+
+    def attach(self, namespace: str, operation_handler: OperationHandler):
+        self.routes[namespace] = operation_handler
+
+    def detach(self, namespace: str) -> OperationHandler:
+        return self.routes.pop(namespace, None)
+
+    @property
+    def operation_types(self) -> Set[str]:
+        operation_types = set()
+        for handler in self.routes.values():
+            if handler.operation_types is None:
+                return None
+            operation_types.update(handler.operation_types)
+        return operation_types
+
+    @property
+    def oplog_fields(self) -> Iterable[str]:
+        oplog_fields = {'ns'}
+        for handler in self.routes.values():
+            if handler.oplog_fields is None:
+                return None
+            oplog_fields.update(handler.oplog_fields)
+        return oplog_fields
+
+    async def handle(self, operation: Dict[str, Any]):
+        self.last_timestamp = operation['ts']
+        handler = self.routes.get(operation['ns'])
+        if handler is None:
+            logger.debug({'info': 'skipping operation', 'operation': operation})
+        else:
+            await handler.handle(operation)
+
+    async def handle_batch(self, operations: List[Dict[str, Any]]):
+        """
+        Dispatches each run of consecutive operations on the same namespace as
+        a single batch, keeping the oplog order across namespaces
+        """
+        if not operations:
+            return
+
+        routes = self.routes
+        start = 0
+        namespace = operations[0]['ns']
+        for i, operation in enumerate(operations):
+            if operation['ns'] != namespace:
+                await self._dispatch(routes, namespace, operations[start:i])
+                start, namespace = i, operation['ns']
+        await self._dispatch(routes, namespace, operations[start:])
+        self.last_timestamp = operations[-1]['ts']
+
+    async def check(self):
+        for handler in list(self.routes.values()):
+            await handler.check()
+
+    async def stop(self):
+        for handler in list(self.routes.values()):
+            await handler.stop()
+
+    @staticmethod
+    async def _dispatch(routes: Dict[str, OperationHandler],
+                        namespace: str,
+                        operations: List[Dict[str, Any]]):
+        handler = routes.get(namespace)
+        if handler is None:
+            logger.debug({'info': 'skipping operations',
+                          'namespace': namespace,
+                          'count': len(operations)})
+        else:
+            await handler.handle_batch(operations)
+
+    async def on_insert(self, operation: Dict[str, Any]):
+        return await self.routes[operation['ns']].on_insert(operation)
+
+    async def on_update(self, operation: Dict[str, Any]):
+        return await self.routes[operation['ns']].on_update(operation)
+
+    async def on_delete(self, operation: Dict[str, Any]):
+        return await self.routes[operation['ns']].on_delete(operation)
+
+
 class ReactiveCollection(OperationHandler):
+    oplog_fields = ('o', 'o2')
+
     def __init__(self,
-                 collection: Dict[ObjectId, Dict],
-                 remote_collection: AsyncIOMotorCollection):
+                 collection: MutableMapping,
+                 remote_collection: AsyncIOMotorCollection,
+                 projection: Dict[str, Any]=None):
+        """
+        :param collection: The documents, by `_id`. Either a dict or a storage
+        engine of `mongo_observer.storage`
+        :param projection: If given, only the projected fields of documents
+        are kept, and changes to any other field are ignored
+        """
         super().__init__()
+        self.check_projection(projection)
         self.collection = collection
         self.remote_collection = remote_collection
+        self.projection = Projection(projection) if projection else None
+        self.sync: BackgroundSync = None
+        self.indexes: Dict[str, Index] = {}
+        self.queries = QueryEngine(self.collection, self.indexes)
+
+        # Synchronous appliers used by `handle_batch`. An operation type whose
+        # `on_*` handler is overridden by a subclass is dispatched to it instead
+        cls = type(self)
+        self.appliers = {}
+        if cls.on_insert is ReactiveCollection.on_insert:
+            self.appliers[Operations.INSERT] = self.apply_insert
+        if cls.on_update is ReactiveCollection.on_update:
+            self.appliers[Operations.UPDATE] = self.apply_update
+        if cls.on_delete is ReactiveCollection.on_delete:
+            self.appliers[Operations.DELETE] = self.apply_delete
+
+    @staticmethod
+    def check_projection(projection: Optional[Dict[str, Any]]):
+        """
+        :raises ValueError: If `projection` excludes `_id`, by which
+        documents are kept
+        """
+        if projection and not Projection(projection).include_id:
+            raise ValueError('Replicas keep documents by _id, which may not '
+                             'be excluded by their projection')
 
     @classmethod
-    async def init_async(cls, remote_collection: AsyncIOMotorCollection):
-        cursor = remote_collection.find({})
-        collection = {doc['_id']: Document(doc) async for doc in cursor}
-        return cls(collection, remote_collection)
+    async def init_async(cls,
+                         remote_collection: AsyncIOMotorCollection,
+                         oplog=None,
+                         partitions: int=None,
+                         batch_size: int=None,
+                         on_progress: Callable[[int, int], Any]=None,
+                         snapshot: SnapshotFile=None,
+                         projection: Dict[str, Any]=None,
+                         storage: MutableMapping=None):
+        """
+        Loads every document of `remote_collection`, concurrently on
+        `partitions` ranges of `_id`s, or from a `snapshot`.
 
-    async def on_update(self, operation: Dict[str, Any]):
-        doc = self.collection[operation['o2']['_id']]
-        change = operation['o']
+        :param oplog: Operation log collection. If given, `last_timestamp` is
+        the newest oplog entry before the load, so that an `Observer` replays
+        every operation that happened during it
+        :param partitions: Number of ranges loaded concurrently. Defaults to
+        `conf.INITIAL_SYNC_PARTITIONS`
+        :param batch_size: Cursor batch size. Defaults to
+        `conf.INITIAL_SYNC_BATCH_SIZE`
+        :param on_progress: Called with the number of loaded documents and the
+        estimated total after each loaded batch
+        :param snapshot: Snapshot loaded instead of the remote collection, if
+        `oplog` still has every operation after its `last_timestamp`.
+        Otherwise, the remote collection is loaded
+        :param projection: If given, only the projected fields are loaded and
+        kept up to date. It may not exclude `_id`
+        :param storage: Where documents are kept, as a `BSONStorage`. A dict of
+        `Document`s by default
+        """
+        cls.check_projection(projection)
+        if snapshot is not None and oplog is not None:
+            loaded = await snapshot.load()
+            if loaded is not None:
+                collection, last_timestamp = loaded
+                if await is_replayable(oplog, last_timestamp):
+                    if storage is not None:
+                        storage.update(collection)
+                        collection = storage
+                    replica = cls(collection, remote_collection, projection)
+                    replica.last_timestamp = last_timestamp
+                    return replica
+                logger.warning({'info': 'snapshot fell off the oplog',
+                                'path': snapshot.path,
+                                'last_timestamp': str(last_timestamp)})
+
+        last_timestamp = None
+        if oplog is not None:
+            last_timestamp = await newest_timestamp(oplog)
+
+        collection = await load_collection(remote_collection,
+                                           partitions=partitions,
+                                           batch_size=batch_size,
+                                           on_progress=on_progress,
+                                           collection=storage,
+                                           projection=projection)
+        replica = cls(collection, remote_collection, projection)
+        replica.last_timestamp = last_timestamp
+        return replica
+
+    @classmethod
+    async def init_background(cls,
+                              remote_collection: AsyncIOMotorCollection,
+                              oplog=None,
+                              partitions: int=None,
+                              batch_size: int=None,
+                              on_progress: Callable[[int, int], Any]=None,
+                              projection: Dict[str, Any]=None,
+                              storage: MutableMapping=None):
+        """
+        Same as `init_async`, but returns before loading the documents, which
+        are loaded in background while operations are handled. Until `ready`,
+        `get` fetches documents which weren't loaded yet from the remote
+        collection.
+        """
+        cls.check_projection(projection)
+        last_timestamp = None
+        if oplog is not None:
+            last_timestamp = await newest_timestamp(oplog)
+
+        if storage is None:
+            storage = {}
+        replica = cls(storage, remote_collection, projection)
+        replica.last_timestamp = last_timestamp
+        replica._load_in_background(partitions, batch_size, on_progress)
+        return replica
+
+    def _load_in_background(self,
+                            partitions: Optional[int],
+                            batch_size: Optional[int],
+                            on_progress: Optional[Callable[[int, int], Any]],
+                            query: Dict[str, Any]=None):
+        self.sync = BackgroundSync(self.collection,
+                                   self.remote_collection,
+                                   partitions=partitions,
+                                   batch_size=batch_size,
+                                   on_progress=on_progress,
+                                   projection=self.projection and
+                                   self.projection.spec,
+                                   query=query)
+        self.sync.ready.add_done_callback(self._reindex)
+        self.sync.start()
+
+    @property
+    def ready(self) -> asyncio.Future:
+        """
+        Resolved once every document of the remote collection is loaded
+        """
+        if self.sync is None:
+            ready = asyncio.get_event_loop().create_future()
+            ready.set_result(None)
+            return ready
+        return self.sync.ready
+
+    @property
+    def percentage(self) -> float:
+        """
+        Percentage of the remote collection documents already loaded
+        """
+        if self.sync is None:
+            return 100.0
+        return self.sync.percentage
+
+    async def get(self, _id: Any) -> Optional[Document]:
+        """
+        :return: The document of `_id`, or None. While loading in background,
+        documents not loaded yet are fetched from the remote collection
+        """
+        doc = self.collection.get(_id)
+        if doc is not None or self.sync is None or not self.sync.loading:
+            return doc
+        return await self.sync.get(_id)
+
+    def create_index(self, path: str, sorted: bool=False) -> Index:
+        """
+        Declares a secondary index on the dotted `path`, kept up to date as
+        operations are applied.
+
+        :param sorted: If True, a `SortedIndex`, which also serves ranges and
+        ordering. A `HashIndex`, for equality lookups, otherwise
+        """
+        index = SortedIndex(path) if sorted else HashIndex(path)
+        index.build(self.collection)
+        self.indexes[path] = index
+        self.queries.invalidate()
+        return index
+
+    def drop_index(self, path: str):
+        del self.indexes[path]
+        self.queries.invalidate()
+
+    def lookup(self, path: str, value: Any) -> List[Document]:
+        """
+        :return: The documents with `value` at the indexed `path`
+        """
+        collection = self.collection
+        return [collection[_id] for _id in self.indexes[path].lookup(value)]
+
+    def lookup_range(self,
+                     path: str,
+                     gt: Any=MISSING,
+                     gte: Any=MISSING,
+                     lt: Any=MISSING,
+                     lte: Any=MISSING,
+                     reverse: bool=False) -> List[Document]:
+        """
+        :return: The documents with a value within the bounds at `path`,
+        which must have a `SortedIndex`, ordered by it
+        """
+        collection = self.collection
+        ids = self.indexes[path].range(gt=gt, gte=gte, lt=lt, lte=lte,
+                                       reverse=reverse)
+        return [collection[_id] for _id in ids]
+
+    def find(self,
+             filter: Dict[str, Any]=None,
+             projection: Dict[str, Any]=None,
+             sort: Sort=None,
+             limit: int=0) -> List[Dict[str, Any]]:
+        """
+        Queries the replica, as `find` queries the remote collection. See
+        `QueryEngine.find`
+        """
+        return self.queries.find(filter, projection, sort, limit)
+
+    def _reindex(self, *args):
+        # documents loaded in background aren't indexed as they're stored
+        for index in self.indexes.values():
+            index.clear()
+            index.build(self.collection)
+
+    def _affected_indexes(self, change: Dict[str, Any]) -> List[Index]:
+        indexes = self.indexes
+        if not indexes:
+            return []
+        if not set(change) <= {'$set', '$unset', '$v'}:
+            return list(indexes.values())
+        paths = [*change.get('$set', ()), *change.get('$unset', ())]
+        return [index for index_path, index in indexes.items()
+                if any(overlaps(path, index_path) for path in paths)]
+
+    def _touch(self, _id: Any):
+        if self.sync is not None and self.sync.loading:
+            self.sync.touch(_id)
+
+    async def handle_batch(self, operations: List[Dict[str, Any]]):
+        if not operations:
+            return
+
+        appliers, handlers = self.appliers, self.handlers
+        for operation in operations:
+            op = operation['op']
+            apply = appliers.get(op)
+            if apply is not None:
+                apply(operation)
+            elif op in handlers:
+                await handlers[op](operation)
+            else:
+                logger.debug({'info': 'skipping operation',
+                              'operation': operation})
+        self.last_timestamp = operations[-1]['ts']
+
+    def apply_update(self, operation: Dict[str, Any]):
+        change = decoded(operation['o'])
+        if self.projection is not None:
+            change = self.projection.restrict(change)
+            if not change:
+                # none of the kept fields changed
+                return None
+        _id = operation['o2']['_id']
+        self._touch(_id)
+        try:
+            doc = self.collection[_id]
+        except KeyError:
+            # replayed operations may affect documents already deleted
+            logger.debug({'info': 'skipping update of unknown document',
+                          'operation': operation})
+            return None
+        indexes = self._affected_indexes(change)
+        for index in indexes:
+            index.remove(_id, doc)
         if '$set' in change:
             doc.update(change['$set'])
         if '$unset' in change:
             for key, _ in change['$unset'].items():
                 doc.pop(key, None)
+        # storage engines keep a copy of the document
+        self.collection[_id] = doc
+        for index in indexes:
+            index.add(_id, doc)
         return doc
 
-    async def on_insert(self, operation: Dict[str, Any]):
-        doc = operation['o']
-        self.collection[doc['_id']] = Document(doc)
+    def apply_insert(self, operation: Dict[str, Any]):
+        doc = decoded(operation['o'])
+        if self.projection is not None:
+            doc = self.projection(doc)
+        _id = doc['_id']
+        self._touch(_id)
+        if self.indexes:
+            previous = self.collection.get(_id)
+            for index in self.indexes.values():
+                if previous is not None:
+                    index.remove(_id, previous)
+                index.add(_id, doc)
+        self.collection[_id] = Document(doc)
         return doc
 
+    def apply_delete(self, operation: Dict[str, Any]):
+        _id = operation['o']['_id']
+        self._touch(_id)
+        doc = self.collection.pop(_id, None)
+        if doc is not None:
+            for index in self.indexes.values():
+                index.remove(_id, doc)
+
+    async def on_update(self, operation: Dict[str, Any]):
+        return self.apply_update(operation)
+
+    async def on_insert(self, operation: Dict[str, Any]):
+        return self.apply_insert(operation)
+
     async def on_delete(self, operation: Dict[str, Any]):
-        doc = operation['o']
-        del self.collection[doc['_id']]
+        self.apply_delete(operation)
+
+
+class ReactivePartialCollection(ReactiveCollection):
+    """
+    A `ReactiveCollection` of the documents of the remote collection which
+    match `query`. Membership is reevaluated on every operation: documents
+    which stop matching are dropped, and documents which start matching are
+    added, fetching them from the remote collection when the oplog entry
+    doesn't have the whole document.
+
+    `query` is evaluated locally, so it may only use the operators supported
+    by `QueryEngine.find`, and the paths it compares are always projected.
+    """
+    def __init__(self,
+                 collection: Dict[ObjectId, Dict],
+                 remote_collection: AsyncIOMotorCollection,
+                 query: Dict[str, Any],
+                 projection: Dict[str, Any]=None):
+        shape, _ = parse(query)
+        query_paths = paths(shape)
+        projection = self.projecting(projection, query_paths)
+        super().__init__(collection, remote_collection, projection)
+        self.query = query
+        self.query_paths = query_paths
+        self.matches = compile_filter(query)
+
+    @staticmethod
+    def projecting(projection: Optional[Dict[str, Any]],
+                   query_paths: Iterable[str]) -> Optional[Dict[str, Any]]:
+        """
+        :return: `projection`, including every path of the query
+        :raises ValueError: If it excludes any of them
+        """
+        if not projection:
+            return projection
+        if Projection(projection).inclusion:
+            return dict(projection, **{path: 1 for path in query_paths})
+        for path in query_paths:
+            if any(overlaps(path, excluded)
+                   for excluded, flag in projection.items() if not flag):
+                raise ValueError(f'Projection excludes the query path {path}')
+        return projection
+
+    @classmethod
+    async def init_async(cls,
+                         remote_collection: AsyncIOMotorCollection,
+                         query: Dict[str, Any],
+                         oplog=None,
+                         partitions: int=None,
+                         batch_size: int=None,
+                         on_progress: Callable[[int, int], Any]=None,
+                         projection: Dict[str, Any]=None,
+                         storage: MutableMapping=None):
+        """
+        Loads the documents of `remote_collection` matching `query`, which
+        is used as the filter of the initial sync queries. See
+        `ReactiveCollection.init_async`
+        """
+        cls.check_projection(projection)
+        last_timestamp = None
+        if oplog is not None:
+            last_timestamp = await newest_timestamp(oplog)
+
+        projection = cls.projecting(projection, paths(parse(query)[0]))
+        collection = await load_collection(remote_collection,
+                                           partitions=partitions,
+                                           batch_size=batch_size,
+                                           on_progress=on_progress,
+                                           collection=storage,
+                                           query=query,
+                                           projection=projection)
+        replica = cls(collection, remote_collection, query, projection)
+        replica.last_timestamp = last_timestamp
+        return replica
+
+    @classmethod
+    async def init_background(cls,
+                              remote_collection: AsyncIOMotorCollection,
+                              query: Dict[str, Any],
+                              oplog=None,
+                              partitions: int=None,
+                              batch_size: int=None,
+                              on_progress: Callable[[int, int], Any]=None,
+                              projection: Dict[str, Any]=None,
+                              storage: MutableMapping=None):
+        """
+        Same as `init_async`, but returns before loading the documents
+        matching `query`, which are loaded in background while operations
+        are handled. See `ReactiveCollection.init_background`
+        """
+        cls.check_projection(projection)
+        last_timestamp = None
+        if oplog is not None:
+            last_timestamp = await newest_timestamp(oplog)
+
+        if storage is None:
+            storage = {}
+        replica = cls(storage, remote_collection, query, projection)
+        replica.last_timestamp = last_timestamp
+        replica._load_in_background(partitions, batch_size, on_progress,
+                                    query=query)
+        return replica
+
+    def _may_match(self, change: Dict[str, Any]) -> bool:
+        """
+        :return: False if `change` doesn't touch any path of `query`, so that
+        it can't make a document start matching it
+        """
+        if not set(change) <= {'$set', '$unset', '$v'}:
+            return True
+        changed = [*change.get('$set', ()), *change.get('$unset', ())]
+        return any(overlaps(path, query_path)
+                   for path in changed for query_path in self.query_paths)
+
+    def _determines(self, change: Dict[str, Any]) -> bool:
+        """
+        :return: True if `change` replaces the values of every path of
+        `query`, so that it's enough to evaluate it
+        """
+        if not set(change) <= {'$set', '$unset', '$v'}:
+            return False
+        changed = [*change.get('$set', ()), *change.get('$unset', ())]
+        return all(any(path == query_path or
+                       query_path.startswith(path + '.')
+                       for path in changed)
+                   for query_path in self.query_paths)
+
+    def _drop(self, operation: Dict[str, Any], _id: Any):
+        super().apply_delete({'op': Operations.DELETE,
+                              'ts': operation['ts'],
+                              'o': {'_id': _id}})
+
+    def _add(self, operation: Dict[str, Any], doc: Dict[str, Any]):
+        super().apply_insert({'op': Operations.INSERT,
+                              'ts': operation['ts'],
+                              'o': doc})
+
+    def apply_insert(self, operation: Dict[str, Any]):
+        doc = decoded(operation['o'])
+        if self.matches(doc):
+            return super().apply_insert(operation)
+        # a version loaded in background may still match
+        self._touch(doc['_id'])
+        # replayed operations may insert documents already in the replica
+        if doc['_id'] in self.collection:
+            self._drop(operation, doc['_id'])
+        return None
+
+    async def on_update(self, operation: Dict[str, Any]):
+        _id = operation['o2']['_id']
+        change = decoded(operation['o'])
+        if not any(key.startswith('$') for key in change):
+            # replacement of the whole document
+            doc = dict(change, _id=_id)
+            if self.matches(doc):
+                self._add(operation, doc)
+                return doc
+            self._touch(_id)
+            if _id in self.collection:
+                self._drop(operation, _id)
+            return None
+
+        if _id in self.collection:
+            doc = self.apply_update(operation)
+            if doc is not None and not self.matches(doc):
+                self._drop(operation, _id)
+                return None
+            return doc
+
+        # a version loaded in background may be older than this operation
+        self._touch(_id)
+        if not self._may_match(change):
+            return None
+        if self._determines(change):
+            changed = Document({})
+            changed.update(change.get('$set', {}))
+            if not self.matches(changed):
+                return None
+
+        doc = await self.remote_collection.find_one(
+            restricted({'_id': _id}, self.query),
+            projection=self.projection and self.projection.spec
+        )
+        if doc is None or _id in self.collection:
+            return None
+        self._add(operation, doc)
+        return doc
@@ -0,0 +1,272 @@
+import asyncio
+import copy
+import mmap
+import re
+import struct
+import time
+from array import array
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+import bson
+from bson import Timestamp
+from bson.codec_options import CodecOptions, DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+from pymongo import CursorType, DESCENDING
+
+from mongo_observer import conf
+
+
+DOCUMENT_SIZE = struct.Struct('<i')
+TAILABLE_CURSOR_TYPES = (CursorType.TAILABLE, CursorType.TAILABLE_AWAIT)
+RegexType = type(re.compile(''))
+
+
+def matches(entry, filter: Dict[str, Any]) -> bool:
+    """
+    Evaluates the oplog queries built by `Observer`: equality, compiled
+    regexes and the `$in`, `$gt`, `$gte`, `$lt` and `$lte` operators on top
+    level fields
+    """
+    for field, condition in filter.items():
+        value = entry.get(field)
+        if isinstance(condition, dict):
+            for operator, operand in condition.items():
+                if not _evaluate(operator, value, operand):
+                    return False
+        elif isinstance(condition, RegexType):
+            if not isinstance(value, str) or not condition.search(value):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _evaluate(operator: str, value, operand) -> bool:
+    if operator == '$in':
+        return value in operand
+    if value is None:
+        return False
+    if operator == '$gt':
+        return value > operand
+    if operator == '$gte':
+        return value >= operand
+    if operator == '$lt':
+        return value < operand
+    if operator == '$lte':
+        return value <= operand
+    raise ValueError(f'Unsupported query operator: {operator}')
+
+
+class OplogDump:
+    """
+    Read only oplog collection backed by a `mongodump` of `local.oplog.rs`
+    (a `.bson` file), which may be observed by an `Observer` without a
+    server.
+
+    The dump is memory mapped and its entries are read from the mapping as
+    they are fetched. Entries must be in `ts` order, as they are dumped, so
+    that cursors binary search their starting `ts`, as `oplog_replay` does.
+    """
+    def __init__(self,
+                 path: str,
+                 speed: float=None,
+                 codec_options: CodecOptions=DEFAULT_CODEC_OPTIONS):
+        """
+        :param path: `.bson` dump of the oplog
+        :param speed: If given, entries are fetched at the pace of their
+        original timestamps, multiplied by `speed`. Otherwise, as fast as
+        possible
+        :param codec_options: Codec options of the fetched entries. With
+        `RawBSONDocument` as `document_class`, entries are views of the
+        mapped dump
+        """
+        self.path = path
+        self.speed = speed
+        self.codec_options = codec_options
+        self.mm: mmap.mmap = None
+        self.offsets = array('Q')
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                return
+
+        offset, size = 0, len(self.mm)
+        while offset < size:
+            self.offsets.append(offset)
+            document_size, = DOCUMENT_SIZE.unpack_from(self.mm, offset)
+            if document_size < 5 or offset + document_size > size:
+                raise ValueError(f'{self.path} has a truncated document at '
+                                 f'offset {offset}')
+            offset += document_size
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def with_options(self, codec_options: CodecOptions=None, **kwargs):
+        dump = copy.copy(self)
+        dump.codec_options = codec_options or self.codec_options
+        return dump
+
+    def raw_entry(self, index: int) -> RawBSONDocument:
+        offset = self.offsets[index]
+        document_size, = DOCUMENT_SIZE.unpack_from(self.mm, offset)
+        return RawBSONDocument(memoryview(self.mm)[offset:offset + document_size])
+
+    def entry(self, index: int):
+        return self.decode(self.raw_entry(index))
+
+    def decode(self, raw: RawBSONDocument):
+        if self.codec_options.document_class is RawBSONDocument:
+            return raw
+        return bson.decode(raw.raw, self.codec_options)
+
+    def bisect(self, timestamp: Timestamp, inclusive: bool=False) -> int:
+        """
+        :return: The index of the first entry whose `ts` is greater than
+        (or equal to, if `inclusive`) `timestamp`
+        """
+        low, high = 0, len(self.offsets)
+        while low < high:
+            middle = (low + high) // 2
+            ts = self.raw_entry(middle)['ts']
+            if ts < timestamp or (ts == timestamp and not inclusive):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self,
+             filter: Dict[str, Any]=None,
+             projection: Dict[str, Any]=None,
+             cursor_type: CursorType=CursorType.NON_TAILABLE,
+             batch_size: int=None,
+             **kwargs) -> 'OplogDumpCursor':
+        """
+        Same signature as a motor collection `find`. Entries are returned
+        whole, regardless of `projection`
+        """
+        return OplogDumpCursor(self,
+                               filter or {},
+                               tailable=cursor_type in TAILABLE_CURSOR_TYPES,
+                               batch_size=batch_size or conf.OPLOG_DUMP_BATCH_SIZE)
+
+    async def find_one(self,
+                       filter: Dict[str, Any]=None,
+                       projection: Dict[str, Any]=None,
+                       sort: List=None,
+                       **kwargs) -> Optional[Dict[str, Any]]:
+        indexes = range(len(self.offsets))
+        if sort and sort[0] == ('$natural', DESCENDING):
+            indexes = reversed(indexes)
+        for index in indexes:
+            if matches(self.raw_entry(index), filter or {}):
+                return self.entry(index)
+        return None
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+
+
+class OplogDumpCursor:
+    """
+    Cursor over the entries of an `OplogDump` matching `filter`, with the
+    subset of the motor cursor interface used by `Observer`.
+
+    A tailable cursor stays alive once the dump is exhausted, fetching
+    nothing, so the observer awaits its `on_nothing_to_fetch_on_cursor`,
+    which may raise `ShouldStopObservation` to end the replay.
+    """
+    def __init__(self,
+                 dump: OplogDump,
+                 filter: Dict[str, Any],
+                 tailable: bool,
+                 batch_size: int):
+        self.dump = dump
+        self.filter = filter
+        self.tailable = tailable
+        self.batch_size = batch_size
+        self.alive = True
+        self.buffer = deque()
+        self.position = self._starting_position()
+        # (wall clock, oplog time) of the first fetched entry, when paced
+        self.origin = None
+
+    def _starting_position(self) -> int:
+        ts = self.filter.get('ts')
+        if not isinstance(ts, dict):
+            return 0
+        if '$gt' in ts:
+            return self.dump.bisect(ts['$gt'])
+        if '$gte' in ts:
+            return self.dump.bisect(ts['$gte'], inclusive=True)
+        return 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._buffer_size() or await self.fetch_next:
+            return self.next_object()
+        raise StopAsyncIteration
+
+    @property
+    def fetch_next(self):
+        return self._get_more()
+
+    async def _get_more(self) -> bool:
+        if self.buffer:
+            return True
+        if not self.alive:
+            return False
+
+        dump, filter, buffer = self.dump, self.filter, self.buffer
+        end = len(dump)
+        while self.position < end and len(buffer) < self.batch_size:
+            raw = dump.raw_entry(self.position)
+            if matches(raw, filter):
+                if dump.speed and not await self._wait_for(raw['ts'], buffer):
+                    break
+                buffer.append(dump.decode(raw))
+            self.position += 1
+
+        if self.position == end and not self.tailable:
+            self.alive = False
+        # replaying as fast as possible must not starve the event loop
+        await asyncio.sleep(0)
+        return bool(buffer)
+
+    async def _wait_for(self, ts: Timestamp, buffer: deque) -> bool:
+        """
+        Waits until `ts` is due, unless there's a batch to be returned.
+
+        :return: True if `ts` is due
+        """
+        if self.origin is None:
+            self.origin = (time.monotonic(), ts.time)
+        wall, oplog_time = self.origin
+        delay = wall + (ts.time - oplog_time) / self.dump.speed - time.monotonic()
+        if delay <= 0:
+            return True
+        if buffer:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    def next_object(self):
+        if not self.buffer:
+            return None
+        return self.buffer.popleft()
+
+    def _buffer_size(self) -> int:
+        return len(self.buffer)
+
+    async def close(self):
+        self.alive = False
+        self.buffer.clear()
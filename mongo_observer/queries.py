@@ -0,0 +1,581 @@
+import itertools
+from collections import OrderedDict, UserList
+from typing import Dict, Any, List, Tuple, Callable, Iterable, Optional, \
+    Mapping, Union, Set
+
+from bson import Regex
+
+from mongo_observer import conf
+from mongo_observer.indexes import Index, HashIndex, SortedIndex, \
+    PrimaryIndex, index_key, RegexType
+from mongo_observer.models import path_values
+
+
+LOGICAL_OPERATORS = {'$and', '$or', '$nor'}
+EQUALITY_OPERATORS = {'$eq', '$ne'}
+MEMBERSHIP_OPERATORS = {'$in', '$nin'}
+RANGE_OPERATORS = {'$gt': 'gt', '$gte': 'gte', '$lt': 'lt', '$lte': 'lte'}
+NULL_KEY = index_key(None)
+
+Shape = Tuple
+Test = Callable[[Mapping[str, Any]], bool]
+# binds the constants of a filter to the compiled closures of its shape
+Binder = Callable[[List[Any]], Callable]
+
+
+def _is_operators(condition: Any) -> bool:
+    return (isinstance(condition, Mapping) and bool(condition) and
+            all(key.startswith('$') for key in condition))
+
+
+def _kind(value: Any) -> str:
+    if isinstance(value, (Regex, RegexType)):
+        return 'regex'
+    if isinstance(value, (list, UserList)):
+        return 'array'
+    return 'value'
+
+
+def parse(filter: Mapping[str, Any]) -> Tuple[Shape, List[Any]]:
+    """
+    Splits `filter` into its shape, made of its paths and operators, and
+    the constants it compares them to, in the order they appear on it.
+    Filters of the same shape share their query plan.
+
+    :raises ValueError: On unsupported operators
+    """
+    params = []
+    return _parse_filter(filter, params), params
+
+
+def _parse_filter(filter: Mapping[str, Any], params: List[Any]) -> Shape:
+    entries = []
+    for key, condition in filter.items():
+        if key in LOGICAL_OPERATORS:
+            if not isinstance(condition, (list, tuple)) or not condition:
+                raise ValueError(f'{key} must be a nonempty list')
+            entries.append((key, tuple(_parse_filter(item, params)
+                                       for item in condition)))
+        elif key.startswith('$'):
+            raise ValueError(f'Unsupported query operator: {key}')
+        elif _is_operators(condition):
+            entries.append(('field', key, tuple(
+                _parse_condition(operator, operand, params)
+                for operator, operand in condition.items()
+            )))
+        else:
+            entries.append(('field', key,
+                            (_parse_condition('$eq', condition, params),)))
+    return ('$and', tuple(entries))
+
+
+def _parse_condition(operator: str, operand: Any, params: List[Any]) -> Shape:
+    if operator in EQUALITY_OPERATORS:
+        params.append(operand)
+        return (operator, _kind(operand))
+    if operator in MEMBERSHIP_OPERATORS:
+        if not isinstance(operand, (list, tuple, UserList)):
+            raise ValueError(f'{operator} needs an array')
+        params.append(operand)
+        return (operator,)
+    if operator in RANGE_OPERATORS:
+        params.append(operand)
+        return (operator, _kind(operand))
+    if operator == '$exists':
+        params.append(bool(operand))
+        return (operator,)
+    raise ValueError(f'Unsupported query operator: {operator}')
+
+
+def paths(shape: Shape) -> Set[str]:
+    """
+    :return: Every path compared by a filter of `shape`
+    """
+    found = set()
+    for entry in shape[1]:
+        if entry[0] == 'field':
+            found.add(entry[1])
+        else:
+            for filter in entry[1]:
+                found.update(paths(filter))
+    return found
+
+
+def _count(entry: Shape) -> int:
+    """
+    :return: The number of constants of a filter `entry`
+    """
+    if entry[0] == 'field':
+        return len(entry[2])
+    return sum(_count(item) for _, entries in entry[1] for item in entries)
+
+
+def _compile_filter(shape: Shape, positions: Iterable[int]) -> Binder:
+    _, entries = shape
+    binders = [_compile_entry(entry, positions) for entry in entries]
+
+    def bind(params: List[Any]) -> Test:
+        tests = [binder(params) for binder in binders]
+        if len(tests) == 1:
+            return tests[0]
+        return lambda doc: all(test(doc) for test in tests)
+    return bind
+
+
+def _compile_entry(entry: Shape, positions: Iterable[int]) -> Binder:
+    if entry[0] == 'field':
+        return _compile_field(entry, positions)
+
+    operator, filters = entry
+    binders = [_compile_filter(shape, positions) for shape in filters]
+
+    def bind(params: List[Any]) -> Test:
+        tests = [binder(params) for binder in binders]
+        if operator == '$and':
+            return lambda doc: all(test(doc) for test in tests)
+        if operator == '$or':
+            return lambda doc: any(test(doc) for test in tests)
+        return lambda doc: not any(test(doc) for test in tests)
+    return bind
+
+
+def _compile_field(entry: Shape, positions: Iterable[int]) -> Binder:
+    _, path, conditions = entry
+    binders = [_compile_condition(condition, next(positions))
+               for condition in conditions]
+
+    def bind(params: List[Any]) -> Test:
+        tests = [binder(params) for binder in binders]
+
+        def test(doc: Mapping[str, Any]) -> bool:
+            keys = [index_key(value) for value in path_values(doc, path)]
+            return all(test(keys) for test in tests)
+        return test
+    return bind
+
+
+def _equals(operand: Any) -> Callable[[List[Tuple]], bool]:
+    if isinstance(operand, (Regex, RegexType)):
+        pattern = operand if isinstance(operand, RegexType) else \
+            operand.try_compile()
+        return lambda keys: any(key[0] == 3 and pattern.search(key[1])
+                                for key in keys)
+    expected = index_key(operand)
+    if expected == NULL_KEY:
+        # null also matches missing fields
+        return lambda keys: not keys or expected in keys
+    return lambda keys: expected in keys
+
+
+def _member(operands: Iterable[Any]) -> Callable[[List[Tuple]], bool]:
+    tests = [_equals(operand) for operand in operands
+             if isinstance(operand, (Regex, RegexType))]
+    expected = {index_key(operand) for operand in operands
+                if not isinstance(operand, (Regex, RegexType))}
+    if NULL_KEY in expected:
+        tests.append(lambda keys: not keys)
+    return lambda keys: (any(key in expected for key in keys) or
+                         any(test(keys) for test in tests))
+
+
+def _compile_condition(condition: Shape, position: int) -> Binder:
+    operator = condition[0]
+
+    def bind(params: List[Any]) -> Callable[[List[Tuple]], bool]:
+        operand = params[position]
+        if operator == '$eq':
+            return _equals(operand)
+        if operator == '$ne':
+            equals = _equals(operand)
+            return lambda keys: not equals(keys)
+        if operator == '$in':
+            return _member(operand)
+        if operator == '$nin':
+            member = _member(operand)
+            return lambda keys: not member(keys)
+        if operator == '$exists':
+            return lambda keys: bool(keys) == operand
+
+        bound = index_key(operand)
+        rank = bound[0]
+        if operator == '$gt':
+            return lambda keys: any(key[0] == rank and key > bound
+                                    for key in keys)
+        if operator == '$gte':
+            return lambda keys: any(key[0] == rank and key >= bound
+                                    for key in keys)
+        if operator == '$lt':
+            return lambda keys: any(key[0] == rank and key < bound
+                                    for key in keys)
+        return lambda keys: any(key[0] == rank and key <= bound
+                                for key in keys)
+    return bind
+
+
+def compile_filter(filter: Mapping[str, Any]) -> Test:
+    """
+    :return: A predicate of the documents matching `filter`
+    """
+    shape, params = parse(filter)
+    return _compile_filter(shape, itertools.count())(params)
+
+
+class Projection:
+    """
+    An inclusion or an exclusion projection on dotted paths, which includes
+    `_id` unless it's excluded. Calling it projects a document into a new
+    dict.
+    """
+    def __init__(self, projection: Mapping[str, Any]):
+        # as sent to the server
+        self.spec = dict(projection)
+        projection = dict(projection)
+        self.include_id = bool(projection.pop('_id', True))
+        flags = {bool(flag) for flag in projection.values()}
+        if len(flags) > 1:
+            raise ValueError('Projections either include or exclude fields')
+        # including only `_id` excludes every other field
+        self.inclusion = flags == {True} or (not flags and self.include_id and
+                                             '_id' in self.spec)
+        self.paths = list(projection)
+
+        self.tree = {}
+        for path in projection:
+            node = self.tree
+            *parents, last = path.split('.')
+            for part in parents:
+                node = node.setdefault(part, {})
+                if node is True:
+                    break
+            else:
+                node[last] = True
+        if not self.inclusion and not self.include_id:
+            self.tree['_id'] = True
+
+    def __call__(self, doc: Mapping[str, Any]) -> Dict[str, Any]:
+        if not self.inclusion:
+            return _exclude(doc, self.tree)
+        projected = _include(doc, self.tree)
+        if self.include_id and '_id' in doc:
+            projected['_id'] = doc['_id']
+        return projected
+
+    def _node(self, path: str):
+        """
+        :return: True if `path` is projected as a whole, its projected subtree
+        if some of its descendants are, or None if none of them is. Array
+        positions are disregarded
+        """
+        node = self.tree
+        for part in path.split('.'):
+            if node is True:
+                return True
+            if not part.isdigit():
+                node = node.get(part)
+                if node is None:
+                    return None
+        return node
+
+    def restrict(self, change: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        :param change: The `o` of an update oplog entry
+        :return: `change` restricted to the projected paths, with the values
+        set on their ancestors projected. Empty if it doesn't change any of
+        them
+        """
+        if not any(key.startswith('$') for key in change):
+            # replacement of the whole document
+            return self(change)
+        if not set(change) <= {'$set', '$unset', '$v'}:
+            return change
+
+        restricted = {'$set': {}, '$unset': {}}
+        for operator in ('$set', '$unset'):
+            for path, value in change.get(operator, {}).items():
+                node = self._node(path)
+                if self.inclusion:
+                    if node is None:
+                        continue
+                    if node is not True and operator == '$set':
+                        if not isinstance(value, (Mapping, list, UserList)):
+                            # only documents have projected descendants
+                            restricted['$unset'][path] = 1
+                            continue
+                        value = _project_value(value, node, _include)
+                elif node is True:
+                    continue
+                elif node is not None and operator == '$set':
+                    value = _project_value(value, node, _exclude)
+                restricted[operator][path] = value
+        return {operator: fields for operator, fields in restricted.items()
+                if fields}
+
+
+def _project_value(value: Any, node: Dict[str, Any], project: Callable) -> Any:
+    if isinstance(value, Mapping):
+        return project(value, node)
+    if isinstance(value, (list, UserList)):
+        return [project(item, node) if isinstance(item, Mapping) else item
+                for item in value
+                if isinstance(item, Mapping) or project is _exclude]
+    return value
+
+
+def compile_projection(projection: Mapping[str, Any]) -> Projection:
+    """
+    :return: A function of a document into a new projected dict
+    """
+    return Projection(projection)
+
+
+def _include(value: Mapping[str, Any], tree: Dict[str, Any]) -> Dict[str, Any]:
+    projected = {}
+    for key, node in tree.items():
+        if key not in value:
+            continue
+        item = value[key]
+        if node is True:
+            projected[key] = item
+        elif isinstance(item, Mapping):
+            projected[key] = _include(item, node)
+        elif isinstance(item, (list, UserList)):
+            projected[key] = [_include(element, node) for element in item
+                              if isinstance(element, Mapping)]
+    return projected
+
+
+def _exclude(value: Mapping[str, Any], tree: Dict[str, Any]) -> Dict[str, Any]:
+    projected = {}
+    for key, item in value.items():
+        node = tree.get(key)
+        if node is True:
+            continue
+        if node is None:
+            projected[key] = item
+        elif isinstance(item, Mapping):
+            projected[key] = _exclude(item, node)
+        elif isinstance(item, (list, UserList)):
+            projected[key] = [_exclude(element, node)
+                              if isinstance(element, Mapping) else element
+                              for element in item]
+        else:
+            projected[key] = item
+    return projected
+
+
+def sort_key(path: str, descending: bool) -> Callable[[Mapping], Tuple]:
+    """
+    :return: The key of documents sorted by `path`, as sorted by mongo:
+    arrays by their lowest item, or by their highest one if `descending`,
+    and missing values as null
+    """
+    pick = max if descending else min
+
+    def key(doc: Mapping[str, Any]) -> Tuple:
+        keys = [index_key(value) for value in path_values(doc, path)
+                if not isinstance(value, (list, UserList))]
+        return pick(keys) if keys else NULL_KEY
+    return key
+
+
+Sort = Union[List[Tuple[str, int]], Mapping[str, int]]
+
+
+class QueryPlan:
+    """
+    How filters of a shape are evaluated: a `Binder` of their constants to
+    a predicate, and the index, if any, that narrows the documents it's
+    evaluated on, or which yields them already sorted
+    """
+    def __init__(self,
+                 bind: Binder,
+                 index: Index=None,
+                 conditions: Tuple[Tuple[str, int], ...]=(),
+                 ordered: bool=False,
+                 reverse: bool=False):
+        """
+        :param conditions: The operators used to look `index` up, and the
+        position of their constants
+        :param ordered: If True, documents are yielded in the requested
+        order by iterating `index`
+        """
+        self.bind = bind
+        self.index = index
+        self.conditions = conditions
+        self.ordered = ordered
+        self.reverse = reverse
+
+    def candidates(self, params: List[Any]) -> Optional[Iterable[Any]]:
+        """
+        :return: The `_id`s of the documents that may match, or None if every
+        one of them may
+        """
+        index = self.index
+        if index is None:
+            return None
+        if self.ordered:
+            return index.ordered(self.reverse)
+
+        operator, position = self.conditions[0]
+        if operator == '$eq':
+            return index.lookup(params[position])
+        if operator == '$in':
+            values = params[position]
+            if any(_kind(value) == 'regex' or
+                   (_kind(value) == 'array' and isinstance(index, SortedIndex))
+                   for value in values):
+                return None
+            ids = {}
+            for value in values:
+                ids.update(dict.fromkeys(index.lookup(value)))
+            return ids
+
+        bounds = {RANGE_OPERATORS[operator]: params[position]
+                  for operator, position in self.conditions}
+        return index.range(**bounds)
+
+
+class QueryEngine:
+    """
+    Runs mongo `find` queries against the documents of a replica, using its
+    secondary `indexes`, and looking `_id`s up on the replica itself. Query
+    plans are cached by the shape of the filter and the sort, until the
+    indexes change.
+    """
+    def __init__(self,
+                 collection: Dict[Any, Mapping[str, Any]],
+                 indexes: Dict[str, Index],
+                 cache_size: int=None):
+        """
+        :param cache_size: Maximum number of cached query plans, and of
+        cached projections. Defaults to `conf.QUERY_PLAN_CACHE_SIZE`
+        """
+        self.collection = collection
+        self.indexes = indexes
+        self.primary = PrimaryIndex(collection)
+        self.cache_size = cache_size or conf.QUERY_PLAN_CACHE_SIZE
+        self.plans: Dict[Tuple, QueryPlan] = OrderedDict()
+        self.projections: Dict[Tuple, Projection] = OrderedDict()
+
+    def invalidate(self):
+        """
+        Drops the cached query plans, which hold the indexes they look up.
+        Must be called whenever `indexes` changes
+        """
+        self.plans.clear()
+
+    def plan(self, shape: Shape, sort: List[Tuple[str, int]]) -> QueryPlan:
+        key = (shape, tuple(sort))
+        plans = self.plans
+        plan = plans.get(key)
+        if plan is not None:
+            plans.move_to_end(key)
+            return plan
+
+        plan = plans[key] = self._plan(shape, sort)
+        if len(plans) > self.cache_size:
+            plans.popitem(last=False)
+        return plan
+
+    def _plan(self, shape: Shape, sort: List[Tuple[str, int]]) -> QueryPlan:
+        bind = _compile_filter(shape, itertools.count())
+        candidates = []
+        start = 0
+        for entry in shape[1]:
+            # positions of the constants of `entry`
+            positions = range(start, start + _count(entry))
+            start = positions.stop
+            if entry[0] != 'field':
+                continue
+            _, path, conditions = entry
+            index = self.indexes.get(path)
+            if index is None and path == '_id':
+                index = self.primary
+            equality, ranges = None, []
+            for position, condition in zip(positions, conditions):
+                operator = condition[0]
+                if operator == '$in' or (operator == '$eq' and
+                                         condition[1] == 'value'):
+                    equality = ((operator, position),)
+                elif operator in RANGE_OPERATORS and condition[1] == 'value':
+                    ranges.append((operator, position))
+            if index is None:
+                continue
+            if equality is not None:
+                # `_id` lookups first, then hash indexes
+                if isinstance(index, PrimaryIndex):
+                    priority = -1
+                else:
+                    priority = 0 if isinstance(index, HashIndex) else 1
+                candidates.append((priority, index, equality))
+            elif ranges and isinstance(index, SortedIndex):
+                candidates.append((2, index, tuple(ranges)))
+
+        if candidates:
+            _, index, conditions = min(candidates, key=lambda c: c[0])
+            return QueryPlan(bind, index, conditions)
+        if len(sort) == 1:
+            path, direction = sort[0]
+            index = self.indexes.get(path)
+            if isinstance(index, SortedIndex):
+                return QueryPlan(bind, index, ordered=True,
+                                 reverse=direction < 0)
+        return QueryPlan(bind)
+
+    def find(self,
+             filter: Mapping[str, Any]=None,
+             projection: Mapping[str, Any]=None,
+             sort: Sort=None,
+             limit: int=0) -> List[Mapping[str, Any]]:
+        """
+        :param filter: A mongo query filter. Supports the `$eq`, `$ne`, `$in`,
+        `$nin`, `$gt`, `$gte`, `$lt`, `$lte` and `$exists` operators on
+        dotted paths, which may traverse arrays, and `$and`, `$or` and `$nor`
+        :param projection: An inclusion or exclusion projection
+        :param sort: A list of (path, direction) pairs, or a dict
+        :param limit: Maximum number of documents. 0 means no limit
+        :return: The matching documents. Projected ones are new dicts,
+        while the others are the replica's own documents
+        """
+        shape, params = parse(filter or {})
+        if isinstance(sort, Mapping):
+            sort = list(sort.items())
+        sort = [(path, direction) for path, direction in (sort or ())]
+        plan = self.plan(shape, sort)
+        test = plan.bind(params)
+
+        collection = self.collection
+        ids = plan.candidates(params)
+        if ids is None:
+            docs = collection.values()
+        else:
+            docs = (doc for doc in map(collection.get, ids) if doc is not None)
+        matching = (doc for doc in docs if test(doc))
+
+        if sort and not plan.ordered:
+            matching = list(matching)
+            # stable sorts, from the least significant path
+            for path, direction in reversed(sort):
+                matching.sort(key=sort_key(path, direction < 0),
+                              reverse=direction < 0)
+        if limit:
+            matching = itertools.islice(matching, limit)
+        results = list(matching)
+
+        if projection:
+            project = self._projection(projection)
+            results = [project(doc) for doc in results]
+        return results
+
+    def _projection(self, projection: Mapping[str, Any]) -> Projection:
+        key = tuple(projection.items())
+        projections = self.projections
+        project = projections.get(key)
+        if project is not None:
+            projections.move_to_end(key)
+            return project
+
+        project = projections[key] = compile_projection(projection)
+        if len(projections) > self.cache_size:
+            projections.popitem(last=False)
+        return project
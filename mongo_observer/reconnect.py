@@ -0,0 +1,68 @@
+import asyncio
+import math
+import random
+
+from mongo_observer import conf
+
+
+class ReconnectScheduler:
+    """
+    Schedules cursor reconnections with exponential backoff and jitter.
+
+    Each consecutive attempt doubles (by `factor`) the delay, up to
+    `max_delay`. The actual delay is randomly picked between half and the
+    whole of it, so that many observers don't reconnect in lockstep.
+    """
+    def __init__(self,
+                 base_delay: float=None,
+                 max_delay: float=None,
+                 factor: float=None):
+        """
+        :param base_delay: Delay before the first attempt. Defaults to
+        `conf.SLEEP_TIME_BEFORE_GET_NEW_CURSOR_IN_SECONDS`
+        :param max_delay: Maximum delay between attempts. Defaults to
+        `conf.RECONNECT_MAX_DELAY_IN_SECONDS`
+        :param factor: Multiplier applied to the delay on each consecutive
+        attempt. Defaults to `conf.RECONNECT_BACKOFF_FACTOR`
+        """
+        if base_delay is None:
+            base_delay = conf.SLEEP_TIME_BEFORE_GET_NEW_CURSOR_IN_SECONDS
+        if max_delay is None:
+            max_delay = conf.RECONNECT_MAX_DELAY_IN_SECONDS
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor or conf.RECONNECT_BACKOFF_FACTOR
+
+        # consecutive attempts since the last successful fetch
+        self.attempts = 0
+        # every attempt since the scheduler was created
+        self.reconnects = 0
+
+    def _max_exponent(self) -> int:
+        """
+        :return: The number of attempts after which the delay reaches
+        `max_delay`
+        """
+        if self.factor <= 1:
+            return self.attempts
+        if self.base_delay <= 0 or self.max_delay <= self.base_delay:
+            return 0
+        return math.ceil(math.log(self.max_delay / self.base_delay,
+                                  self.factor))
+
+    def next_delay(self) -> float:
+        # the exponent stops growing at `max_delay`, so that long outages
+        # don't overflow it
+        exponent = min(self.attempts, self._max_exponent())
+        delay = min(self.max_delay,
+                    self.base_delay * self.factor ** exponent)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def wait(self):
+        delay = self.next_delay()
+        self.attempts += 1
+        self.reconnects += 1
+        await asyncio.sleep(delay)
+
+    def reset(self):
+        self.attempts = 0
@@ -0,0 +1,253 @@
+import asyncio
+import multiprocessing
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Callable, Iterable, Set
+
+import bson
+
+from mongo_observer import conf
+from mongo_observer.conf import logger
+from mongo_observer.models import document_id
+from mongo_observer.operation_handlers import OperationHandler
+
+
+def partition_of(key: Any, partitions: int) -> int:
+    """
+    :return: The partition of a document `_id`, stable across processes and
+    restarts
+    """
+    return zlib.crc32(bson.encode({'_id': key})) % partitions
+
+
+class ShardedOperationHandler(OperationHandler):
+    """
+    Handles operations on `processes` worker processes, each one with its own
+    handler instance, created by `handler_factory`. Operations are
+    partitioned by `partition_of` their document `_id`, so that each worker
+    always handles the same documents, in oplog order.
+
+    Batches are sent BSON encoded through pipes and acknowledged by workers.
+    `last_timestamp` only advances up to the newest batch acknowledged by
+    every worker it was partitioned to, which is the minimum of the workers'
+    progress.
+    """
+    def __init__(self,
+                 handler_factory: Callable,
+                 processes: int=None,
+                 max_pending_batches: int=None,
+                 operation_types: Set[str]=None,
+                 oplog_fields: Iterable[str]=None,
+                 mp_context: str='spawn'):
+        """
+        :param handler_factory: Picklable callable, or coroutine function,
+        returning the `OperationHandler` of a worker process. It's called
+        on the worker process, with its partition index and the number
+        of partitions
+        :param processes: Number of worker processes. Defaults to
+        `conf.SHARDED_HANDLER_PROCESSES`
+        :param max_pending_batches: Maximum number of batches sent and not yet
+        acknowledged. Defaults to `conf.SHARDED_HANDLER_MAX_PENDING_BATCHES`
+        :param operation_types: `op` types handled by the worker handlers. None
+        means every type
+        :param oplog_fields: Top level oplog fields required by the worker
+        handlers. None means every field
+        :param mp_context: `multiprocessing` start method
+        """
+        super().__init__()
+        self.handler_factory = handler_factory
+        self.processes = processes or conf.SHARDED_HANDLER_PROCESSES
+        self.max_pending_batches = (max_pending_batches or
+                                    conf.SHARDED_HANDLER_MAX_PENDING_BATCHES)
+        self._operation_types = operation_types
+        self.oplog_fields = oplog_fields
+        self.mp_context = multiprocessing.get_context(mp_context)
+
+        self.workers: List[multiprocessing.Process] = []
+        self.connections = []
+        self.senders: List[ThreadPoolExecutor] = []
+        self.pending: asyncio.Semaphore = None
+        self.drained: asyncio.Event = None
+        # [timestamp, number of workers yet to acknowledge] of pending batches
+        self.in_flight = deque()
+        self.batches: Dict[int, list] = {}
+        self.sequence = 0
+        self.error: Exception = None
+
+    @property
+    def operation_types(self) -> Set[str]:
+        return self._operation_types
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.pending = asyncio.Semaphore(self.max_pending_batches)
+        self.drained = asyncio.Event()
+        for index in range(self.processes):
+            parent_conn, child_conn = self.mp_context.Pipe()
+            worker = self.mp_context.Process(
+                target=_serve,
+                args=(child_conn, self.handler_factory, index, self.processes),
+                daemon=True
+            )
+            worker.start()
+            child_conn.close()
+            self.workers.append(worker)
+            self.connections.append(parent_conn)
+            self.senders.append(ThreadPoolExecutor(max_workers=1))
+            loop.add_reader(parent_conn.fileno(), self._on_ack, parent_conn)
+
+    async def handle(self, operation: Dict[str, Any]):
+        await self.handle_batch([operation])
+
+    async def handle_batch(self, operations: List[Dict[str, Any]]):
+        await self.check()
+        if not operations:
+            return
+        if not self.workers:
+            self.start()
+
+        partitions = [[] for _ in range(self.processes)]
+        for operation in operations:
+            key = document_id(operation)
+            index = 0 if key is None else partition_of(key, self.processes)
+            partitions[index].append(operation)
+
+        await self.pending.acquire()
+        if self.error:
+            self.pending.release()
+            raise self.error
+
+        self.sequence += 1
+        self.drained.clear()
+        entry = [operations[-1]['ts'], 0]
+        self.in_flight.append(entry)
+        self.batches[self.sequence] = entry
+
+        loop = asyncio.get_event_loop()
+        for connection, sender, partition in zip(self.connections,
+                                                 self.senders,
+                                                 partitions):
+            if partition:
+                entry[1] += 1
+                message = bson.encode({'seq': self.sequence,
+                                       'operations': partition})
+                await loop.run_in_executor(sender,
+                                           connection.send_bytes,
+                                           message)
+
+    def _on_ack(self, connection):
+        try:
+            ack = bson.decode(connection.recv_bytes())
+        except EOFError:
+            asyncio.get_event_loop().remove_reader(connection.fileno())
+            self.error = self.error or ChildProcessError('worker exited')
+            self.pending.release()
+            self.drained.set()
+            return
+
+        if 'error' in ack:
+            logger.error({'info': 'worker failed to handle operations',
+                          'error': ack['error']})
+            self.error = ChildProcessError(ack['error'])
+            self.pending.release()
+            self.drained.set()
+            return
+
+        entry = self.batches[ack['seq']]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.batches[ack['seq']]
+            self.pending.release()
+            in_flight = self.in_flight
+            while in_flight and in_flight[0][1] == 0:
+                self.last_timestamp = in_flight.popleft()[0]
+            if not self.batches:
+                self.drained.set()
+
+    async def check(self):
+        if self.error:
+            raise self.error
+
+    async def join(self):
+        """
+        Waits until every batch already sent is acknowledged
+        """
+        if self.batches:
+            await self.drained.wait()
+        if self.error:
+            raise self.error
+
+    async def stop(self):
+        """
+        Stops the worker processes, terminating the ones which don't exit
+        within `conf.SHARDED_HANDLER_STOP_TIMEOUT_IN_SECONDS`. Blocking calls
+        run on executors, so that the event loop keeps running meanwhile
+        """
+        loop = asyncio.get_event_loop()
+        for connection, sender in zip(self.connections, self.senders):
+            loop.remove_reader(connection.fileno())
+            # waits for the batches being sent
+            await loop.run_in_executor(None, sender.shutdown)
+            try:
+                await loop.run_in_executor(None,
+                                           connection.send_bytes,
+                                           bson.encode({'stop': True}))
+            except (BrokenPipeError, OSError):
+                pass
+            connection.close()
+        await asyncio.gather(*(
+            loop.run_in_executor(None,
+                                 worker.join,
+                                 conf.SHARDED_HANDLER_STOP_TIMEOUT_IN_SECONDS)
+            for worker in self.workers
+        ))
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        self.workers, self.connections, self.senders = [], [], []
+
+    async def on_insert(self, operation: Dict[str, Any]):
+        await self.handle_batch([operation])
+
+    async def on_update(self, operation: Dict[str, Any]):
+        await self.handle_batch([operation])
+
+    async def on_delete(self, operation: Dict[str, Any]):
+        await self.handle_batch([operation])
+
+
+def _serve(connection, handler_factory: Callable, index: int, partitions: int):
+    """
+    Worker process main loop: handles received batches on its own event loop
+    and acknowledges each one of them
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    handler = handler_factory(index, partitions)
+    if asyncio.iscoroutine(handler):
+        handler = loop.run_until_complete(handler)
+
+    async def serve():
+        while True:
+            message = bson.decode(
+                await loop.run_in_executor(None, connection.recv_bytes)
+            )
+            if message.get('stop'):
+                return
+            try:
+                await handler.handle_batch(message['operations'])
+            except Exception as e:
+                connection.send_bytes(bson.encode({'seq': message['seq'],
+                                                   'error': repr(e)}))
+                return
+            connection.send_bytes(bson.encode({'seq': message['seq']}))
+
+    try:
+        loop.run_until_complete(serve())
+    except EOFError:
+        pass
+    finally:
+        connection.close()
+        loop.close()
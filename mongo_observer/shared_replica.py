@@ -0,0 +1,446 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Iterable, Tuple
+
+import bson
+from bson import Timestamp
+from bson.raw_bson import RawBSONDocument
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from mongo_observer import conf
+from mongo_observer.models import Document, plain
+from mongo_observer.operation_handlers import ReactiveCollection
+
+
+MAGIC = b'MOREPL01'
+# magic, sequence, retired, slots, data capacity, data used, count,
+# tombstones, last timestamp
+HEADER = struct.Struct('<8sQQQQQQQQ')
+HEADER_SIZE = 128
+SEQUENCE_OFFSET = 8
+RETIRED_OFFSET = 16
+# key hash, record offset
+SLOT = struct.Struct('<QQ')
+LENGTH = struct.Struct('<I')
+
+EMPTY = 0
+DELETED = 1
+MAX_LOAD_FACTOR = 0.7
+
+# bounds of the exponential backoff of readers waiting for a write section
+MIN_READ_BACKOFF_IN_SECONDS = 1e-6
+MAX_READ_BACKOFF_IN_SECONDS = 1e-3
+
+
+def _key_bytes(key: Any) -> bytes:
+    return bson.encode({'_id': key})
+
+
+def _key_hash(key_bytes: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(),
+                          'little')
+
+
+def _pack_timestamp(timestamp: Timestamp) -> int:
+    if timestamp is None:
+        return 0
+    return timestamp.time << 32 | timestamp.inc
+
+
+def _unpack_timestamp(value: int) -> Optional[Timestamp]:
+    if not value:
+        return None
+    return Timestamp(value >> 32, value & 0xFFFFFFFF)
+
+
+class SharedMemoryStore:
+    """
+    Single writer, memory mapped hash table of BSON documents indexed by
+    `_id`, which may be read by other processes with `SharedReplicaReader`.
+
+    Records are appended to a data region and never modified in place, and
+    slots are updated within a write section, guarded by a sequence lock:
+    the header `sequence` is odd while a write is in progress. When the
+    table or the data region are full, a bigger file is built with the live
+    records only and atomically replaces the old one, which is marked as
+    retired so that readers reopen the path.
+    """
+    def __init__(self,
+                 path: str,
+                 slots: int=None,
+                 data_capacity: int=None):
+        """
+        :param path: File backing the store. Any existing one is replaced
+        :param slots: Initial number of hash table slots, rounded up to a
+        power of 2. Defaults to `conf.SHARED_REPLICA_SLOTS`
+        :param data_capacity: Initial size in bytes of the data region.
+        Defaults to `conf.SHARED_REPLICA_DATA_CAPACITY`
+        """
+        self.path = path
+        self.sequence = 0
+        # depth of nested write sections
+        self.writers = 0
+        self.last_timestamp: Timestamp = None
+        self.mm = self._create(path,
+                               slots or conf.SHARED_REPLICA_SLOTS,
+                               data_capacity or conf.SHARED_REPLICA_DATA_CAPACITY)
+        self.publish()
+
+    def _create(self, path: str, slots: int, data_capacity: int) -> mmap.mmap:
+        slots = 1 << max(slots - 1, 1).bit_length()
+        self.slots = slots
+        self.data_capacity = data_capacity
+        self.data_start = HEADER_SIZE + slots * SLOT.size
+        self.data_used = 0
+        self.count = 0
+        self.tombstones = 0
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.truncate(self.data_start + data_capacity)
+        with open(tmp_path, 'r+b') as f:
+            mm = mmap.mmap(f.fileno(), 0)
+        self._write_header(mm)
+        return mm
+
+    def _write_header(self, mm: mmap.mmap, retired: bool=False):
+        HEADER.pack_into(mm, 0, MAGIC, self.sequence, int(retired),
+                         self.slots, self.data_capacity, self.data_used,
+                         self.count, self.tombstones,
+                         _pack_timestamp(self.last_timestamp))
+
+    def publish(self):
+        """
+        Makes the file being built available to readers at `path`
+        """
+        self.mm.flush()
+        os.replace(f'{self.path}.tmp', self.path)
+
+    @contextmanager
+    def writing(self):
+        """
+        Write section: readers retry reads concurrent to it, so it must not
+        be held across awaits. Nested sections are part of the outermost one
+        """
+        self.writers += 1
+        if self.writers == 1:
+            self.sequence += 1
+            struct.pack_into('<Q', self.mm, SEQUENCE_OFFSET, self.sequence)
+        try:
+            yield self
+        finally:
+            self.writers -= 1
+            if not self.writers:
+                self.sequence += 1
+                self._write_header(self.mm)
+
+    def _find_slot(self, key_bytes: bytes, key_hash: int) -> Tuple[int, bool]:
+        """
+        :return: The index of the slot holding `key_bytes`, and True, or the
+        index of the first free slot for it, and False
+        """
+        mm, mask = self.mm, self.slots - 1
+        index = key_hash & mask
+        free = None
+        while True:
+            slot_hash, offset = SLOT.unpack_from(mm, HEADER_SIZE + index * SLOT.size)
+            if offset == EMPTY:
+                return (index if free is None else free), False
+            if offset == DELETED:
+                if free is None:
+                    free = index
+            elif slot_hash == key_hash and self._record_key(offset) == key_bytes:
+                return index, True
+            index = (index + 1) & mask
+
+    def _record_key(self, offset: int) -> bytes:
+        key_length, = LENGTH.unpack_from(self.mm, offset)
+        return self.mm[offset + LENGTH.size:offset + LENGTH.size + key_length]
+
+    def _set_slot(self, index: int, key_hash: int, offset: int):
+        SLOT.pack_into(self.mm, HEADER_SIZE + index * SLOT.size, key_hash, offset)
+
+    def put(self, key: Any, document: bytes):
+        """
+        :param key: Document `_id`
+        :param document: BSON encoded document
+        """
+        key_bytes = _key_bytes(key)
+        record_size = 2 * LENGTH.size + len(key_bytes) + len(document)
+        if self.data_used + record_size > self.data_capacity or \
+                self.count + self.tombstones + 1 > self.slots * MAX_LOAD_FACTOR:
+            self._grow(record_size)
+
+        offset = self.data_start + self.data_used
+        mm = self.mm
+        LENGTH.pack_into(mm, offset, len(key_bytes))
+        start = offset + LENGTH.size
+        mm[start:start + len(key_bytes)] = key_bytes
+        start += len(key_bytes)
+        LENGTH.pack_into(mm, start, len(document))
+        start += LENGTH.size
+        mm[start:start + len(document)] = document
+        self.data_used += record_size
+
+        key_hash = _key_hash(key_bytes)
+        index, found = self._find_slot(key_bytes, key_hash)
+        if not found:
+            if SLOT.unpack_from(mm, HEADER_SIZE + index * SLOT.size)[1] == DELETED:
+                self.tombstones -= 1
+            self.count += 1
+        self._set_slot(index, key_hash, offset)
+
+    def delete(self, key: Any):
+        key_bytes = _key_bytes(key)
+        key_hash = _key_hash(key_bytes)
+        index, found = self._find_slot(key_bytes, key_hash)
+        if found:
+            self._set_slot(index, key_hash, DELETED)
+            self.count -= 1
+            self.tombstones += 1
+
+    def items(self) -> Iterable[Tuple[bytes, memoryview]]:
+        """
+        :return: `(key, document)` BSON pairs of every live record. The
+        memory views are released as soon as the next pair is produced
+        """
+        with memoryview(self.mm) as view:
+            for index in range(self.slots):
+                _, offset = SLOT.unpack_from(view, HEADER_SIZE + index * SLOT.size)
+                if offset > DELETED:
+                    key, document = _read_record(view, offset)
+                    yield key, document
+                    key.release()
+                    document.release()
+
+    def _grow(self, record_size: int):
+        records = [(bytes(key), bytes(document))
+                   for key, document in self.items()]
+        live_data = sum(len(key) + len(document) + 2 * LENGTH.size
+                        for key, document in records)
+        slots = self.slots
+        while len(records) + 1 > slots * MAX_LOAD_FACTOR / 2:
+            slots *= 2
+        data_capacity = max(self.data_capacity, 2 * (live_data + record_size))
+
+        old_mm = self.mm
+        self.mm = self._create(self.path, slots, data_capacity)
+        for key_bytes, document in records:
+            self.put(bson.decode(key_bytes)['_id'], document)
+        self._write_header(self.mm)
+        self.publish()
+
+        self._write_header(old_mm, retired=True)
+        old_mm.close()
+
+    def close(self):
+        self.mm.close()
+
+
+def _read_record(view: memoryview, offset: int) -> Tuple[memoryview, memoryview]:
+    key_length, = LENGTH.unpack_from(view, offset)
+    start = offset + LENGTH.size
+    key = view[start:start + key_length]
+    start += key_length
+    document_length, = LENGTH.unpack_from(view, start)
+    start += LENGTH.size
+    return key, view[start:start + document_length]
+
+
+class SharedReplicaReader:
+    """
+    Read only view of a `SharedMemoryStore` maintained by another process.
+    Lookups return memory views of the mapped BSON, without copying it.
+
+    Every lookup is consistent with a single `sequence`: reads concurrent
+    to a write section are retried.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.mm: mmap.mmap = None
+        self.view: memoryview = None
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        magic, *_ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a shared replica')
+
+    @property
+    def sequence(self) -> int:
+        """
+        Even number of the last completed write section. Odd while a write
+        is in progress
+        """
+        return struct.unpack_from('<Q', self.mm, SEQUENCE_OFFSET)[0]
+
+    @property
+    def last_timestamp(self) -> Optional[Timestamp]:
+        return self._consistent(
+            lambda: _unpack_timestamp(HEADER.unpack_from(self.mm, 0)[8])
+        )[1]
+
+    def __len__(self) -> int:
+        return self._consistent(lambda: HEADER.unpack_from(self.mm, 0)[6])[1]
+
+    def get_raw(self, key: Any) -> Optional[memoryview]:
+        """
+        :return: A memory view of the BSON document of `_id` `key`, or None
+        """
+        return self.get_many_raw([key])[1][0]
+
+    def get(self, key: Any) -> Optional[RawBSONDocument]:
+        raw = self.get_raw(key)
+        return None if raw is None else RawBSONDocument(raw)
+
+    def get_many_raw(self, keys: Iterable[Any]) -> Tuple[int, List[Optional[memoryview]]]:
+        """
+        :return: The `sequence` the lookups are consistent with, and memory
+        views of the BSON documents of `keys`
+        """
+        keys = [_key_bytes(key) for key in keys]
+        hashes = [_key_hash(key) for key in keys]
+        return self._consistent(
+            lambda: [self._lookup(key, key_hash)
+                     for key, key_hash in zip(keys, hashes)]
+        )
+
+    def _consistent(self, read):
+        backoff = 0
+        while True:
+            if HEADER.unpack_from(self.mm, 0)[2]:
+                self._open()
+                continue
+
+            sequence = self.sequence
+            if sequence & 1:
+                time.sleep(backoff)
+                backoff = min(max(2 * backoff, MIN_READ_BACKOFF_IN_SECONDS),
+                              MAX_READ_BACKOFF_IN_SECONDS)
+                continue
+            try:
+                result = read()
+            except (IndexError, ValueError, struct.error):
+                result = None
+            if self.sequence == sequence:
+                return sequence, result
+
+    def _lookup(self, key_bytes: bytes, key_hash: int) -> Optional[memoryview]:
+        slots = HEADER.unpack_from(self.mm, 0)[3]
+        mask = slots - 1
+        index = key_hash & mask
+        for _ in range(slots):
+            slot_hash, offset = SLOT.unpack_from(self.mm,
+                                                 HEADER_SIZE + index * SLOT.size)
+            if offset == EMPTY:
+                return None
+            if offset != DELETED and slot_hash == key_hash:
+                key, document = _read_record(self.view, offset)
+                if key == key_bytes:
+                    return document
+            index = (index + 1) & mask
+        return None
+
+    def close(self):
+        """
+        Unmaps the store. Documents returned by the reader must be released
+        before it
+        """
+        self.view.release()
+        self.mm.close()
+
+
+class SharedReactiveCollection(ReactiveCollection):
+    """
+    A `ReactiveCollection` that publishes its documents to a
+    `SharedMemoryStore`, so that other local processes may read the replica
+    through `SharedReplicaReader`s, without keeping their own replica.
+
+    Each run of operations of a batch applied synchronously is a single
+    write section of the store, so readers never observe it partially
+    applied. Operations dispatched to overridden `on_*` handlers are awaited
+    outside of write sections.
+    """
+    def __init__(self,
+                 collection: Dict[Any, Document],
+                 remote_collection: AsyncIOMotorCollection,
+                 store: SharedMemoryStore,
+                 projection: Dict[str, Any]=None):
+        super().__init__(collection, remote_collection, projection)
+        self.store = store
+        with store.writing():
+            for _id, doc in collection.items():
+                store.put(_id, bson.encode(plain(doc)))
+
+    @classmethod
+    async def init_async(cls,
+                         remote_collection: AsyncIOMotorCollection,
+                         store: SharedMemoryStore,
+                         **kwargs):
+        replica = await ReactiveCollection.init_async(remote_collection,
+                                                      **kwargs)
+        shared = cls(replica.collection,
+                     remote_collection,
+                     store,
+                     kwargs.get('projection'))
+        shared.last_timestamp = replica.last_timestamp
+        return shared
+
+    async def handle(self, operation: Dict[str, Any]):
+        await super().handle(operation)
+        with self.store.writing():
+            self.store.last_timestamp = self.last_timestamp
+
+    async def handle_batch(self, operations: List[Dict[str, Any]]):
+        if not operations:
+            return
+
+        appliers, handlers, store = self.appliers, self.handlers, self.store
+        runs = itertools.groupby(operations,
+                                 key=lambda operation: operation['op'] in appliers)
+        for applied, run in runs:
+            run = list(run)
+            if applied:
+                with store.writing():
+                    for operation in run:
+                        appliers[operation['op']](operation)
+                    store.last_timestamp = run[-1]['ts']
+                continue
+            for operation in run:
+                handler = handlers.get(operation['op'])
+                if handler is None:
+                    conf.logger.debug({'info': 'skipping operation',
+                                       'operation': operation})
+                else:
+                    await handler(operation)
+
+        self.last_timestamp = operations[-1]['ts']
+        if store.last_timestamp != self.last_timestamp:
+            with store.writing():
+                store.last_timestamp = self.last_timestamp
+
+    def apply_update(self, operation: Dict[str, Any]):
+        with self.store.writing():
+            doc = super().apply_update(operation)
+            if doc is not None:
+                self.store.put(doc['_id'], bson.encode(plain(doc)))
+        return doc
+
+    def apply_insert(self, operation: Dict[str, Any]):
+        with self.store.writing():
+            doc = super().apply_insert(operation)
+            self.store.put(doc['_id'], bson.encode(plain(doc)))
+        return doc
+
+    def apply_delete(self, operation: Dict[str, Any]):
+        with self.store.writing():
+            super().apply_delete(operation)
+            self.store.delete(operation['o']['_id'])
@@ -0,0 +1,138 @@
+import asyncio
+import mmap
+import os
+import struct
+from typing import Dict, Any, Optional, Tuple
+
+import bson
+from bson import Timestamp
+from bson.errors import InvalidBSON
+from pymongo import ASCENDING
+
+from mongo_observer import conf
+from mongo_observer.conf import logger
+from mongo_observer.models import Document, plain
+
+
+MAGIC = 'mongo_observer.snapshot'
+VERSION = 1
+DOCUMENT_SIZE = struct.Struct('<i')
+
+
+class SnapshotFile:
+    """
+    Snapshots of a `ReactiveCollection` on a local file: a BSON header with
+    the `last_timestamp` the documents are consistent with, followed by the
+    BSON documents.
+
+    Documents are encoded a chunk at a time, while operations keep being
+    handled, so they may be newer than the header `last_timestamp`.
+    Replaying operations from it is still consistent, as when observing
+    after an initial sync. The file is atomically replaced on every save.
+    """
+    def __init__(self, path: str, interval: float=None):
+        """
+        :param path: Snapshot file
+        :param interval: Seconds between the saves of `save_periodically`.
+        Defaults to `conf.SNAPSHOT_INTERVAL_IN_SECONDS`
+        """
+        self.path = path
+        if interval is None:
+            interval = conf.SNAPSHOT_INTERVAL_IN_SECONDS
+        self.interval = interval
+
+    async def save(self, replica):
+        """
+        :param replica: `ReactiveCollection` to be saved
+        """
+        last_timestamp = replica.last_timestamp
+        ids = list(replica.collection)
+        loop = asyncio.get_event_loop()
+        tmp_path = f'{self.path}.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            header = bson.encode({'magic': MAGIC,
+                                  'version': VERSION,
+                                  'last_timestamp': last_timestamp})
+            await loop.run_in_executor(None, f.write, header)
+
+            collection, chunk_size = replica.collection, conf.SNAPSHOT_CHUNK_SIZE
+            for start in range(0, len(ids), chunk_size):
+                chunk = b''.join(bson.encode(plain(doc))
+                                 for doc in map(collection.get,
+                                                ids[start:start + chunk_size])
+                                 if doc is not None)
+                await loop.run_in_executor(None, f.write, chunk)
+            await loop.run_in_executor(None, self._sync, f)
+        finally:
+            f.close()
+        os.replace(tmp_path, self.path)
+        logger.info({'info': 'saved snapshot',
+                     'path': self.path,
+                     'documents': len(ids),
+                     'last_timestamp': str(last_timestamp)})
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    async def save_periodically(self, replica):
+        """
+        Saves a snapshot of `replica` every `interval` seconds, until
+        cancelled
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save(replica)
+            except OSError as e:
+                logger.error({'info': 'failed to save snapshot',
+                              'path': self.path,
+                              'error': repr(e)})
+
+    async def load(self) -> Optional[Tuple[Dict[Any, Document], Timestamp]]:
+        """
+        :return: The documents of the snapshot, by `_id`, and its
+        `last_timestamp`, or None if there's no valid snapshot
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, self._read)
+        except FileNotFoundError:
+            return None
+        except (ValueError, InvalidBSON, struct.error) as e:
+            logger.error({'info': 'invalid snapshot',
+                          'path': self.path,
+                          'error': repr(e)})
+            return None
+
+    def _read(self) -> Optional[Tuple[Dict[Any, Document], Timestamp]]:
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            offset, = DOCUMENT_SIZE.unpack_from(mm, 0)
+            if offset > size:
+                raise ValueError(f'{self.path} is truncated')
+            header = bson.decode(mm[:offset])
+            if header.get('magic') != MAGIC or header.get('version') != VERSION:
+                raise ValueError(f'{self.path} is not a snapshot')
+
+            collection = {}
+            while offset < size:
+                document_size, = DOCUMENT_SIZE.unpack_from(mm, offset)
+                doc = bson.decode(mm[offset:offset + document_size])
+                collection[doc['_id']] = Document(doc)
+                offset += document_size
+        return collection, header['last_timestamp']
+
+
+async def is_replayable(oplog, timestamp: Timestamp) -> bool:
+    """
+    :return: True if every operation after `timestamp` is still on `oplog`
+    """
+    if timestamp is None:
+        return False
+    oldest = await oplog.find_one(sort=[('$natural', ASCENDING)],
+                                  projection={'ts': True})
+    return oldest is not None and oldest['ts'] <= timestamp
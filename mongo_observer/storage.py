@@ -0,0 +1,175 @@
+import sys
+import types
+from collections import UserList
+from typing import Dict, Any, Iterator, Mapping, MutableMapping, Tuple, \
+    Optional
+
+import bson
+from bson.codec_options import CodecOptions, DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+
+from mongo_observer import conf
+from mongo_observer.models import Document, plain
+
+
+# objects shared by every document, which aren't part of their size
+SHARED_TYPES = (type, types.FunctionType, types.MethodType,
+                types.BuiltinFunctionType, types.ModuleType, CodecOptions)
+
+
+def deep_sizeof(value: Any, seen: set=None) -> int:
+    """
+    :return: The size in bytes of `value` and every object it references,
+    each one of them counted once
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen or isinstance(value, SHARED_TYPES):
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(item, seen)
+                    for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in value)
+    if hasattr(value, '__dict__'):
+        size += deep_sizeof(vars(value), seen)
+    for cls in type(value).__mro__:
+        for slot in getattr(cls, '__slots__', ()):
+            if hasattr(value, slot):
+                size += deep_sizeof(getattr(value, slot), seen)
+    return size
+
+
+def bytes_per_document(collection: Mapping[Any, Any]) -> float:
+    """
+    :param collection: The documents of a `ReactiveCollection`, either a dict
+    or a storage engine
+    :return: The average memory used by each document, including the
+    overhead of `collection`
+    """
+    if not collection:
+        return 0.0
+    return deep_sizeof(collection) / len(collection)
+
+
+def compact(value: Any) -> Any:
+    """
+    :return: `value` with every nested mapping and list converted into plain
+    dicts and lists, and every key interned, so that documents share them
+    """
+    if isinstance(value, Mapping):
+        return {sys.intern(key): compact(item) for key, item in value.items()}
+    if isinstance(value, (list, UserList)):
+        return [compact(item) for item in value]
+    return value
+
+
+class BSONStorage(MutableMapping):
+    """
+    Keeps each document as its BSON bytes, decoded into a new `Document` on
+    every access. Updated documents must be stored again.
+    """
+    def __init__(self, codec_options: CodecOptions=DEFAULT_CODEC_OPTIONS):
+        self.codec_options = codec_options
+        self.data: Dict[Any, bytes] = {}
+
+    def __getitem__(self, _id: Any) -> Document:
+        return Document(bson.decode(self.data[_id], self.codec_options))
+
+    def __setitem__(self, _id: Any, doc: Mapping[str, Any]):
+        if isinstance(doc, RawBSONDocument):
+            self.data[_id] = doc.raw
+        else:
+            self.data[_id] = bson.encode(plain(doc))
+
+    def __delitem__(self, _id: Any):
+        del self.data[_id]
+
+    def __contains__(self, _id: Any) -> bool:
+        return _id in self.data
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def raw(self, _id: Any) -> bytes:
+        """
+        :return: The BSON bytes of the document of `_id`, without decoding it
+        """
+        return self.data[_id]
+
+
+class RecordStorage(MutableMapping):
+    """
+    Keeps each document as a record of a `__slots__` class of its schema,
+    the names of its top level fields, which is shared by every document
+    with the same ones. Nested values are kept as plain dicts and lists,
+    with interned keys. Documents are built on every access, and updated
+    documents must be stored again.
+
+    Documents of schemas beyond the first `max_classes` ones are kept as
+    compacted dicts instead, as collections without a fixed schema would
+    create a class for almost every document.
+    """
+    def __init__(self, max_classes: int=None):
+        """
+        :param max_classes: Maximum number of record classes. Defaults to
+        `conf.RECORD_STORAGE_MAX_CLASSES`
+        """
+        if max_classes is None:
+            max_classes = conf.RECORD_STORAGE_MAX_CLASSES
+        self.max_classes = max_classes
+        self.records: Dict[Any, Any] = {}
+        self.classes: Dict[Tuple[str, ...], type] = {}
+
+    def record_class(self, fields: Tuple[str, ...]) -> Optional[type]:
+        """
+        :return: The record class of the schema `fields`, or None if there
+        are already `max_classes` classes of other schemas
+        """
+        cls = self.classes.get(fields)
+        if cls is None:
+            if len(self.classes) >= self.max_classes:
+                return None
+            # field names aren't necessarily identifiers
+            slots = tuple(f'_{i}' for i in range(len(fields)))
+            cls = self.classes[fields] = type('Record', (), {
+                '__slots__': slots,
+                'fields': tuple(sys.intern(field) for field in fields),
+            })
+        return cls
+
+    def __getitem__(self, _id: Any) -> Document:
+        record = self.records[_id]
+        if isinstance(record, dict):
+            return Document(dict(record))
+        cls = type(record)
+        return Document({field: getattr(record, slot)
+                         for field, slot in zip(cls.fields, cls.__slots__)})
+
+    def __setitem__(self, _id: Any, doc: Mapping[str, Any]):
+        cls = self.record_class(tuple(doc))
+        if cls is None:
+            self.records[_id] = compact(doc)
+            return
+        record = cls()
+        for slot, value in zip(cls.__slots__, doc.values()):
+            setattr(record, slot, compact(value))
+        self.records[_id] = record
+
+    def __delitem__(self, _id: Any):
+        del self.records[_id]
+
+    def __contains__(self, _id: Any) -> bool:
+        return _id in self.records
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
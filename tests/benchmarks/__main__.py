@@ -0,0 +1,287 @@
+"""
+End-to-end throughput benchmarks of `Observer` pipelines over synthetic
+oplogs, fed by in-process fakes of motor collections and cursors.
+
+    python -m tests.benchmarks
+    python -m tests.benchmarks --check-regressions
+    python -m tests.benchmarks --save-baseline
+
+Throughput and latency depend on the machine, so they're compared relative
+to a pure Python reference workload measured in the same run. Given
+`--check-regressions`, results are compared with `baseline.json`, and the
+exit status is 1 if any of them regressed beyond `--tolerance`. Baselines
+measured by another Python version or number of operations aren't
+compared, as relative results and memory depend on them, and the exit
+status is 2.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Dict, Any, List
+
+from bson import Timestamp
+
+from mongo_observer import conf
+from mongo_observer.models import Operations
+from mongo_observer.observer import Observer, ShouldStopObservation
+from mongo_observer.operation_handlers import ReactiveCollection
+from mongo_observer.storage import BSONStorage, RecordStorage, \
+    bytes_per_document
+from tests.benchmarks.fake_motor import FakeCollection
+from tests.benchmarks.oplog_generator import SyntheticOplog
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# oplog cursor batch size, so that each pipeline dispatches many batches
+BATCH_SIZE = 100
+# the fastest of these runs of the reference workload is kept, as it's the
+# least disturbed by everything else running on the machine
+REFERENCE_RUNS = 3
+
+WORKLOADS = {
+    'update_heavy': dict(mix={Operations.INSERT: 0.1,
+                              Operations.UPDATE: 0.85,
+                              Operations.DELETE: 0.05}),
+    'insert_heavy': dict(mix={Operations.INSERT: 0.7,
+                              Operations.UPDATE: 0.2,
+                              Operations.DELETE: 0.1}),
+    'large_documents': dict(document_size=4096,
+                            nesting_depth=6,
+                            array_size=64),
+}
+
+PIPELINES = {
+    'reactive_collection': dict(),
+    'reactive_collection_raw_bson': dict(raw_bson=True),
+    'reactive_collection_prefetch': dict(prefetch_batches=2),
+    'reactive_collection_bson_storage': dict(storage=BSONStorage),
+    'reactive_collection_record_storage': dict(storage=RecordStorage),
+}
+
+# (result key, higher is better)
+COMPARED_RESULTS = (('relative_throughput', True),
+                    ('relative_p50_dispatch_latency', False),
+                    ('peak_memory_mb', False),
+                    ('bytes_per_document', False))
+
+
+async def stop():
+    raise ShouldStopObservation
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run_pipeline(workload: Dict[str, Any],
+                       pipeline: Dict[str, Any],
+                       operations: int,
+                       trace_memory: bool) -> Dict[str, float]:
+    pipeline = dict(pipeline)
+    storage_class = pipeline.pop('storage', None)
+    generator = SyntheticOplog(**workload)
+    remote_collection = FakeCollection(generator.collection())
+    oplog = FakeCollection(generator.operations(operations),
+                           batch_size=BATCH_SIZE)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    reactive_collection = await ReactiveCollection.init_async(
+        remote_collection,
+        partitions=1,
+        storage=storage_class() if storage_class else None
+    )
+    observer = await Observer.init_async(oplog=oplog,
+                                         operation_handler=reactive_collection,
+                                         namespace_filter=generator.namespace,
+                                         starting_timestamp=Timestamp(0, 1),
+                                         on_nothing_to_fetch_on_cursor=stop,
+                                         catch_up_threshold=0,
+                                         **pipeline)
+
+    latencies = []
+    handle_batch = observer.handle_batch
+
+    async def timed_handle_batch(batch):
+        batch_start = time.perf_counter()
+        await handle_batch(batch)
+        latencies.append(time.perf_counter() - batch_start)
+    observer.handle_batch = timed_handle_batch
+
+    observe_start = time.perf_counter()
+    await observer.observe_changes()
+    end = time.perf_counter()
+
+    result = {'operations_per_second': operations / (end - observe_start),
+              'initial_sync_seconds': observe_start - start,
+              'p50_dispatch_latency_ms': percentile(latencies, 0.5) * 1000,
+              'p99_dispatch_latency_ms': percentile(latencies, 0.99) * 1000}
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_memory_mb'] = peak / 2 ** 20
+    # measured after tracing, as it allocates while walking the documents
+    result['bytes_per_document'] = bytes_per_document(
+        reactive_collection.collection
+    )
+    return result
+
+
+def reference_operations_per_second(workload: Dict[str, Any],
+                                    operations: int) -> float:
+    """
+    :return: The rate at which the operations of `workload` are deep copied,
+    which scales with the speed of the machine as the pipelines do, but
+    doesn't depend on the code under benchmark
+    """
+    generator = SyntheticOplog(**workload)
+    generator.collection()
+    oplog = generator.operations(operations)
+    elapsed = []
+    for _ in range(REFERENCE_RUNS):
+        start = time.perf_counter()
+        for operation in oplog:
+            copy.deepcopy(operation)
+        elapsed.append(time.perf_counter() - start)
+    return operations / min(elapsed)
+
+
+def run(operations: int, only: str=None) -> Dict[str, Dict[str, float]]:
+    loop = asyncio.get_event_loop()
+    results = {}
+    for workload_name, workload in WORKLOADS.items():
+        for pipeline_name, pipeline in PIPELINES.items():
+            name = f'{workload_name}/{pipeline_name}'
+            if only and only not in name:
+                continue
+            # measured right before each pipeline, so that both run on a
+            # machine under the same load
+            reference = reference_operations_per_second(workload, operations)
+            result = loop.run_until_complete(
+                run_pipeline(workload, pipeline, operations, trace_memory=False)
+            )
+            # tracing allocations slows the pipeline down, so memory is
+            # measured by a separate run
+            memory = loop.run_until_complete(
+                run_pipeline(workload, pipeline, operations, trace_memory=True)
+            )
+            result['peak_memory_mb'] = memory['peak_memory_mb']
+            result['relative_throughput'] = (result['operations_per_second'] /
+                                             reference)
+            # in reference operations, as the dispatch latency is in seconds
+            result['relative_p50_dispatch_latency'] = (
+                result['p50_dispatch_latency_ms'] / 1000 * reference
+            )
+            results[name] = result
+            print(f'{name:<50} {result["operations_per_second"]:>10.0f} ops/s  '
+                  f'x{result["relative_throughput"]:>6.3f}  '
+                  f'p50 {result["p50_dispatch_latency_ms"]:>7.2f} ms  '
+                  f'p99 {result["p99_dispatch_latency_ms"]:>7.2f} ms  '
+                  f'peak {result["peak_memory_mb"]:>7.1f} MB  '
+                  f'{result["bytes_per_document"]:>7.0f} B/doc')
+    return results
+
+
+def regressions(results: Dict[str, Dict[str, float]],
+                baseline: Dict[str, Dict[str, float]],
+                tolerance: float) -> List[str]:
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key, higher_is_better in COMPARED_RESULTS:
+            if key not in baseline[name]:
+                continue
+            expected, actual = baseline[name][key], result[key]
+            if higher_is_better:
+                regressed = actual < expected * (1 - tolerance)
+            else:
+                regressed = actual > expected * (1 + tolerance)
+            if regressed:
+                found.append(f'{name} {key}: {actual:.2f} '
+                             f'(baseline {expected:.2f})')
+    return found
+
+
+def environment(operations: int) -> Dict[str, Any]:
+    """
+    :return: What results depend on besides the code and the machine, saved
+    along with them on the baseline
+    """
+    return {'python': '.'.join(platform.python_version_tuple()[:2]),
+            'operations': operations}
+
+
+def incomparable(baseline: Dict[str, Dict[str, Any]],
+                 expected: Dict[str, Any],
+                 only: str=None) -> List[str]:
+    """
+    :return: The baseline results to be compared which weren't measured in
+    the `expected` environment
+    """
+    return [f'{name}: {dict((key, result.get(key)) for key in expected)}'
+            for name, result in sorted(baseline.items())
+            if (not only or only in name) and
+            any(result.get(key) != value for key, value in expected.items())]
+
+
+def main(argv: List[str]=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m tests.benchmarks')
+    parser.add_argument('--operations', type=int, default=10000)
+    parser.add_argument('--only', help='Runs only benchmarks containing it')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check-regressions', action='store_true',
+                        help='Exits with 1 if any result regressed from the '
+                             'baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Accepted relative regression of each result')
+    args = parser.parse_args(argv)
+    conf.logger.setLevel(logging.WARNING)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    expected = environment(args.operations)
+    check = args.check_regressions and not args.save_baseline
+    if check:
+        found = incomparable(baseline, expected, args.only)
+        if found:
+            print(f'The baseline of these results wasn\'t measured with '
+                  f'{expected}, save a new one with --save-baseline:',
+                  file=sys.stderr)
+            for name in found:
+                print(f'    {name}', file=sys.stderr)
+            return 2
+
+    results = run(args.operations, args.only)
+
+    if args.save_baseline:
+        baseline.update((name, dict(result, **expected))
+                        for name, result in results.items())
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+
+    if not check:
+        return 0
+    found = regressions(results, baseline, args.tolerance)
+    for regression in found:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import asyncio
+import copy
+from bisect import bisect_right
+from collections import deque
+from typing import Dict, Any, List
+
+import bson
+from bson.codec_options import CodecOptions, DEFAULT_CODEC_OPTIONS
+from pymongo import CursorType, DESCENDING
+
+from mongo_observer.oplog_dump import matches, TAILABLE_CURSOR_TYPES
+
+
+class FakeCursor:
+    """
+    In-process motor cursor over BSON encoded documents, decoded a batch at
+    a time as `fetch_next` fetches it, like network batches
+    """
+    def __init__(self,
+                 documents: List[bytes],
+                 filter: Dict[str, Any],
+                 codec_options: CodecOptions,
+                 batch_size: int,
+                 tailable: bool=False,
+                 start: int=0):
+        self.documents = documents
+        self.filter = filter
+        self.codec_options = codec_options
+        self.batch_size = batch_size
+        self.tailable = tailable
+        self.position = start
+        self.buffer = deque()
+        self.alive = True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._buffer_size() or await self.fetch_next:
+            return self.next_object()
+        raise StopAsyncIteration
+
+    @property
+    def fetch_next(self):
+        return self._get_more()
+
+    async def _get_more(self) -> bool:
+        if self.buffer:
+            return True
+        if not self.alive:
+            return False
+
+        documents, end = self.documents, len(self.documents)
+        while self.position < end and len(self.buffer) < self.batch_size:
+            document = bson.decode(documents[self.position], self.codec_options)
+            if matches(document, self.filter):
+                self.buffer.append(document)
+            self.position += 1
+
+        if self.position == end and not self.tailable:
+            self.alive = False
+        await asyncio.sleep(0)
+        return bool(self.buffer)
+
+    def next_object(self):
+        if not self.buffer:
+            return None
+        return self.buffer.popleft()
+
+    def _buffer_size(self) -> int:
+        return len(self.buffer)
+
+    async def close(self):
+        self.alive = False
+
+
+class FakeCollection:
+    """
+    In-process fake of the subset of a motor collection used by `Observer`
+    and `ReactiveCollection`
+    """
+    def __init__(self,
+                 documents: List[Dict[str, Any]],
+                 batch_size: int=1000,
+                 codec_options: CodecOptions=DEFAULT_CODEC_OPTIONS,
+                 name: str='fake'):
+        self.name = name
+        self.documents = [bson.encode(document) for document in documents]
+        self.batch_size = batch_size
+        self.codec_options = codec_options
+        # oplog entries are sorted by `ts`, which cursors may seek
+        self.timestamps = [document.get('ts') for document in documents]
+        self.seekable = all(ts is not None for ts in self.timestamps)
+
+    def with_options(self, codec_options: CodecOptions=None, **kwargs):
+        collection = copy.copy(self)
+        collection.codec_options = codec_options or self.codec_options
+        return collection
+
+    def find(self,
+             filter: Dict[str, Any]=None,
+             projection: Dict[str, Any]=None,
+             cursor_type: CursorType=CursorType.NON_TAILABLE,
+             batch_size: int=None,
+             **kwargs) -> FakeCursor:
+        filter = filter or {}
+        start = 0
+        ts = filter.get('ts')
+        if self.seekable and isinstance(ts, dict) and '$gt' in ts:
+            start = bisect_right(self.timestamps, ts['$gt'])
+        return FakeCursor(self.documents,
+                          filter,
+                          self.codec_options,
+                          batch_size or self.batch_size,
+                          tailable=cursor_type in TAILABLE_CURSOR_TYPES,
+                          start=start)
+
+    async def estimated_document_count(self) -> int:
+        return len(self.documents)
+
+    async def find_one(self,
+                       filter: Dict[str, Any]=None,
+                       projection: Dict[str, Any]=None,
+                       sort: List=None,
+                       **kwargs):
+        documents = self.documents
+        if sort and sort[0] == ('$natural', DESCENDING):
+            documents = reversed(documents)
+        for raw in documents:
+            document = bson.decode(raw, self.codec_options)
+            if matches(document, filter or {}):
+                return document
+        return None
@@ -0,0 +1,137 @@
+import random
+import string
+from typing import Dict, Any, List
+
+from bson import Timestamp, ObjectId
+
+from mongo_observer.models import Operations
+
+
+class SyntheticOplog:
+    """
+    Generates a collection and a consistent oplog of operations on it:
+    updates and deletes only affect existing documents.
+    """
+    def __init__(self,
+                 namespace: str='bench.documents',
+                 mix: Dict[str, float]=None,
+                 document_size: int=256,
+                 nesting_depth: int=2,
+                 array_size: int=8,
+                 initial_documents: int=1000,
+                 operations_per_second: int=1000,
+                 seed: int=0):
+        """
+        :param mix: Relative weights of `Operations.INSERT`, `UPDATE` and
+        `DELETE`
+        :param document_size: Approximate size in bytes of the string fields
+        of a document
+        :param nesting_depth: Depth of the embedded documents
+        :param array_size: Number of items of the array fields
+        :param initial_documents: Number of documents of the collection,
+        before the oplog operations
+        :param operations_per_second: Operations sharing the same `ts.time`
+        """
+        self.namespace = namespace
+        self.mix = mix or {Operations.INSERT: 0.2,
+                           Operations.UPDATE: 0.7,
+                           Operations.DELETE: 0.1}
+        self.document_size = document_size
+        self.nesting_depth = nesting_depth
+        self.array_size = array_size
+        self.initial_documents = initial_documents
+        self.operations_per_second = operations_per_second
+        self.random = random.Random(seed)
+
+        self.ids: List[ObjectId] = []
+        self.positions: Dict[ObjectId, int] = {}
+        self.clock = 1
+
+    def _string(self, size: int) -> str:
+        return ''.join(self.random.choices(string.ascii_letters, k=size))
+
+    def _embedded(self, depth: int) -> Dict[str, Any]:
+        doc = {'value': self.random.random(), 'label': self._string(8)}
+        if depth > 1:
+            doc['child'] = self._embedded(depth - 1)
+        return doc
+
+    def document(self, _id: ObjectId) -> Dict[str, Any]:
+        fields = max(1, self.document_size // 32)
+        doc = {'_id': _id, 'counter': 0}
+        for index in range(fields):
+            doc[f'field_{index}'] = self._string(32)
+        doc['items'] = [self.random.randint(0, 1000)
+                        for _ in range(self.array_size)]
+        if self.nesting_depth:
+            doc['nested'] = self._embedded(self.nesting_depth)
+        return doc
+
+    def _path(self) -> str:
+        depth = self.random.randint(0, self.nesting_depth)
+        if depth == 0:
+            return 'counter'
+        return '.'.join(['nested'] + ['child'] * (depth - 1) + ['value'])
+
+    def _update(self) -> Dict[str, Any]:
+        change = {'$set': {self._path(): self.random.random()}}
+        if self.array_size:
+            index = self.random.randrange(self.array_size)
+            change['$set'][f'items.{index}'] = self.random.randint(0, 1000)
+        if self.random.random() < 0.1:
+            change['$unset'] = {'field_0': True}
+        return change
+
+    def _add(self, _id: ObjectId):
+        self.positions[_id] = len(self.ids)
+        self.ids.append(_id)
+
+    def _remove(self, _id: ObjectId):
+        position = self.positions.pop(_id)
+        last = self.ids.pop()
+        if last != _id:
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def collection(self) -> List[Dict[str, Any]]:
+        """
+        :return: The initial documents of the collection
+        """
+        docs = []
+        for _ in range(self.initial_documents):
+            _id = ObjectId()
+            self._add(_id)
+            docs.append(self.document(_id))
+        return docs
+
+    def operations(self, count: int) -> List[Dict[str, Any]]:
+        """
+        :return: `count` oplog entries, following the `collection` ones
+        """
+        ops, weights = zip(*self.mix.items())
+        entries = []
+        for index in range(count):
+            op = self.random.choices(ops, weights)[0]
+            if op != Operations.INSERT and not self.ids:
+                op = Operations.INSERT
+
+            entry = {'ts': Timestamp(self.clock + index // self.operations_per_second,
+                                     index % self.operations_per_second + 1),
+                     'ns': self.namespace,
+                     'op': op}
+            if op == Operations.INSERT:
+                _id = ObjectId()
+                self._add(_id)
+                entry['o'] = self.document(_id)
+            elif op == Operations.UPDATE:
+                _id = self.random.choice(self.ids)
+                entry['o'] = self._update()
+                entry['o2'] = {'_id': _id}
+            else:
+                _id = self.random.choice(self.ids)
+                self._remove(_id)
+                entry['o'] = {'_id': _id}
+            entries.append(entry)
+
+        self.clock += count // self.operations_per_second + 1
+        return entries
@@ -0,0 +1,151 @@
+from collections import deque
+
+from asynctest import TestCase, CoroutineMock, Mock, call
+
+from mongo_observer import conf
+from mongo_observer.change_stream import ChangeStreamObserver, to_oplog_entry
+from mongo_observer.observer import ShouldStopObservation
+from tests.unit.utils import mock_handler
+
+
+class ToOplogEntryTests(TestCase):
+    def setUp(self):
+        self.change = {
+            '_id': {'_data': 'token'},
+            'clusterTime': 666,
+            'ns': {'db': 'pets', 'coll': 'dogs'},
+            'documentKey': {'_id': 1},
+        }
+
+    def test_insert_events_are_converted_to_i_operations(self):
+        self.change.update(operationType='insert',
+                           fullDocument={'_id': 1, 'dog': 'Xablau'})
+
+        self.assertEqual(to_oplog_entry(self.change), {
+            'ts': 666,
+            'ns': 'pets.dogs',
+            'op': 'i',
+            'o': {'_id': 1, 'dog': 'Xablau'}
+        })
+
+    def test_update_events_are_converted_to_set_and_unset_operations(self):
+        self.change.update(operationType='update', updateDescription={
+            'updatedFields': {'dog': 'Xena'},
+            'removedFields': ['cat']
+        })
+
+        self.assertEqual(to_oplog_entry(self.change), {
+            'ts': 666,
+            'ns': 'pets.dogs',
+            'op': 'u',
+            'o': {'$set': {'dog': 'Xena'}, '$unset': {'cat': True}},
+            'o2': {'_id': 1}
+        })
+
+    def test_replace_events_are_converted_to_replacement_updates(self):
+        self.change.update(operationType='replace',
+                           fullDocument={'_id': 1, 'dog': 'Xena'})
+
+        entry = to_oplog_entry(self.change)
+        self.assertEqual(entry['op'], 'u')
+        self.assertEqual(entry['o'], {'_id': 1, 'dog': 'Xena'})
+        self.assertEqual(entry['o2'], {'_id': 1})
+
+    def test_delete_events_are_converted_to_d_operations(self):
+        self.change.update(operationType='delete')
+
+        self.assertEqual(to_oplog_entry(self.change), {
+            'ts': 666,
+            'ns': 'pets.dogs',
+            'op': 'd',
+            'o': {'_id': 1}
+        })
+
+    def test_non_document_events_are_ignored(self):
+        self.change.update(operationType='drop')
+        self.assertIsNone(to_oplog_entry(self.change))
+
+
+class MockChangeStream:
+    """
+    A motor change stream whose getMores return each of `batches`
+    """
+    alive = True
+
+    def __init__(self, batches):
+        self.batches = deque(batches)
+        self.buffer = deque()
+        self.get_mores = 0
+        self.delegate = Mock(_cursor=Mock(_has_next=lambda: bool(self.buffer)))
+        self.close = CoroutineMock()
+
+    async def try_next(self):
+        if not self.buffer:
+            self.get_mores += 1
+            self.buffer.extend(self.batches.popleft())
+        return self.buffer.popleft() if self.buffer else None
+
+
+class ChangeStreamObserverTests(TestCase):
+    def setUp(self):
+        self.handler = mock_handler(operation_types={'i', 'd'})
+        self.watched = Mock()
+        self.observer = ChangeStreamObserver(
+            watched=self.watched,
+            operation_handler=self.handler,
+            namespace_filter='pets.dogs',
+            pipeline=[{'$project': {'fullDocument.photo': 0}}],
+            resume_after={'_data': 'token'},
+            on_nothing_to_fetch_on_cursor=self.stop_infinite_iteration,
+            batch_size=2
+        )
+
+    async def stop_infinite_iteration(self):
+        raise ShouldStopObservation()
+
+    def change(self, token, _id):
+        return {'_id': token,
+                'operationType': 'delete',
+                'clusterTime': token,
+                'ns': {'db': 'pets', 'coll': 'dogs'},
+                'documentKey': {'_id': _id}}
+
+    def test_filters_are_pushed_down_to_a_match_stage(self):
+        self.assertEqual(self.observer.pipeline, [
+            {'$match': {'ns.db': 'pets',
+                        'ns.coll': 'dogs',
+                        'operationType': {'$in': ['delete', 'insert']}}},
+            {'$project': {'fullDocument.photo': 0}}
+        ])
+
+    def test_stream_resumes_after_the_last_handled_event(self):
+        stream = self.observer.get_new_stream()
+
+        self.assertEqual(stream, self.watched.watch.return_value)
+        self.watched.watch.assert_called_once_with(
+            self.observer.pipeline,
+            resume_after={'_data': 'token'},
+            batch_size=2,
+            max_await_time_ms=conf.CHANGE_STREAM_MAX_AWAIT_TIME_MS
+        )
+
+    async def test_it_handles_available_events_in_batches(self):
+        changes = [self.change(token, _id=token) for token in range(3)]
+        stream = MockChangeStream([changes, []])
+        self.watched.watch.return_value = stream
+
+        await self.observer.observe_changes()
+
+        self.assertEqual(self.handler.handle_batch.call_args_list, [
+            call([to_oplog_entry(change) for change in changes[:2]]),
+            call([to_oplog_entry(changes[2])])
+        ])
+        self.assertEqual(self.observer.resume_token, 2)
+        stream.close.assert_called_once_with()
+
+    async def test_batches_end_with_the_locally_buffered_events(self):
+        changes = [self.change(token, _id=token) for token in range(2)]
+        stream = MockChangeStream([changes[:1], changes[1:]])
+
+        self.assertEqual(await self.observer.fetch_batch(stream), changes[:1])
+        self.assertEqual(stream.get_mores, 1)
@@ -0,0 +1,92 @@
+import os
+import tempfile
+
+from asynctest import TestCase, CoroutineMock, Mock
+from bson import Timestamp
+
+from mongo_observer.checkpoints import CheckpointStore, FileCheckpointStore, \
+    MongoCheckpointStore
+
+
+class InMemoryCheckpointStore(CheckpointStore):
+    async def load(self):
+        return self.saved_position
+
+    async def save(self, position):
+        pass
+
+
+class CheckpointStoreTests(TestCase):
+    def setUp(self):
+        self.store = InMemoryCheckpointStore(interval=60, max_operations=10)
+        self.store.save = CoroutineMock()
+
+    async def test_checkpoints_are_coalesced_by_operation_count(self):
+        for ts in range(1, 10):
+            await self.store.checkpoint(ts)
+        self.store.save.assert_not_called()
+
+        await self.store.checkpoint(10)
+        self.store.save.assert_called_once_with(10)
+        self.assertEqual(self.store.pending_operations, 0)
+
+    async def test_checkpoints_are_coalesced_by_time(self):
+        self.store.interval = 0
+        await self.store.checkpoint(1)
+
+        self.store.save.assert_called_once_with(1)
+
+    async def test_flush_saves_only_unsaved_checkpoints(self):
+        await self.store.flush()
+        self.store.save.assert_not_called()
+
+        await self.store.checkpoint(1)
+        await self.store.flush()
+        await self.store.flush()
+        self.store.save.assert_called_once_with(1)
+
+
+class FileCheckpointStoreTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'checkpoint.bson')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_load_returns_none_if_theres_no_checkpoint(self):
+        self.assertIsNone(await FileCheckpointStore(self.path).load())
+
+    async def test_saved_checkpoint_is_loaded_by_a_new_store(self):
+        await FileCheckpointStore(self.path).save(Timestamp(666, 1))
+
+        loaded = await FileCheckpointStore(self.path).load()
+        self.assertEqual(loaded, Timestamp(666, 1))
+        self.assertFalse(os.path.exists(f'{self.path}.tmp'))
+
+
+class MongoCheckpointStoreTests(TestCase):
+    def setUp(self):
+        self.collection = Mock(find_one=CoroutineMock(),
+                               update_one=CoroutineMock())
+        self.store = MongoCheckpointStore(self.collection, 'xablau')
+
+    async def test_it_upserts_the_checkpoint_document(self):
+        await self.store.save(Timestamp(666, 1))
+
+        self.collection.update_one.assert_called_once_with(
+            {'_id': 'xablau'},
+            {'$set': {'position': Timestamp(666, 1)}},
+            upsert=True
+        )
+
+    async def test_it_loads_the_checkpoint_document_position(self):
+        self.collection.find_one.return_value = {'_id': 'xablau',
+                                                 'position': Timestamp(666, 1)}
+
+        self.assertEqual(await self.store.load(), Timestamp(666, 1))
+        self.collection.find_one.assert_called_once_with({'_id': 'xablau'})
+
+    async def test_load_returns_none_if_theres_no_checkpoint(self):
+        self.collection.find_one.return_value = None
+        self.assertIsNone(await self.store.load())
@@ -0,0 +1,229 @@
+import asyncio
+
+from asynctest import TestCase, CoroutineMock, Mock, call
+from bson import Timestamp
+
+from mongo_observer.coalescing import coalesce, CoalescingOperationHandler, \
+    DebouncingOperationHandler
+from mongo_observer.models import Operations, Document
+from mongo_observer.operation_handlers import ReactiveCollection
+from tests.unit.utils import mock_handler
+
+
+def update(ts, _id, change, ns='db.xablau'):
+    return {'ts': Timestamp(1, ts), 'ns': ns, 'op': Operations.UPDATE,
+            'o': change, 'o2': {'_id': _id}}
+
+
+def insert(ts, _id, ns='db.xablau'):
+    return {'ts': Timestamp(1, ts), 'ns': ns, 'op': Operations.INSERT,
+            'o': {'_id': _id}}
+
+
+def delete(ts, _id, ns='db.xablau'):
+    return {'ts': Timestamp(1, ts), 'ns': ns, 'op': Operations.DELETE,
+            'o': {'_id': _id}}
+
+
+class CoalesceTests(TestCase):
+    def test_updates_on_the_same_document_are_merged_into_the_last_one(self):
+        operations = [
+            update(1, 1, {'$set': {'price': 1, 'stock': 5}}),
+            update(2, 2, {'$set': {'price': 10}}),
+            update(3, 1, {'$v': 1, '$set': {'price': 2}, '$unset': {'stock': 1}}),
+            update(4, 1, {'$set': {'stock': 3}, '$unset': {'old': 1}}),
+        ]
+
+        coalesced = coalesce(operations)
+
+        self.assertEqual(coalesced, [
+            operations[1],
+            update(4, 1, {'$set': {'price': 2, 'stock': 3},
+                          '$unset': {'old': 1}}),
+        ])
+        self.assertEqual(operations[0]['o'],
+                         {'$set': {'price': 1, 'stock': 5}})
+
+    def test_updates_on_overlapping_paths_are_not_merged(self):
+        operations = [
+            update(1, 1, {'$set': {'seller.price': 1}}),
+            update(2, 1, {'$unset': {'seller': 1}}),
+            update(3, 1, {'$set': {'stock': 1}}),
+        ]
+
+        self.assertEqual(coalesce(operations), [
+            operations[0],
+            update(3, 1, {'$unset': {'seller': 1}, '$set': {'stock': 1}}),
+        ])
+
+    def test_other_update_operators_are_barriers(self):
+        operations = [
+            update(1, 1, {'$set': {'price': 1}}),
+            update(2, 1, {'$inc': {'views': 1}}),
+            update(3, 1, {'$set': {'price': 2}}),
+        ]
+
+        self.assertEqual(coalesce(operations), operations)
+
+    def test_inserted_and_deleted_documents_are_reduced_to_the_delete(self):
+        operations = [
+            insert(1, 1),
+            update(2, 1, {'$set': {'price': 1}}),
+            insert(3, 2),
+            delete(4, 1),
+        ]
+
+        self.assertEqual(coalesce(operations), operations[2:])
+
+    async def test_replayed_inserts_of_existing_documents_are_deleted(self):
+        replica = ReactiveCollection({1: Document({'_id': 1, 'price': 1})},
+                                     Mock())
+
+        await replica.handle_batch(coalesce([
+            insert(1, 1),
+            update(2, 1, {'$set': {'price': 2}}),
+            delete(3, 1),
+        ]))
+
+        self.assertEqual(replica.collection, {})
+
+    def test_unset_of_a_dotted_path_set_before_is_a_barrier(self):
+        operations = [
+            update(1, 1, {'$set': {'d.e.f': 1}}),
+            update(2, 1, {'$unset': {'d.e.f': 1}}),
+        ]
+
+        self.assertEqual(coalesce(operations), operations)
+
+    def test_updates_before_a_delete_are_dropped(self):
+        operations = [
+            update(1, 1, {'$set': {'price': 1}}),
+            update(2, 1, {'$inc': {'views': 1}}),
+            delete(3, 1),
+        ]
+
+        self.assertEqual(coalesce(operations), [operations[2]])
+
+    def test_documents_are_identified_by_namespace(self):
+        operations = [
+            update(1, 1, {'$set': {'price': 1}}),
+            update(2, 1, {'$set': {'price': 2}}, ns='db.other'),
+        ]
+
+        self.assertEqual(coalesce(operations), operations)
+
+
+class CoalescingOperationHandlerTests(TestCase):
+    async def test_it_handles_coalesced_batches_up_to_the_last_ts(self):
+        handler = mock_handler(last_timestamp=Timestamp(1, 5))
+        coalescing = CoalescingOperationHandler(handler)
+        operations = [
+            update(1, 1, {'$set': {'price': 1}}),
+            update(3, 1, {'$set': {'price': 2}}),
+            insert(4, 2),
+            delete(5, 2),
+        ]
+
+        await coalescing.handle_batch(operations)
+
+        handler.handle_batch.assert_called_once_with(
+            [update(3, 1, {'$set': {'price': 2}}), delete(5, 2)]
+        )
+        self.assertEqual(coalescing.last_timestamp, Timestamp(1, 5))
+
+    async def test_last_timestamp_follows_a_lagging_handler(self):
+        handler = mock_handler(last_timestamp=Timestamp(1, 1))
+        coalescing = CoalescingOperationHandler(handler)
+
+        await coalescing.handle_batch([insert(1, 1), insert(2, 2)])
+
+        self.assertEqual(coalescing.last_timestamp, Timestamp(1, 1))
+
+
+class DebouncingOperationHandlerTests(TestCase):
+    def setUp(self):
+        self.handler = mock_handler(handlers={
+            Operations.INSERT: CoroutineMock(),
+            Operations.UPDATE: CoroutineMock(),
+            Operations.DELETE: CoroutineMock(),
+        })
+        self.on_update = self.handler.handlers[Operations.UPDATE]
+        self.debouncing = DebouncingOperationHandler(self.handler,
+                                                     window=0.05,
+                                                     max_delay=1,
+                                                     max_pending=2)
+
+    async def test_bursts_of_updates_are_handled_once_after_the_window(self):
+        await self.debouncing.handle_batch([
+            update(1, 1, {'$set': {'price': 1}}),
+            update(2, 1, {'$set': {'price': 2}, '$unset': {'old': 1}}),
+        ])
+        self.on_update.assert_not_called()
+        self.assertIsNone(self.debouncing.last_timestamp)
+
+        await asyncio.sleep(0.1)
+
+        self.on_update.assert_called_once_with(
+            update(2, 1, {'$set': {'price': 2}, '$unset': {'old': 1}})
+        )
+        self.assertEqual(self.debouncing.last_timestamp, Timestamp(1, 2))
+
+    async def test_updates_are_delayed_at_most_max_delay(self):
+        self.debouncing.window = 0.2
+        self.debouncing.max_delay = 0.15
+        for ts in range(1, 5):
+            await self.debouncing.handle(update(ts, 1, {'$set': {'price': ts}}))
+            await asyncio.sleep(0.06)
+
+        self.on_update.assert_called_once_with(
+            update(3, 1, {'$set': {'price': 3}})
+        )
+        self.assertIn(('db.xablau', 1), self.debouncing.pending)
+
+    async def test_last_timestamp_stays_before_the_first_pending_update(self):
+        await self.debouncing.handle_batch([
+            insert(1, 1),
+            update(2, 1, {'$set': {'price': 1}}),
+            insert(3, 2),
+        ])
+
+        self.assertEqual(self.debouncing.last_timestamp, Timestamp(1, 1))
+
+    async def test_other_operations_are_handled_after_the_pending_ones(self):
+        await self.debouncing.handle_batch([
+            update(1, 1, {'$set': {'price': 1}}),
+            update(2, 1, {'$inc': {'views': 1}}),
+            update(3, 2, {'$set': {'price': 1}}),
+            delete(4, 2),
+        ])
+
+        self.assertEqual(self.on_update.call_args_list, [
+            call(update(1, 1, {'$set': {'price': 1}})),
+            call(update(2, 1, {'$inc': {'views': 1}})),
+        ])
+        self.handler.handlers[Operations.DELETE].assert_called_once_with(
+            delete(4, 2)
+        )
+        self.assertEqual(self.debouncing.last_timestamp, Timestamp(1, 4))
+
+    async def test_oldest_document_is_handled_when_max_pending_is_exceeded(self):
+        await self.debouncing.handle_batch([
+            update(ts, ts, {'$set': {'price': ts}}) for ts in range(1, 4)
+        ])
+
+        self.on_update.assert_called_once_with(
+            update(1, 1, {'$set': {'price': 1}})
+        )
+        self.assertEqual(len(self.debouncing.pending), 2)
+
+        await self.debouncing.flush()
+        self.assertEqual(self.on_update.call_count, 3)
+        self.assertEqual(self.debouncing.last_timestamp, Timestamp(1, 3))
+
+    async def test_documents_with_compound_ids_are_handled_right_away(self):
+        operation = update(1, {'seller': 1, 'sku': 2}, {'$set': {'price': 1}})
+
+        await self.debouncing.handle_batch([operation])
+
+        self.on_update.assert_called_once_with(operation)
+        self.assertEqual(self.debouncing.last_timestamp, Timestamp(1, 1))
@@ -0,0 +1,13 @@
+import asynctest
+
+from mongo_observer.cursors import fetch_batch
+from tests.unit.utils import AsyncIterMockCursor
+
+
+class FetchBatchTests(asynctest.TestCase):
+    async def test_each_network_batch_is_fetched_at_once(self):
+        cursor = AsyncIterMockCursor(range(5), batch_size=2)
+
+        batches = [await fetch_batch(cursor) for _ in range(4)]
+
+        self.assertEqual(batches, [[0, 1], [2, 3], [4], []])
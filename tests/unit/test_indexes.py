@@ -0,0 +1,170 @@
+import random
+
+import asynctest
+from bson import ObjectId
+
+from mongo_observer.indexes import HashIndex, SortedIndex, SortedList, \
+    index_key, overlaps
+from mongo_observer.models import Document, path_values
+from mongo_observer.operation_handlers import ReactiveCollection
+
+
+def insert(ts, doc):
+    return {'op': 'i', 'ts': ts, 'o': doc}
+
+
+def update(ts, _id, change):
+    return {'op': 'u', 'ts': ts, 'o': change, 'o2': {'_id': _id}}
+
+
+def delete(ts, _id):
+    return {'op': 'd', 'ts': ts, 'o': {'_id': _id}}
+
+
+class PathValuesTests(asynctest.TestCase):
+    def test_it_traverses_embedded_documents_and_arrays(self):
+        doc = {'seller': {'offers': [{'price': 10}, {'price': 20}, {}]},
+               'tags': ['a', 'b']}
+
+        self.assertEqual(path_values(doc, 'seller.offers.price'), [10, 20])
+        self.assertEqual(path_values(doc, 'seller.offers.1.price'), [20])
+        self.assertEqual(path_values(doc, 'tags'), [['a', 'b'], 'a', 'b'])
+        self.assertEqual(path_values(doc, 'seller.name'), [])
+
+
+class IndexKeyTests(asynctest.TestCase):
+    def test_keys_follow_bson_comparison_order(self):
+        values = [True, ObjectId(), 'a', {'a': 1}, 1.5, None, 1]
+
+        self.assertEqual(sorted(values, key=index_key),
+                         [None, 1, 1.5, 'a', {'a': 1}, values[1], True])
+
+    def test_numbers_have_equal_keys(self):
+        self.assertEqual(index_key(1), index_key(1.0))
+        self.assertNotEqual(index_key(1), index_key(True))
+
+    def test_overlapping_paths(self):
+        self.assertTrue(overlaps('seller', 'seller.price'))
+        self.assertTrue(overlaps('offers.3.price', 'offers.price'))
+        self.assertFalse(overlaps('seller.price', 'seller.priced'))
+
+
+class HashIndexTests(asynctest.TestCase):
+    def test_it_looks_up_documents_by_any_of_their_values(self):
+        index = HashIndex('tags')
+        index.build({1: {'tags': ['a', 'b']}, 2: {'tags': 'b'}, 3: {}})
+
+        self.assertEqual(index.lookup('a'), [1])
+        self.assertCountEqual(index.lookup('b'), [1, 2])
+        self.assertEqual(index.lookup(['a', 'b']), [1])
+        self.assertEqual(index.lookup(None), [3])
+
+        index.remove(1, {'tags': ['a', 'b']})
+        self.assertEqual(index.lookup('a'), [])
+        self.assertNotIn(index_key('a'), index.ids)
+
+
+class SortedListTests(asynctest.TestCase):
+    def test_it_keeps_items_sorted_across_buckets(self):
+        items = SortedList(bucket_size=2)
+        expected = []
+        for item in random.Random(0).sample(range(100), 50):
+            items.add(item)
+            expected.append(item)
+        expected.sort()
+        for item in expected[::3]:
+            del items[items.bisect_left(item)]
+        del expected[::3]
+
+        self.assertEqual(list(items), expected)
+        self.assertEqual(len(items), len(expected))
+        self.assertTrue(all(len(bucket) <= 4 for bucket in items.buckets))
+
+        start, stop = items.bisect_left(20), items.bisect_right(60)
+        in_range = [item for item in expected if 20 <= item <= 60]
+        self.assertEqual(list(items.islice(start, stop)), in_range)
+        self.assertEqual(list(items.islice(start, stop, reverse=True)),
+                         in_range[::-1])
+        self.assertEqual(items.bisect_left(1000), items.end())
+
+    def test_update_rebuilds_the_buckets(self):
+        items = SortedList(bucket_size=2)
+        items.add(3)
+        items.update([5, 1, 4, 2])
+
+        self.assertEqual(list(items), [1, 2, 3, 4, 5])
+        self.assertEqual(items.maxes, [2, 4, 5])
+
+
+class SortedIndexTests(asynctest.TestCase):
+    def setUp(self):
+        self.index = SortedIndex('price')
+        self.index.build({1: {'price': 30}, 2: {'price': 10.5},
+                          3: {'price': 'free'}, 4: {}, 5: {'price': [20, 40]}})
+
+    def test_ranges_match_values_of_the_bounds_type(self):
+        self.assertEqual(self.index.range(gt=10), [2, 5, 1])
+        self.assertEqual(self.index.range(gte=20, lte=30), [5, 1])
+        self.assertEqual(self.index.range(lt=30, reverse=True), [5, 2])
+        self.assertEqual(self.index.range(gte='a'), [3])
+        self.assertEqual(self.index.lookup(40), [5])
+
+    def test_documents_are_ordered_as_sorted_by_mongo(self):
+        self.assertEqual(list(self.index.ordered()), [4, 2, 5, 1, 3])
+        self.assertEqual(list(self.index.ordered(reverse=True)),
+                         [3, 5, 1, 2, 4])
+
+    def test_added_and_removed_documents(self):
+        self.index.add(6, {'price': 15})
+        self.index.remove(5, {'price': [20, 40]})
+
+        self.assertEqual(self.index.range(gt=10), [2, 6, 1])
+
+
+class ReactiveCollectionIndexesTests(asynctest.TestCase):
+    def setUp(self):
+        self.replica = ReactiveCollection(
+            collection={1: Document({'_id': 1, 'seller': {'id': 'a',
+                                                         'price': 10}})},
+            remote_collection=asynctest.Mock()
+        )
+        self.replica.create_index('seller.id')
+        self.replica.create_index('seller.price', sorted=True)
+
+    def ids(self, docs):
+        return [doc['_id'] for doc in docs]
+
+    async def test_indexes_are_built_from_existing_documents(self):
+        self.assertEqual(self.ids(self.replica.lookup('seller.id', 'a')), [1])
+        self.assertEqual(
+            self.ids(self.replica.lookup_range('seller.price', lte=10)), [1]
+        )
+
+    async def test_operations_keep_indexes_up_to_date(self):
+        await self.replica.handle_batch([
+            insert(1, {'_id': 2, 'seller': {'id': 'b', 'price': 5}}),
+            update(2, 1, {'$set': {'seller.price': 20}}),
+            update(3, 2, {'$unset': {'seller': 1}}),
+            insert(4, {'_id': 3, 'seller': {'id': 'a', 'price': 15}}),
+        ])
+
+        self.assertEqual(self.ids(self.replica.lookup('seller.id', 'b')), [])
+        self.assertEqual(self.ids(self.replica.lookup('seller.id', None)), [2])
+        self.assertEqual(
+            self.ids(self.replica.lookup_range('seller.price', gt=0)), [3, 1]
+        )
+
+        await self.replica.handle(delete(5, 1))
+
+        self.assertEqual(self.ids(self.replica.lookup('seller.id', 'a')), [3])
+        self.assertEqual(
+            self.ids(self.replica.lookup_range('seller.price', gt=0)), [3]
+        )
+
+    async def test_updates_on_other_paths_dont_touch_indexes(self):
+        index = self.replica.indexes['seller.id']
+        index.remove = asynctest.Mock()
+
+        await self.replica.handle(update(1, 1, {'$set': {'stock': 3}}))
+
+        index.remove.assert_not_called()
@@ -0,0 +1,227 @@
+import asyncio
+
+from asynctest import TestCase, Mock, CoroutineMock
+from bson import Timestamp, ObjectId
+
+from mongo_observer.initial_sync import split_ranges, load_collection
+from mongo_observer.models import Operations
+from mongo_observer.operation_handlers import ReactiveCollection, \
+    ReactivePartialCollection
+from tests.unit.utils import AsyncIterMockCursor
+
+
+def mock_remote_collection(docs, sampled_ids):
+    def find(filter, **kwargs):
+        bounds = filter.get('_id', {})
+        return AsyncIterMockCursor(
+            [doc for doc in docs
+             if ('$gte' not in bounds or doc['_id'] >= bounds['$gte']) and
+             ('$lt' not in bounds or doc['_id'] < bounds['$lt']) and
+             '$not' not in bounds],
+            batch_size=kwargs.get('batch_size')
+        )
+
+    return Mock(name='xablau',
+                find=Mock(side_effect=find),
+                aggregate=Mock(side_effect=lambda pipeline: AsyncIterMockCursor(
+                    [{'_id': _id} for _id in sampled_ids]
+                )),
+                estimated_document_count=CoroutineMock(return_value=len(docs)))
+
+
+class SplitRangesTests(TestCase):
+    async def test_sampled_ids_split_the_id_space(self):
+        remote = mock_remote_collection([], sampled_ids=range(100))
+
+        ranges = await split_ranges(remote, partitions=4)
+
+        self.assertEqual(ranges, [
+            {'_id': {'$lt': 25}},
+            {'_id': {'$gte': 25, '$lt': 50}},
+            {'_id': {'$gte': 50, '$lt': 75}},
+            {'_id': {'$gte': 75}},
+            {'_id': {'$not': {'$type': 'number'}}},
+        ])
+
+    async def test_ids_of_mixed_types_arent_split(self):
+        remote = mock_remote_collection([], sampled_ids=[1, 'a', ObjectId()])
+
+        self.assertEqual(await split_ranges(remote, partitions=4), [{}])
+
+    async def test_a_single_partition_isnt_split(self):
+        remote = mock_remote_collection([], sampled_ids=range(100))
+
+        self.assertEqual(await split_ranges(remote, partitions=1), [{}])
+        remote.aggregate.assert_not_called()
+
+
+class LoadCollectionTests(TestCase):
+    async def test_every_range_is_loaded_and_progress_is_reported(self):
+        docs = [{'_id': _id, 'v': _id} for _id in range(100)]
+        remote = mock_remote_collection(docs, sampled_ids=range(0, 100, 5))
+        on_progress = Mock()
+
+        collection = await load_collection(remote,
+                                           partitions=4,
+                                           batch_size=10,
+                                           on_progress=on_progress)
+
+        self.assertEqual(collection, {_id: {'_id': _id, 'v': _id}
+                                      for _id in range(100)})
+        self.assertEqual(remote.find.call_count, 5)
+        on_progress.assert_called_with(100, 100)
+        # 3 batches of each one of the 4 ranges
+        self.assertEqual(on_progress.call_count, 12)
+
+    async def test_only_documents_matching_the_query_are_loaded(self):
+        remote = Mock(name='xablau',
+                      find=Mock(return_value=AsyncIterMockCursor([{'_id': 1}])),
+                      aggregate=Mock(return_value=AsyncIterMockCursor(
+                          [{'_id': _id} for _id in range(10)]
+                      )),
+                      count_documents=CoroutineMock(return_value=1))
+        query = {'active': True}
+
+        collection = await load_collection(remote, partitions=2, query=query)
+
+        self.assertEqual(collection, {1: {'_id': 1}})
+        remote.count_documents.assert_called_once_with(query)
+        self.assertEqual(remote.aggregate.call_args[0][0][0], {'$match': query})
+        self.assertEqual(remote.find.call_args_list[0][0][0],
+                         {'$and': [{'_id': {'$lt': 5}}, query]})
+
+
+class ReactiveCollectionInitAsyncTests(TestCase):
+    async def test_last_timestamp_is_the_newest_oplog_entry_before_the_load(self):
+        remote = mock_remote_collection([{'_id': 1}], sampled_ids=[1])
+        oplog = Mock(find_one=CoroutineMock(return_value={'ts': Timestamp(6, 6)}))
+
+        replica = await ReactiveCollection.init_async(remote, oplog=oplog)
+
+        self.assertEqual(replica.last_timestamp, Timestamp(6, 6))
+        self.assertEqual(dict(replica.collection[1]), {'_id': 1})
+
+
+class BlockingCursor(AsyncIterMockCursor):
+    """
+    Returns its documents as a single batch, once `release` is set
+    """
+    def __init__(self, seq):
+        super().__init__(seq)
+        self.release = asyncio.Event()
+
+    async def _get_more(self):
+        await self.release.wait()
+        return await super()._get_more()
+
+
+class ReactiveCollectionInitBackgroundTests(TestCase):
+    async def setUp(self):
+        self.loader = BlockingCursor([{'_id': 1, 'v': 1}, {'_id': 2, 'v': 1}])
+        self.remote_docs = {1: {'_id': 1, 'v': 2}, 2: {'_id': 2, 'v': 2},
+                            3: {'_id': 3, 'v': 2}}
+
+        def find(filter, **kwargs):
+            if not filter:
+                return self.loader
+            return AsyncIterMockCursor([self.remote_docs[_id]
+                                        for _id in filter['_id']['$in']
+                                        if _id in self.remote_docs])
+
+        self.remote = Mock(find=Mock(side_effect=find),
+                           estimated_document_count=CoroutineMock(return_value=2))
+        self.replica = await ReactiveCollection.init_background(self.remote,
+                                                                partitions=1)
+
+    async def tearDown(self):
+        self.loader.release.set()
+        await self.replica.ready
+
+    async def test_lookups_fall_through_to_a_batched_remote_fetch(self):
+        docs = await asyncio.gather(self.replica.get(1),
+                                    self.replica.get(3),
+                                    self.replica.get(4))
+
+        self.assertEqual([doc and dict(doc) for doc in docs],
+                         [{'_id': 1, 'v': 2}, {'_id': 3, 'v': 2}, None])
+        self.remote.find.assert_called_with({'_id': {'$in': [1, 3, 4]}},
+                                            projection=None,
+                                            batch_size=3)
+        self.assertFalse(self.replica.ready.done())
+        self.assertEqual(self.replica.percentage, 0)
+
+    async def test_documents_touched_while_loading_are_fetched_again(self):
+        await asyncio.sleep(0)
+        await self.replica.handle_batch([
+            {'op': Operations.UPDATE, 'ts': Timestamp(1, 1),
+             'o': {'$set': {'v': 2}}, 'o2': {'_id': 2}},
+        ])
+        self.assertNotIn(2, self.replica.collection)
+
+        self.loader.release.set()
+        await self.replica.ready
+
+        self.assertEqual(dict(self.replica.collection[1]), {'_id': 1, 'v': 1})
+        self.assertEqual(dict(self.replica.collection[2]), {'_id': 2, 'v': 2})
+        self.remote.find.assert_called_with({'_id': {'$in': [2]}},
+                                            projection=None,
+                                            batch_size=1)
+        self.assertEqual(self.replica.percentage, 100)
+
+
+class ReactivePartialCollectionInitBackgroundTests(TestCase):
+    async def setUp(self):
+        self.query = {'active': True}
+        self.loader = BlockingCursor([{'_id': 1, 'active': True},
+                                      {'_id': 2, 'active': True}])
+        self.remote_docs = {1: {'_id': 1, 'active': True},
+                            2: {'_id': 2, 'active': False},
+                            3: {'_id': 3, 'active': True}}
+
+        def find(filter, **kwargs):
+            if filter == self.query:
+                return self.loader
+            ids, query = filter['$and']
+            return AsyncIterMockCursor([self.remote_docs[_id]
+                                        for _id in ids['_id']['$in']
+                                        if _id in self.remote_docs and
+                                        self.remote_docs[_id]['active']])
+
+        self.remote = Mock(find=Mock(side_effect=find),
+                           count_documents=CoroutineMock(return_value=2))
+        self.replica = await ReactivePartialCollection.init_background(
+            self.remote, self.query, partitions=1
+        )
+
+    async def tearDown(self):
+        self.loader.release.set()
+        await self.replica.ready
+
+    async def test_only_documents_matching_the_query_are_fetched(self):
+        docs = await asyncio.gather(self.replica.get(2), self.replica.get(3))
+
+        self.assertEqual([doc and dict(doc) for doc in docs],
+                         [None, {'_id': 3, 'active': True}])
+        self.remote.find.assert_called_with(
+            {'$and': [{'_id': {'$in': [2, 3]}}, self.query]},
+            projection=None,
+            batch_size=2
+        )
+        self.remote.count_documents.assert_awaited_once_with(self.query)
+
+    async def test_documents_touched_while_loading_are_fetched_again(self):
+        await asyncio.sleep(0)
+        await self.replica.handle_batch([
+            {'op': Operations.UPDATE, 'ts': Timestamp(1, 1),
+             'o': {'$set': {'active': False}}, 'o2': {'_id': 2}},
+        ])
+
+        self.loader.release.set()
+        await self.replica.ready
+
+        self.assertEqual(list(self.replica.collection), [1])
+        self.remote.find.assert_called_with(
+            {'$and': [{'_id': {'$in': [2]}}, self.query]},
+            projection=None,
+            batch_size=1
+        )
@@ -0,0 +1,99 @@
+import time
+import unittest
+
+import asynctest
+from bson import Timestamp
+
+from mongo_observer.metrics import Histogram, ObserverMetrics
+from mongo_observer.models import Document
+from mongo_observer.operation_handlers import ReactiveCollection
+
+
+class HistogramTests(unittest.TestCase):
+    def test_values_are_counted_on_cumulative_buckets(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.cumulative_counts(),
+                         [('1', 2), ('10', 3), ('+Inf', 4)])
+        self.assertEqual(histogram.sum, 56.5)
+        self.assertEqual(histogram.count, 4)
+
+
+class ObserverMetricsTests(asynctest.TestCase):
+    def setUp(self):
+        self.metrics = ObserverMetrics()
+        self.now = int(time.time())
+        self.batch = [
+            {'ts': Timestamp(self.now - 10, 1), 'op': 'i', 'ns': 'pets.dogs'},
+            {'ts': Timestamp(self.now - 10, 2), 'op': 'u'},
+        ]
+
+    def test_record_batch_counts_operations_and_measures_lag(self):
+        self.metrics.record_batch(self.batch, namespace='pets.cats')
+
+        self.assertEqual(self.metrics.operations, {('pets.dogs', 'i'): 1,
+                                                   ('pets.cats', 'u'): 1})
+        self.assertEqual(self.metrics.batch_sizes.count, 1)
+        self.assertAlmostEqual(self.metrics.lag, 10, delta=1)
+
+    def test_lag_keeps_growing_while_nothing_is_handled(self):
+        self.assertIsNone(self.metrics.snapshot()['lag'])
+        self.metrics.record_batch(self.batch)
+
+        with asynctest.patch('mongo_observer.metrics.time.time',
+                             return_value=self.now + 50):
+            self.assertEqual(self.metrics.snapshot()['lag'], 60)
+            self.assertIn('mongo_observer_replication_lag_seconds 60\n',
+                          self.metrics.to_prometheus())
+
+    def test_snapshot_measures_throughput_since_previous_snapshot(self):
+        self.metrics.snapshot()
+        self.metrics.record_batch(self.batch, namespace='pets.cats')
+        snapshot = self.metrics.snapshot()
+
+        self.assertEqual(snapshot['operations'], {('pets.dogs', 'i'): 1,
+                                                  ('pets.cats', 'u'): 1})
+        self.assertGreater(snapshot['operations_per_second'][('pets.dogs', 'i')], 0)
+        self.assertEqual(snapshot['reconnects'], 0)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['operations_per_second'][('pets.dogs', 'i')], 0)
+
+    async def test_instrumented_handlers_record_their_latency(self):
+        handler = ReactiveCollection({1: Document({'_id': 1})}, asynctest.Mock())
+        self.metrics.instrument(handler)
+
+        await handler.handle_batch([
+            {'ts': Timestamp(self.now, 1), 'op': 'i', 'o': {'_id': 2}},
+            {'ts': Timestamp(self.now, 2), 'op': 'd', 'o': {'_id': 1}},
+        ])
+        await handler.handle(
+            {'ts': Timestamp(self.now, 3), 'op': 'd', 'o': {'_id': 2}}
+        )
+
+        latencies = self.metrics.handler_latencies
+        self.assertEqual(latencies['on_insert'].count, 1)
+        self.assertEqual(latencies['on_delete'].count, 2)
+        self.assertEqual(latencies['on_update'].count, 0)
+        self.assertEqual(handler.collection, {})
+
+    def test_prometheus_exposition(self):
+        self.metrics.reconnect_scheduler = asynctest.Mock(reconnects=3)
+        self.metrics.record_batch(self.batch[:1])
+        self.metrics._latency('i').observe(0.002)
+
+        text = self.metrics.to_prometheus()
+
+        self.assertIn('mongo_observer_operations_total'
+                      '{namespace="pets.dogs",op="i"} 1\n', text)
+        self.assertIn('mongo_observer_reconnects_total 3\n', text)
+        self.assertIn('mongo_observer_cursor_batch_size_bucket{le="1"} 1\n', text)
+        self.assertIn('mongo_observer_cursor_batch_size_count 1\n', text)
+        self.assertIn('mongo_observer_handler_latency_seconds_bucket'
+                      '{method="on_insert",le="0.005"} 1\n', text)
+        self.assertIn('mongo_observer_handler_latency_seconds_count'
+                      '{method="on_insert"} 1\n', text)
+        self.assertIn('# TYPE mongo_observer_replication_lag_seconds gauge\n'
+                      'mongo_observer_replication_lag_seconds ', text)
@@ -1,6 +1,11 @@
 import unittest
 
-from mongo_observer.models import NullableList, Document
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from mongo_observer.models import NullableList, Document, document_id, decoded, \
+    plain
 
 
 class NullableListTests(unittest.TestCase):
@@ -25,3 +30,42 @@ class DocumentTests(unittest.TestCase):
 
         doc['y.m.c.a'] = "Village People"
         self.assertEqual(doc['y']['m']['c']['a'], "Village People")
+
+
+class DocumentIdTests(unittest.TestCase):
+    def test_it_returns_o2_id_for_updates(self):
+        operation = {'op': 'u', 'o': {'$set': {'dog': 'Xena'}}, 'o2': {'_id': 1}}
+        self.assertEqual(document_id(operation), 1)
+
+    def test_it_returns_o_id_for_inserts_and_deletes(self):
+        self.assertEqual(document_id({'op': 'i', 'o': {'_id': 1, 'dog': 'Xablau'}}), 1)
+        self.assertEqual(document_id({'op': 'd', 'o': {'_id': 2}}), 2)
+
+    def test_it_returns_none_for_operations_without_a_document(self):
+        self.assertIsNone(document_id({'op': 'n', 'o': {'msg': 'periodic noop'}}))
+
+
+class DecodedTests(unittest.TestCase):
+    def test_raw_bson_documents_are_fully_decoded(self):
+        data = {'dog': {'name': 'Xablau', 'siblings': [{'name': 'Xena'}]}}
+        raw = RawBSONDocument(bson.encode(data),
+                              CodecOptions(document_class=RawBSONDocument))
+
+        document = decoded(raw)
+        self.assertEqual(document, data)
+        self.assertIs(type(document['dog']['siblings'][0]), dict)
+
+    def test_dicts_are_returned_as_they_are(self):
+        data = {'dog': 'Xablau'}
+        self.assertIs(decoded(data), data)
+
+
+class PlainTests(unittest.TestCase):
+    def test_documents_are_converted_to_plain_dicts_and_lists(self):
+        doc = Document({'dog': {'siblings': ['Xena', {'toys': [1, 2]}]}})
+        converted = plain(doc)
+
+        self.assertEqual(converted, {'dog': {'siblings': ['Xena', {'toys': [1, 2]}]}})
+        self.assertIs(type(converted), dict)
+        self.assertIs(type(converted['dog']['siblings']), list)
+        bson.encode(converted)
@@ -1,8 +1,19 @@
+import asyncio
+
 from pymongo import DESCENDING, CursorType
-from asynctest import TestCase, CoroutineMock, Mock, patch, call
+from bson import Timestamp
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import AutoReconnect
+from asynctest import TestCase, CoroutineMock, Mock, MagicMock, patch, call, \
+    ANY
 
-from mongo_observer.observer import Observer, ShouldStopObservation
-from tests.unit.utils import AsyncIterMockCursor
+from mongo_observer import conf
+from mongo_observer.observer import Observer, ShouldStopObservation, \
+    MultiplexObserver
+from mongo_observer.operation_handlers import NamespaceRouter, \
+    OperationHandler, PartitionedOperationHandler
+from tests.unit.utils import AsyncIterMockCursor, mock_handler, mock_oplog
 
 
 class ObserverTests(TestCase):
@@ -12,7 +23,7 @@ class ObserverTests(TestCase):
         # noinspection PyTypeChecker
         observer = await Observer.init_async(
             oplog=Mock(),
-            operation_handler=Mock(),
+            operation_handler=mock_handler(),
             namespace_filter=ns,
             starting_timestamp=ts)
         self.assertEqual(observer.filter, {'ns': ns, 'ts': {'$gt': ts}})
@@ -22,72 +33,424 @@ class ObserverTests(TestCase):
         # noinspection PyTypeChecker
         observer = await Observer.init_async(
             oplog=Mock(),
-            operation_handler=Mock(),
+            operation_handler=mock_handler(),
             starting_timestamp=ts)
         self.assertEqual(observer.filter, {'ts': {'$gt': ts}})
 
+    async def test_handler_requirements_are_pushed_down_to_the_oplog_query(self):
+        handler = mock_handler(operation_types={'u', 'i'}, oplog_fields=('o',))
+        # noinspection PyTypeChecker
+        observer = await Observer.init_async(
+            oplog=Mock(),
+            operation_handler=handler,
+            namespace_filter='pets.dogs',
+            starting_timestamp=1)
+
+        self.assertEqual(observer.filter, {'ns': 'pets.dogs',
+                                           'op': {'$in': ['i', 'u']},
+                                           'ts': {'$gt': 1}})
+        self.assertEqual(observer.projection, {'ts': 1, 'op': 1, 'o': 1})
+
+    async def test_raw_bson_oplog_entries_are_fetched_as_raw_documents(self):
+        oplog = Mock(codec_options=CodecOptions())
+        # noinspection PyTypeChecker
+        observer = await Observer.init_async(oplog=oplog,
+                                             operation_handler=mock_handler(),
+                                             starting_timestamp=1,
+                                             raw_bson=True)
+
+        oplog.with_options.assert_called_once_with(
+            codec_options=CodecOptions(document_class=RawBSONDocument)
+        )
+        self.assertEqual(observer.oplog, oplog.with_options.return_value)
+
     async def test_get_new_cursor_return_a_new_tailable_cursor(self):
         oplog = Mock()
-        observer = await Observer.init_async(oplog, Mock(), Mock(), Mock())
+        observer = await Observer.init_async(oplog, mock_handler(), Mock(), Mock())
         cursor = observer.get_new_cursor()
 
         self.assertEqual(cursor, oplog.find.return_value)
         oplog.find.assert_called_once_with(observer.filter,
-                                           cursor_type=CursorType.TAILABLE_AWAIT)
+                                           observer.projection,
+                                           cursor_type=CursorType.TAILABLE_AWAIT,
+                                           oplog_replay=True)
 
     async def test_init_async_gets_last_document_ts_if_starting_ts_isnt_provided(self):
-        oplog = CoroutineMock()
+        oplog = Mock(find_one=CoroutineMock())
         timestamp = Mock()
         oplog.find_one.return_value = {'ts': timestamp}
-        observer = await Observer.init_async(oplog, Mock(), Mock())
+        observer = await Observer.init_async(oplog, mock_handler(), Mock())
 
         oplog.find_one.assert_called_once_with(sort=[('$natural', DESCENDING)])
         self.assertEqual(observer.filter['ts'], {'$gt': timestamp})
 
+    async def test_init_async_resumes_from_checkpoint_if_theres_one(self):
+        oplog = Mock(find_one=CoroutineMock())
+        timestamp = Mock()
+        checkpoint_store = Mock(load=CoroutineMock(return_value=timestamp))
+        observer = await Observer.init_async(oplog, mock_handler(), Mock(),
+                                             checkpoint_store=checkpoint_store)
+
+        oplog.find_one.assert_not_called()
+        self.assertEqual(observer.filter['ts'], {'$gt': timestamp})
+
+    async def test_init_async_gets_last_document_ts_if_theres_no_checkpoint(self):
+        oplog = Mock(find_one=CoroutineMock(return_value={'ts': 1}))
+        checkpoint_store = Mock(load=CoroutineMock(return_value=None))
+        observer = await Observer.init_async(oplog, mock_handler(), Mock(),
+                                             checkpoint_store=checkpoint_store)
+
+        self.assertEqual(observer.filter['ts'], {'$gt': 1})
+
 
 class ObserverObserveChangesTests(TestCase):
     async def setUp(self):
-        self.oplog = CoroutineMock()
-        self.handler = CoroutineMock()
+        self.oplog = mock_oplog()
+        self.handler = mock_handler()
+
+        self.reconnect_scheduler = Mock(wait=CoroutineMock(), attempts=0)
+        self.stop_infinite_iteration = CoroutineMock(
+            side_effect=ShouldStopObservation
+        )
 
         # noinspection PyTypeChecker
         self.observer = await Observer.init_async(
             oplog=self.oplog,
             operation_handler=self.handler,
             starting_timestamp=Mock(),
-            on_nothing_to_fetch_on_cursor=self.stop_infinite_iteration
+            on_nothing_to_fetch_on_cursor=self.stop_infinite_iteration,
+            reconnect_scheduler=self.reconnect_scheduler
         )
 
-    async def stop_infinite_iteration(self):
-        raise ShouldStopObservation()
-
     async def test_it_calls_handler_if_theres_a_document_to_fetch_on_cursor(self):
-        document = Mock()
+        document = MagicMock()
         cursor = AsyncIterMockCursor([document])
 
         with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
-            with self.assertRaises(ShouldStopObservation):
-                await self.observer.observe_changes()
+            await self.observer.observe_changes()
+
+            self.stop_infinite_iteration.assert_awaited_once_with()
+            self.handler.handle_batch.assert_called_once_with([document])
+
+    async def test_it_calls_handler_once_for_each_cursor_batch(self):
+        documents = [MagicMock() for _ in range(5)]
+        cursor = AsyncIterMockCursor(documents, batch_size=3)
 
-            self.handler.handle.assert_called_once_with(operation=document)
+        with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
+            await self.observer.observe_changes()
+
+            self.assertEqual(self.handler.handle_batch.call_args_list,
+                             [call(documents[:3]), call(documents[3:])])
 
     async def test_it_doesnt_call_handler_if_theres_nothing_to_fetch_on_cursor(self):
         cursor = AsyncIterMockCursor([])
 
         with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
-            with self.assertRaises(ShouldStopObservation):
+            await self.observer.observe_changes()
+
+            self.stop_infinite_iteration.assert_awaited_once_with()
+            self.handler.handle_batch.assert_not_called()
+
+    async def test_background_failures_stop_observation_on_an_idle_oplog(self):
+        class FailingHandler(OperationHandler):
+            async def on_insert(self, operation):
+                raise ValueError('Xablau')
+
+            on_update = on_delete = on_insert
+
+        handler = PartitionedOperationHandler(FailingHandler(), concurrency=2)
+        idle_polls = 0
+
+        async def on_nothing_to_fetch():
+            nonlocal idle_polls
+            idle_polls += 1
+            if idle_polls > 10:
+                raise ShouldStopObservation
+            await asyncio.sleep(0)
+
+        self.observer.operation_handler = handler
+        self.observer.on_nothing_to_fetch_on_cursor = on_nothing_to_fetch
+        cursor = AsyncIterMockCursor([{'op': 'i', 'ts': 1, 'o': {'_id': 1}}])
+        with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
+            workers = None
+
+            async def started():
+                nonlocal workers
+                while not handler.workers:
+                    await asyncio.sleep(0)
+                workers = handler.workers
+
+            asyncio.ensure_future(started())
+            with self.assertRaises(ValueError):
                 await self.observer.observe_changes()
 
-            self.handler.handle.assert_not_called()
+        self.assertLessEqual(idle_polls, 10)
+        self.assertEqual(handler.workers, [])
+        self.assertTrue(all(worker.done() for worker in workers))
+
+    async def test_it_checkpoints_handler_last_timestamp_after_each_batch(self):
+        self.handler.last_timestamp = 2
+        self.observer.checkpoint_store = Mock(checkpoint=CoroutineMock(),
+                                              flush=CoroutineMock())
+        cursor = AsyncIterMockCursor([{'ts': 1}, {'ts': 2}])
+
+        with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
+            await self.observer.observe_changes()
+
+        self.observer.checkpoint_store.checkpoint.assert_called_once_with(2, 2)
+        self.observer.checkpoint_store.flush.assert_called_once_with()
+
+    async def test_it_records_metrics_of_handled_batches(self):
+        self.observer.metrics = Mock()
+        batch = [{'ts': 1}, {'ts': 2}]
+        cursor = AsyncIterMockCursor(batch)
+
+        with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
+            await self.observer.observe_changes()
+
+        self.observer.metrics.record_batch.assert_called_once_with(
+            batch, self.observer.namespace_filter
+        )
 
     async def test_it_gets_a_new_cursor_if_current_cursor_dies(self):
         dead_cursor = CoroutineMock(alive=False)
 
         with patch.object(self.observer, 'get_new_cursor',
                           side_effect=[dead_cursor, ShouldStopObservation]):
-            with self.assertRaises(ShouldStopObservation):
-                await self.observer.observe_changes()
+            await self.observer.observe_changes()
 
+            self.stop_infinite_iteration.assert_not_awaited()
             self.assertEqual(self.observer.get_new_cursor.call_args_list,
                              [call(), call()])
+        self.reconnect_scheduler.wait.assert_called_once_with()
+
+    async def test_it_schedules_a_new_cursor_if_connection_fails(self):
+        failed_cursor = AsyncIterMockCursor([])
+        failed_cursor._get_more = CoroutineMock(side_effect=AutoReconnect)
+        document = MagicMock()
+        cursor = AsyncIterMockCursor([document])
+
+        with patch.object(self.observer, 'get_new_cursor',
+                          side_effect=[failed_cursor, cursor]):
+            await self.observer.observe_changes()
+
+        self.reconnect_scheduler.wait.assert_called_once_with()
+        self.reconnect_scheduler.reset.assert_called_with()
+        self.handler.handle_batch.assert_called_once_with([document])
+
+
+
+class ObserverCatchUpTests(TestCase):
+    async def setUp(self):
+        self.handler = mock_handler(last_timestamp=None)
+        self.oplog = mock_oplog()
+        self.reconnect_scheduler = Mock(wait=CoroutineMock(), attempts=0)
+
+        # noinspection PyTypeChecker
+        self.observer = await Observer.init_async(
+            oplog=self.oplog,
+            operation_handler=self.handler,
+            starting_timestamp=Timestamp(1000, 1),
+            catch_up_threshold=60,
+            reconnect_scheduler=self.reconnect_scheduler
+        )
+
+    async def test_it_doesnt_catch_up_if_lag_is_below_threshold(self):
+        self.oplog.find_one.return_value = {'ts': Timestamp(1060, 1)}
+
+        self.assertEqual(await self.observer.catch_up(), 0)
+        self.oplog.find.assert_not_called()
+
+    async def test_it_drains_backlog_up_to_newest_entry_with_plain_cursors(self):
+        newest = Timestamp(2000, 1)
+        self.oplog.find_one.side_effect = [{'ts': newest}, {'ts': newest}]
+        backlog = [{'ts': Timestamp(1500, i)} for i in range(5)]
+        self.oplog.find.return_value = AsyncIterMockCursor(backlog, batch_size=2)
+
+        self.assertEqual(await self.observer.catch_up(), 5)
+
+        self.oplog.find.assert_called_once_with(
+            {'ts': {'$gt': Timestamp(1000, 1), '$lte': newest}},
+            None,
+            oplog_replay=True,
+            batch_size=conf.CATCH_UP_BATCH_SIZE
+        )
+        self.assertEqual(self.handler.handle_batch.call_args_list,
+                         [call(backlog[:2]), call(backlog[2:4]), call(backlog[4:])])
+        self.assertEqual(self.observer.resume_timestamp, newest)
+
+    async def test_it_resumes_draining_after_connection_failures(self):
+        newest = Timestamp(2000, 1)
+        self.oplog.find_one.side_effect = [AutoReconnect(), {'ts': newest},
+                                           {'ts': newest}, {'ts': newest}]
+        backlog = [{'ts': Timestamp(1500, i)} for i in range(4)]
+        failed_cursor = AsyncIterMockCursor(backlog[:2])
+        get_more = failed_cursor._get_more
+        failed_cursor._get_more = CoroutineMock(
+            side_effect=[get_more(), AutoReconnect()]
+        )
+        self.oplog.find.side_effect = [failed_cursor,
+                                       AsyncIterMockCursor(backlog[2:])]
+
+        self.assertEqual(await self.observer.catch_up(), 4)
+
+        self.assertEqual(self.reconnect_scheduler.wait.call_count, 2)
+        self.assertEqual(self.oplog.find.call_args_list[1][0][0]['ts']['$gt'],
+                         backlog[1]['ts'])
+        self.assertEqual(self.handler.handle_batch.call_args_list,
+                         [call(backlog[:2]), call(backlog[2:])])
+
+    async def test_stop_requests_while_catching_up_stop_observation(self):
+        self.handler.handle_batch.side_effect = ShouldStopObservation
+        self.oplog.find_one.return_value = {'ts': Timestamp(2000, 1)}
+        self.oplog.find.return_value = AsyncIterMockCursor(
+            [{'ts': Timestamp(1500, 1)}]
+        )
+
+        with patch.object(self.observer, 'get_new_cursor') as get_new_cursor:
+            await self.observer.observe_changes()
+
+        get_new_cursor.assert_not_called()
+        self.handler.handle_batch.assert_called_once_with(
+            [{'ts': Timestamp(1500, 1)}]
+        )
+
+
+class ObserverPipelinedObserveChangesTests(TestCase):
+    async def setUp(self):
+        self.handler = mock_handler()
+
+        # noinspection PyTypeChecker
+        self.observer = await Observer.init_async(
+            oplog=mock_oplog(),
+            operation_handler=self.handler,
+            starting_timestamp=Mock(),
+            on_nothing_to_fetch_on_cursor=self.stop_infinite_iteration,
+            prefetch_batches=1
+        )
+
+    async def stop_infinite_iteration(self):
+        raise ShouldStopObservation()
+
+    async def test_it_dispatches_every_fetched_batch_in_order(self):
+        documents = [MagicMock() for _ in range(5)]
+        cursor = AsyncIterMockCursor(documents, batch_size=2)
+
+        with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
+            await self.observer.observe_changes()
+
+        self.assertEqual(self.handler.handle_batch.call_args_list,
+                         [call(documents[:2]),
+                          call(documents[2:4]),
+                          call(documents[4:])])
+
+    async def test_reader_stops_fetching_while_prefetch_queue_is_full(self):
+        release_handler = asyncio.Event()
+        self.handler.handle_batch.side_effect = lambda batch: release_handler.wait()
+        cursor = AsyncIterMockCursor([MagicMock() for _ in range(5)], batch_size=1)
+
+        with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
+            observation = asyncio.ensure_future(self.observer.observe_changes())
+            await asyncio.sleep(0.01)
+
+            # one batch being handled, one queued and one waiting to be queued
+            self.assertEqual(len(cursor.pending), 2)
+
+            release_handler.set()
+            await observation
+
+        self.assertEqual(self.handler.handle_batch.call_count, 5)
+
+    async def test_it_propagates_handler_errors(self):
+        self.handler.handle_batch.side_effect = ValueError
+        cursor = AsyncIterMockCursor([MagicMock()])
+
+        with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
+            with self.assertRaises(ValueError):
+                await self.observer.observe_changes()
+
+    async def test_handler_stop_requests_stop_reading(self):
+        self.handler.handle_batch.side_effect = ShouldStopObservation
+        cursor = AsyncIterMockCursor([MagicMock() for _ in range(5)],
+                                     batch_size=1)
+
+        with patch.object(self.observer, 'get_new_cursor', return_value=cursor):
+            await asyncio.wait_for(self.observer.observe_changes(), timeout=1)
+
+        self.handler.handle_batch.assert_called_once_with(ANY)
+        # one batch handled, one queued and one waiting to be queued
+        self.assertEqual(len(cursor.pending), 2)
+
+
+class MultiplexObserverTests(TestCase):
+    async def setUp(self):
+        self.dogs = mock_handler()
+        self.router = NamespaceRouter({'pets.dogs': self.dogs})
+        self.oplog = mock_oplog()
+
+        # noinspection PyTypeChecker
+        self.observer = await MultiplexObserver.init_async(
+            oplog=self.oplog,
+            operation_handler=self.router,
+            starting_timestamp=1,
+            on_nothing_to_fetch_on_cursor=self.stop_infinite_iteration
+        )
+
+    async def stop_infinite_iteration(self):
+        raise ShouldStopObservation()
+
+    async def test_filter_includes_every_attached_namespace(self):
+        self.observer.attach('pets.cats', mock_handler())
+
+        self.assertEqual(self.observer.filter,
+                         {'ns': {'$in': ['pets.cats', 'pets.dogs']},
+                          'ts': {'$gt': 1}})
+        self.assertTrue(self.observer.cursor_outdated)
+
+    async def test_attaching_a_filtered_namespace_doesnt_renew_cursor(self):
+        self.observer.attach('pets.dogs', mock_handler())
+        self.assertFalse(self.observer.cursor_outdated)
+
+    async def test_attaching_a_handler_with_new_requirements_renews_cursor(self):
+        self.dogs.operation_types = {'i'}
+        self.dogs.oplog_fields = ('o',)
+        self.observer.push_down()
+
+        self.observer.attach('pets.dogs', mock_handler(operation_types={'d'},
+                                                       oplog_fields=('o',)))
+
+        self.assertEqual(self.observer.filter['op'], {'$in': ['d']})
+        self.assertEqual(self.observer.projection,
+                         {'ts': 1, 'op': 1, 'ns': 1, 'o': 1})
+        self.assertTrue(self.observer.cursor_outdated)
+
+    async def test_attaching_doesnt_renew_cursor_with_a_custom_filter(self):
+        observer = await MultiplexObserver.init_async(
+            oplog=self.oplog,
+            operation_handler=self.router,
+            namespace_filter={'$regex': '^pets\\.'},
+            starting_timestamp=1
+        )
+        observer.attach('pets.cats', mock_handler())
+
+        self.assertEqual(observer.filter['ns'], {'$regex': '^pets\\.'})
+        self.assertFalse(observer.cursor_outdated)
+
+    async def test_outdated_cursor_is_renewed_from_last_fetched_timestamp(self):
+        operations = [{'op': 'i', 'ts': 2, 'ns': 'pets.dogs', 'o': {'_id': 1}},
+                      {'op': 'i', 'ts': 3, 'ns': 'pets.cats', 'o': {'_id': 1}}]
+        first_cursor = AsyncIterMockCursor(operations[:1])
+        second_cursor = AsyncIterMockCursor(operations[1:])
+        cats = mock_handler()
+
+        async def attach_cats(batch):
+            self.observer.attach('pets.cats', cats)
+
+        self.dogs.handle_batch.side_effect = attach_cats
+        with patch.object(self.oplog, 'find',
+                          side_effect=[first_cursor, second_cursor]):
+            await self.observer.observe_changes()
 
+        self.assertFalse(first_cursor.alive)
+        self.assertEqual(self.observer.filter['ts'], {'$gt': 2})
+        cats.handle_batch.assert_called_once_with(operations[1:])
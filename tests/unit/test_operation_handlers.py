@@ -1,6 +1,15 @@
+import asyncio
+
 import asynctest
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 
-from mongo_observer.operation_handlers import OperationHandler
+from mongo_observer.models import Document
+from mongo_observer.observer import ShouldStopObservation
+from mongo_observer.operation_handlers import OperationHandler, \
+    ReactiveCollection, PartitionedOperationHandler, NamespaceRouter, \
+    ReactivePartialCollection
 
 
 class OperationHandlerTests(asynctest.TestCase):
@@ -49,3 +58,351 @@ class OperationHandlerTests(asynctest.TestCase):
         self.handler.on_update.assert_not_called()
         self.handler.on_insert.assert_not_called()
         self.handler.on_delete.assert_not_called()
+
+    def test_operation_types_are_the_handled_ones(self):
+        self.assertEqual(self.handler.operation_types, {'i', 'u', 'd'})
+        self.assertIsNone(self.handler.oplog_fields)
+
+    async def test_handle_batch_handles_each_operation_in_order(self):
+        operations = [{'op': 'i', 'ts': 1, 'o': {'_id': 1}},
+                      {'op': 'n', 'ts': 2, 'o': {}},
+                      {'op': 'd', 'ts': 3, 'o': {'_id': 1}}]
+        await self.handler.handle_batch(operations)
+
+        self.handler.on_insert.assert_called_once_with(operations[0])
+        self.handler.on_delete.assert_called_once_with(operations[2])
+        self.handler.on_update.assert_not_called()
+        self.assertEqual(self.handler.last_timestamp, 3)
+
+
+class ReactiveCollectionHandleBatchTests(asynctest.TestCase):
+    def setUp(self):
+        self.handler = ReactiveCollection(
+            collection={1: Document({'_id': 1, 'dog': 'Xablau'})},
+            remote_collection=asynctest.Mock()
+        )
+
+    async def test_it_applies_every_operation_of_the_batch(self):
+        await self.handler.handle_batch([
+            {'op': 'i', 'ts': 1, 'o': {'_id': 2, 'dog': 'Xena'}},
+            {'op': 'u', 'ts': 2, 'o': {'$set': {'dog': 'Fido'}},
+             'o2': {'_id': 1}},
+            {'op': 'n', 'ts': 3, 'o': {'msg': 'periodic noop'}},
+            {'op': 'd', 'ts': 4, 'o': {'_id': 2}},
+        ])
+
+        self.assertEqual(self.handler.collection, {1: {'_id': 1, 'dog': 'Fido'}})
+        self.assertEqual(self.handler.last_timestamp, 4)
+
+    async def test_it_applies_raw_bson_operations(self):
+        options = CodecOptions(document_class=RawBSONDocument)
+        operations = [
+            {'op': 'i', 'ts': 1, 'o': {'_id': 2, 'dog': {'name': 'Xena'}}},
+            {'op': 'u', 'ts': 2, 'o': {'$set': {'dog.name': 'Fido'}},
+             'o2': {'_id': 2}},
+            {'op': 'd', 'ts': 3, 'o': {'_id': 1}},
+        ]
+        await self.handler.handle_batch([
+            RawBSONDocument(bson.encode(operation), options)
+            for operation in operations
+        ])
+
+        self.assertEqual(self.handler.collection,
+                         {2: {'_id': 2, 'dog': {'name': 'Fido'}}})
+        self.assertIs(type(self.handler.collection[2]), Document)
+
+    async def test_it_dispatches_to_overridden_handlers(self):
+        class NotifierCollection(ReactiveCollection):
+            on_update = asynctest.CoroutineMock()
+
+        handler = NotifierCollection(self.handler.collection, asynctest.Mock())
+        operation = {'op': 'u', 'ts': 1, 'o': {'$set': {'dog': 'Fido'}},
+                     'o2': {'_id': 1}}
+        await handler.handle_batch([operation])
+
+        handler.on_update.assert_called_once_with(operation)
+        self.assertEqual(handler.collection[1]['dog'], 'Xablau')
+
+
+class PartitionedOperationHandlerTests(asynctest.TestCase):
+    def setUp(self):
+        self.handled = []
+        self.releases = {}
+
+        class SlowHandler(OperationHandler):
+            async def on_insert(handler, operation):
+                await self.releases[operation['o']['_id']].wait()
+                if operation['o'].get('fail'):
+                    raise ValueError()
+                if operation['o'].get('stop'):
+                    raise ShouldStopObservation()
+                self.handled.append(operation['ts'])
+
+            on_update = on_insert
+            on_delete = on_insert
+
+        self.handler = PartitionedOperationHandler(SlowHandler(), concurrency=2)
+
+    async def tearDown(self):
+        await self.handler.stop()
+
+    def insert(self, _id, ts):
+        self.releases.setdefault(_id, asyncio.Event())
+        return {'op': 'i', 'ts': ts, 'o': {'_id': _id}}
+
+    async def test_operations_on_different_documents_run_in_parallel(self):
+        await self.handler.handle_batch([self.insert(0, 1), self.insert(1, 2)])
+        self.releases[1].set()
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.handled, [2])
+        self.assertIsNone(self.handler.last_timestamp)
+
+        self.releases[0].set()
+        await self.handler.join()
+
+        self.assertEqual(self.handled, [2, 1])
+        self.assertEqual(self.handler.last_timestamp, 2)
+
+    async def test_operations_on_the_same_document_keep_oplog_order(self):
+        await self.handler.handle_batch([self.insert(0, ts) for ts in range(1, 4)])
+        self.releases[0].set()
+        await self.handler.join()
+
+        self.assertEqual(self.handled, [1, 2, 3])
+        self.assertEqual(self.handler.last_timestamp, 3)
+
+    async def test_skipped_operations_advance_last_timestamp(self):
+        await self.handler.handle({'op': 'n', 'ts': 1, 'o': {}})
+
+        self.assertEqual(self.handler.last_timestamp, 1)
+
+    async def test_it_raises_handler_errors_on_next_handle(self):
+        operation = self.insert(0, 1)
+        operation['o']['fail'] = True
+        self.releases[0].set()
+        await self.handler.handle(operation)
+
+        with self.assertRaises(ValueError):
+            await self.handler.join()
+        with self.assertRaises(ValueError):
+            await self.handler.handle(self.insert(0, 2))
+        self.assertIsNone(self.handler.last_timestamp)
+
+    async def test_partitions_stop_on_their_first_error(self):
+        operation = self.insert(0, 1)
+        operation['o']['fail'] = True
+        await self.handler.handle_batch([operation, self.insert(0, 2)])
+        self.releases[0].set()
+
+        with self.assertRaises(ValueError):
+            await self.handler.join()
+        self.assertEqual(self.handled, [])
+
+    async def test_it_raises_stop_requests_on_next_handle(self):
+        operation = self.insert(0, 1)
+        operation['o']['stop'] = True
+        self.releases[0].set()
+        await self.handler.handle(operation)
+
+        with self.assertRaises(ShouldStopObservation):
+            await self.handler.join()
+        with self.assertRaises(ShouldStopObservation):
+            await self.handler.handle(self.insert(0, 2))
+        self.assertFalse(any(worker.done() for worker in self.handler.workers))
+
+
+class NamespaceRouterTests(asynctest.TestCase):
+    def setUp(self):
+        self.dogs = asynctest.Mock(handle=asynctest.CoroutineMock(),
+                                   handle_batch=asynctest.CoroutineMock())
+        self.cats = asynctest.Mock(handle=asynctest.CoroutineMock(),
+                                   handle_batch=asynctest.CoroutineMock())
+        self.router = NamespaceRouter({'pets.dogs': self.dogs})
+
+    async def test_it_routes_operations_by_namespace(self):
+        operation = {'op': 'i', 'ts': 1, 'ns': 'pets.dogs', 'o': {'_id': 1}}
+        await self.router.handle(operation)
+
+        self.dogs.handle.assert_called_once_with(operation)
+        self.assertEqual(self.router.last_timestamp, 1)
+
+    async def test_it_skips_operations_on_unattached_namespaces(self):
+        await self.router.handle({'op': 'i', 'ts': 1, 'ns': 'pets.cats', 'o': {}})
+
+        self.dogs.handle.assert_not_called()
+        self.assertEqual(self.router.last_timestamp, 1)
+
+    async def test_handle_batch_groups_consecutive_operations_by_namespace(self):
+        self.router.attach('pets.cats', self.cats)
+        operations = [
+            {'op': 'i', 'ts': 1, 'ns': 'pets.dogs', 'o': {'_id': 1}},
+            {'op': 'i', 'ts': 2, 'ns': 'pets.dogs', 'o': {'_id': 2}},
+            {'op': 'i', 'ts': 3, 'ns': 'pets.cats', 'o': {'_id': 1}},
+            {'op': 'd', 'ts': 4, 'ns': 'pets.dogs', 'o': {'_id': 1}},
+        ]
+        await self.router.handle_batch(operations)
+
+        self.assertEqual(self.dogs.handle_batch.call_args_list,
+                         [asynctest.call(operations[:2]),
+                          asynctest.call(operations[3:])])
+        self.cats.handle_batch.assert_called_once_with(operations[2:3])
+        self.assertEqual(self.router.last_timestamp, 4)
+
+    def test_requirements_are_the_union_of_attached_handlers(self):
+        self.dogs.operation_types = {'i'}
+        self.dogs.oplog_fields = ('o',)
+        self.cats.operation_types = {'u'}
+        self.cats.oplog_fields = ('o', 'o2')
+        self.router.attach('pets.cats', self.cats)
+
+        self.assertEqual(self.router.operation_types, {'i', 'u'})
+        self.assertEqual(self.router.oplog_fields, {'ns', 'o', 'o2'})
+
+    def test_requirements_are_unrestricted_if_any_handler_is(self):
+        self.dogs.operation_types = None
+        self.dogs.oplog_fields = None
+
+        self.assertIsNone(self.router.operation_types)
+        self.assertIsNone(self.router.oplog_fields)
+
+    async def test_detached_handlers_dont_receive_operations(self):
+        self.assertEqual(self.router.detach('pets.dogs'), self.dogs)
+        await self.router.handle_batch([
+            {'op': 'i', 'ts': 1, 'ns': 'pets.dogs', 'o': {'_id': 1}}
+        ])
+
+        self.dogs.handle_batch.assert_not_called()
+
+
+class ReactivePartialCollectionTests(asynctest.TestCase):
+    def setUp(self):
+        self.remote = asynctest.Mock(find_one=asynctest.CoroutineMock())
+        self.replica = ReactivePartialCollection(
+            collection={1: Document({'_id': 1, 'active': True, 'dog': 'Xena'})},
+            remote_collection=self.remote,
+            query={'active': True}
+        )
+
+    def update(self, _id, change):
+        return {'op': 'u', 'ts': 1, 'o': change, 'o2': {'_id': _id}}
+
+    async def test_only_matching_documents_are_inserted(self):
+        await self.replica.handle_batch([
+            {'op': 'i', 'ts': 1, 'o': {'_id': 2, 'active': False}},
+            {'op': 'i', 'ts': 2, 'o': {'_id': 3, 'active': True}},
+        ])
+
+        self.assertCountEqual(self.replica.collection, [1, 3])
+
+    async def test_replaced_documents_are_reevaluated(self):
+        self.replica.collection[2] = Document({'_id': 2, 'active': True})
+
+        await self.replica.handle_batch([
+            self.update(1, {'active': False, 'dog': 'Xena'}),
+            self.update(2, {'active': True, 'dog': 'Xablau'}),
+        ])
+
+        self.assertEqual(list(self.replica.collection), [2])
+        self.assertEqual(self.replica.collection[2],
+                         {'_id': 2, 'active': True, 'dog': 'Xablau'})
+
+    async def test_documents_which_stop_matching_are_dropped(self):
+        self.replica.create_index('dog')
+
+        await self.replica.handle(self.update(1, {'$set': {'active': False}}))
+
+        self.assertEqual(self.replica.collection, {})
+        self.assertEqual(self.replica.lookup('dog', 'Xena'), [])
+
+    async def test_updates_which_dont_touch_the_query_are_skipped(self):
+        await self.replica.handle(self.update(2, {'$set': {'dog': 'Fido'}}))
+        await self.replica.handle(self.update(2, {'$set': {'active': False}}))
+
+        self.remote.find_one.assert_not_called()
+        self.assertNotIn(2, self.replica.collection)
+
+    async def test_documents_which_start_matching_are_fetched(self):
+        self.remote.find_one.return_value = {'_id': 2, 'active': True,
+                                             'dog': 'Fido'}
+
+        await self.replica.handle_batch([
+            self.update(2, {'$set': {'active': True}}),
+            self.update(2, {'$set': {'dog': 'Rex'}}),
+        ])
+
+        self.remote.find_one.assert_called_once_with(
+            {'$and': [{'_id': 2}, {'active': True}]}, projection=None
+        )
+        self.assertEqual(self.replica.collection[2],
+                         {'_id': 2, 'active': True, 'dog': 'Rex'})
+
+    async def test_replacements_are_evaluated_without_fetching(self):
+        await self.replica.handle(self.update(3, {'active': True}))
+
+        self.remote.find_one.assert_not_called()
+        self.assertEqual(self.replica.collection[3], {'_id': 3, 'active': True})
+
+
+class ReactiveCollectionProjectionTests(asynctest.TestCase):
+    def setUp(self):
+        self.replica = ReactiveCollection(
+            collection={1: Document({'_id': 1, 'price': 10})},
+            remote_collection=asynctest.Mock(),
+            projection={'price': 1, 'seller.id': 1}
+        )
+
+    async def test_only_projected_fields_are_kept(self):
+        await self.replica.handle_batch([
+            {'op': 'i', 'ts': 1, 'o': {'_id': 2, 'price': 5, 'stock': 1,
+                                       'seller': {'id': 'a', 'name': 'X'}}},
+            {'op': 'u', 'ts': 2, 'o': {'$set': {'price': 20, 'stock': 2}},
+             'o2': {'_id': 1}},
+        ])
+
+        self.assertEqual(self.replica.collection, {
+            1: {'_id': 1, 'price': 20},
+            2: {'_id': 2, 'price': 5, 'seller': {'id': 'a'}},
+        })
+
+    async def test_updates_of_unprojected_fields_dont_touch_documents(self):
+        self.replica.create_index('price')
+        self.replica.indexes['price'].remove = asynctest.Mock()
+        self.replica.collection = asynctest.MagicMock()
+
+        doc = await self.replica.on_update({'op': 'u', 'ts': 1,
+                                            'o': {'$set': {'stock': 2}},
+                                            'o2': {'_id': 1}})
+
+        self.assertIsNone(doc)
+        self.replica.collection.__getitem__.assert_not_called()
+        self.replica.indexes['price'].remove.assert_not_called()
+
+    async def test_projections_of_id_alone_keep_only_ids(self):
+        replica = ReactiveCollection({}, asynctest.Mock(),
+                                     projection={'_id': 1})
+
+        await replica.handle_batch([
+            {'op': 'i', 'ts': 1, 'o': {'_id': 2, 'price': 5}},
+        ])
+
+        self.assertEqual(replica.collection, {2: {'_id': 2}})
+
+    async def test_projections_may_not_exclude_id(self):
+        with self.assertRaises(ValueError):
+            ReactiveCollection({}, asynctest.Mock(),
+                               projection={'price': 1, '_id': 0})
+        with self.assertRaises(ValueError):
+            await ReactiveCollection.init_async(asynctest.Mock(),
+                                                projection={'_id': 0})
+
+    def test_partial_collections_project_their_query_paths(self):
+        replica = ReactivePartialCollection({}, asynctest.Mock(),
+                                            query={'active': True},
+                                            projection={'price': 1})
+
+        self.assertEqual(replica.projection.spec, {'price': 1, 'active': 1})
+        with self.assertRaises(ValueError):
+            ReactivePartialCollection({}, asynctest.Mock(),
+                                      query={'seller.active': True},
+                                      projection={'seller': 0})
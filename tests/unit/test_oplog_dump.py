@@ -0,0 +1,129 @@
+import os
+import re
+import tempfile
+import time
+
+import bson
+from asynctest import TestCase, CoroutineMock
+from bson import Timestamp
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import CursorType, DESCENDING
+
+from mongo_observer.observer import Observer, ShouldStopObservation
+from mongo_observer.oplog_dump import OplogDump, matches
+from tests.unit.utils import mock_handler
+
+
+class MatchesTests(TestCase):
+    def test_it_evaluates_observer_queries(self):
+        entry = {'ns': 'db.xablau', 'op': 'i', 'ts': Timestamp(10, 1)}
+
+        self.assertTrue(matches(entry, {'ns': 'db.xablau',
+                                        'op': {'$in': ['i', 'u']},
+                                        'ts': {'$gt': Timestamp(9, 1),
+                                               '$lte': Timestamp(10, 1)}}))
+        self.assertTrue(matches(entry, {'ns': re.compile(r'^db\.')}))
+        self.assertFalse(matches(entry, {'ns': 'db.other'}))
+        self.assertFalse(matches(entry, {'ts': {'$gt': Timestamp(10, 1)}}))
+
+    def test_unsupported_operators_raise(self):
+        with self.assertRaises(ValueError):
+            matches({'op': 'i'}, {'op': {'$nin': ['u']}})
+
+
+class OplogDumpTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'oplog.rs.bson')
+        self.entries = [
+            {'ts': Timestamp(100 + i, 1),
+             'ns': 'db.xablau' if i % 2 else 'db.other',
+             'op': 'i',
+             'o': {'_id': i}}
+            for i in range(10)
+        ]
+        with open(self.path, 'wb') as f:
+            for entry in self.entries:
+                f.write(bson.encode(entry))
+        self.dump = OplogDump(self.path)
+
+    def tearDown(self):
+        self.dump.close()
+        self.dir.cleanup()
+
+    async def test_find_one_sorted_by_natural_order(self):
+        first = await self.dump.find_one()
+        last = await self.dump.find_one(sort=[('$natural', DESCENDING)])
+
+        self.assertEqual(first, self.entries[0])
+        self.assertEqual(last, self.entries[-1])
+
+    async def test_cursor_starts_after_the_filtered_ts(self):
+        cursor = self.dump.find({'ns': 'db.xablau',
+                                 'ts': {'$gt': Timestamp(105, 1)}})
+
+        entries = [entry async for entry in cursor]
+        self.assertEqual([entry['o']['_id'] for entry in entries], [7, 9])
+        self.assertFalse(cursor.alive)
+
+    async def test_tailable_cursor_stays_alive_when_exhausted(self):
+        cursor = self.dump.find({}, cursor_type=CursorType.TAILABLE_AWAIT,
+                                batch_size=4)
+
+        self.assertTrue(await cursor.fetch_next)
+        self.assertEqual(cursor._buffer_size(), 4)
+        for _ in range(4):
+            cursor.next_object()
+        self.assertTrue(await cursor.fetch_next)
+        self.assertTrue(await cursor.fetch_next)
+        self.assertEqual(cursor._buffer_size(), 4)
+        cursor.buffer.clear()
+
+        self.assertTrue(await cursor.fetch_next)
+        cursor.buffer.clear()
+        self.assertFalse(await cursor.fetch_next)
+        self.assertTrue(cursor.alive)
+
+    async def test_raw_bson_entries_are_views_of_the_dump(self):
+        dump = self.dump.with_options(
+            codec_options=CodecOptions(document_class=RawBSONDocument)
+        )
+        entry = await dump.find_one()
+
+        self.assertIsInstance(entry, RawBSONDocument)
+        self.assertIsInstance(entry.raw, memoryview)
+        self.assertEqual(entry['o']['_id'], 0)
+        entry.raw.release()
+
+    async def test_paced_replay_follows_the_original_timestamps(self):
+        self.dump.speed = 20
+        cursor = self.dump.find({'ts': {'$gt': Timestamp(106, 1)}})
+
+        start = time.monotonic()
+        entries = [entry async for entry in cursor]
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(entries), 3)
+        self.assertGreaterEqual(elapsed, 2 / 20)
+
+    async def test_it_is_observed_as_fast_as_possible(self):
+        handler = mock_handler(last_timestamp=None)
+
+        async def stop():
+            raise ShouldStopObservation
+
+        observer = await Observer.init_async(
+            oplog=self.dump,
+            operation_handler=handler,
+            namespace_filter='db.xablau',
+            starting_timestamp=Timestamp(0, 1),
+            on_nothing_to_fetch_on_cursor=CoroutineMock(side_effect=stop),
+            catch_up_threshold=0
+        )
+        await observer.observe_changes()
+
+        handled = [entry
+                   for call in handler.handle_batch.call_args_list
+                   for entry in call[0][0]]
+        self.assertEqual(handled, self.entries[1::2])
@@ -0,0 +1,236 @@
+import re
+
+import asynctest
+
+from mongo_observer.models import Document
+from mongo_observer.operation_handlers import ReactiveCollection
+from mongo_observer.queries import compile_filter, compile_projection, parse, \
+    QueryEngine, Projection
+
+
+class CompileFilterTests(asynctest.TestCase):
+    def setUp(self):
+        self.doc = {'_id': 1,
+                    'price': 10,
+                    'seller': {'id': 'xablau', 'active': True},
+                    'offers': [{'price': 5}, {'price': 20}],
+                    'tags': ['dog', 'cat'],
+                    'discount': None}
+
+    def assertMatches(self, filter, expected=True):
+        self.assertEqual(compile_filter(filter)(self.doc), expected, filter)
+
+    def test_equality(self):
+        self.assertMatches({'seller.id': 'xablau', 'price': 10.0})
+        self.assertMatches({'price': {'$eq': 11}}, False)
+        self.assertMatches({'price': {'$ne': 11}})
+        self.assertMatches({'seller': {'id': 'xablau', 'active': True}})
+        self.assertMatches({'seller.id': re.compile('^xab')})
+        self.assertMatches({'discount': None})
+        self.assertMatches({'missing': None})
+        self.assertMatches({'seller.active': 1}, False)
+
+    def test_arrays_match_any_of_their_items(self):
+        self.assertMatches({'tags': 'cat'})
+        self.assertMatches({'tags': ['dog', 'cat']})
+        self.assertMatches({'tags': {'$ne': 'cat'}}, False)
+        self.assertMatches({'offers.price': {'$gt': 15}})
+        self.assertMatches({'offers.0.price': {'$gt': 15}}, False)
+
+    def test_membership_and_existence(self):
+        self.assertMatches({'tags': {'$in': ['fish', 'dog']}})
+        self.assertMatches({'tags': {'$nin': ['fish', 'dog']}}, False)
+        self.assertMatches({'missing': {'$in': [None]}})
+        self.assertMatches({'discount': {'$exists': True}})
+        self.assertMatches({'missing': {'$exists': False}})
+
+    def test_ranges_only_match_values_of_the_same_type(self):
+        self.assertMatches({'price': {'$gte': 10, '$lt': 11}})
+        self.assertMatches({'price': {'$gt': 'a'}}, False)
+        self.assertMatches({'price': {'$lt': 'a'}}, False)
+
+    def test_logical_operators(self):
+        self.assertMatches({'$or': [{'price': 1}, {'tags': 'dog'}]})
+        self.assertMatches({'$and': [{'price': 10}, {'tags': 'fish'}]}, False)
+        self.assertMatches({'$nor': [{'price': 1}, {'tags': 'fish'}]})
+
+    def test_unsupported_operators(self):
+        with self.assertRaises(ValueError):
+            compile_filter({'price': {'$mod': [2, 0]}})
+
+
+class ParseTests(asynctest.TestCase):
+    def test_filters_of_the_same_shape_differ_only_on_constants(self):
+        shape, params = parse({'price': {'$gt': 1}, 'seller.id': 'a'})
+        other_shape, other_params = parse({'price': {'$gt': 5},
+                                           'seller.id': 'b'})
+
+        self.assertEqual(shape, other_shape)
+        self.assertEqual(params, [1, 'a'])
+        self.assertEqual(other_params, [5, 'b'])
+
+
+class CompileProjectionTests(asynctest.TestCase):
+    def setUp(self):
+        self.doc = {'_id': 1, 'price': 10,
+                    'seller': {'id': 'a', 'name': 'Xablau'},
+                    'offers': [{'price': 5, 'stock': 1}, 'invalid']}
+
+    def test_inclusion(self):
+        project = compile_projection({'price': 1, 'seller.id': 1,
+                                      'offers.price': 1})
+
+        self.assertEqual(project(self.doc), {'_id': 1, 'price': 10,
+                                             'seller': {'id': 'a'},
+                                             'offers': [{'price': 5}]})
+
+    def test_exclusion(self):
+        project = compile_projection({'_id': 0, 'seller.name': 0,
+                                      'offers.stock': 0})
+
+        self.assertEqual(project(self.doc), {'price': 10,
+                                             'seller': {'id': 'a'},
+                                             'offers': [{'price': 5},
+                                                        'invalid']})
+
+
+    def test_inclusion_of_id_alone(self):
+        project = compile_projection({'_id': 1})
+
+        self.assertEqual(project(self.doc), {'_id': 1})
+        self.assertEqual(project.restrict({'$set': {'price': 1}}), {})
+
+
+class ProjectionRestrictTests(asynctest.TestCase):
+    def test_changes_are_restricted_to_projected_paths(self):
+        projection = Projection({'price': 1, 'seller.id': 1, 'offers.price': 1})
+
+        change = projection.restrict({
+            '$v': 1,
+            '$set': {'price': 10, 'stock': 3, 'offers.1.price': 5,
+                     'seller': {'id': 'a', 'name': 'Xablau'},
+                     'offers': [{'price': 1, 'stock': 1}]},
+            '$unset': {'seller.name': 1, 'seller.id': 1},
+        })
+
+        self.assertEqual(change, {
+            '$set': {'price': 10, 'offers.1.price': 5,
+                     'seller': {'id': 'a'},
+                     'offers': [{'price': 1}]},
+            '$unset': {'seller.id': 1},
+        })
+
+    def test_changes_to_unprojected_paths_are_empty(self):
+        projection = Projection({'price': 1})
+
+        self.assertEqual(projection.restrict({'$set': {'stock': 1}}), {})
+
+    def test_scalars_set_on_ancestors_unset_them(self):
+        projection = Projection({'seller.id': 1})
+
+        self.assertEqual(projection.restrict({'$set': {'seller': 'Xablau'}}),
+                         {'$unset': {'seller': 1}})
+
+    def test_exclusions(self):
+        projection = Projection({'description': 0, 'seller.name': 0})
+
+        change = projection.restrict({
+            '$set': {'description': 'x', 'price': 1,
+                     'seller': {'id': 'a', 'name': 'Xablau'}},
+        })
+
+        self.assertEqual(change, {'$set': {'price': 1,
+                                           'seller': {'id': 'a'}}})
+
+
+class QueryEngineTests(asynctest.TestCase):
+    def setUp(self):
+        self.replica = ReactiveCollection(
+            collection={_id: Document({'_id': _id,
+                                       'price': price,
+                                       'seller': seller})
+                        for _id, price, seller in [(1, 30, 'a'),
+                                                   (2, 10, 'b'),
+                                                   (3, 20, 'a'),
+                                                   (4, 40, 'c')]},
+            remote_collection=asynctest.Mock()
+        )
+
+    def ids(self, docs):
+        return [doc['_id'] for doc in docs]
+
+    def test_find_filters_sorts_limits_and_projects(self):
+        docs = self.replica.find({'price': {'$gt': 10}},
+                                 projection={'price': 1},
+                                 sort=[('seller', 1), ('price', -1)],
+                                 limit=2)
+
+        self.assertEqual(docs, [{'_id': 1, 'price': 30},
+                                {'_id': 3, 'price': 20}])
+
+    def test_plans_use_declared_indexes(self):
+        self.replica.create_index('seller')
+        self.replica.create_index('price', sorted=True)
+        engine = self.replica.queries
+
+        docs = self.replica.find({'seller': {'$in': ['a', 'c']},
+                                  'price': {'$lt': 35}})
+        shape, _ = parse({'seller': {'$in': []}, 'price': {'$lt': 0}})
+        plan = engine.plan(shape, [])
+
+        self.assertCountEqual(self.ids(docs), [1, 3])
+        self.assertIs(plan.index, self.replica.indexes['seller'])
+        self.assertEqual(len(engine.plans), 1)
+
+        self.assertEqual(self.ids(self.replica.find({'price': {'$gte': 20}})),
+                         [3, 1, 4])
+        self.assertEqual(self.ids(self.replica.find({'$or': [{'seller': 'a'}]},
+                                                    sort={'price': -1},
+                                                    limit=2)),
+                         [1, 3])
+        self.assertTrue(list(engine.plans.values())[-1].ordered)
+
+    def test_indexed_and_unindexed_plans_find_the_same_documents(self):
+        filters = [{'price': {'$lte': 20}},
+                   {'seller': 'a', 'price': {'$gt': 25}},
+                   {'seller': {'$in': ['b', re.compile('c')]}},
+                   {'price': {'$gt': 'a'}}]
+        expected = [sorted(self.ids(self.replica.find(filter)))
+                    for filter in filters]
+
+        self.replica.create_index('seller', sorted=True)
+        self.replica.create_index('price', sorted=True)
+
+        self.assertEqual([sorted(self.ids(self.replica.find(filter)))
+                          for filter in filters], expected)
+
+    def test_plans_dont_use_dropped_indexes(self):
+        self.replica.create_index('seller')
+        self.replica.find({'seller': 'a'})
+        self.replica.drop_index('seller')
+        self.replica.create_index('seller')
+
+        self.replica.apply_insert({'op': 'i', 'ts': 1,
+                                   'o': {'_id': 5, 'seller': 'a'}})
+
+        self.assertCountEqual(self.ids(self.replica.find({'seller': 'a'})),
+                              [1, 3, 5])
+
+    def test_id_filters_look_the_replica_up(self):
+        engine = self.replica.queries
+
+        self.assertEqual(self.ids(self.replica.find({'_id': 3})), [3])
+        self.assertEqual(self.ids(self.replica.find({'_id': {'$in': [5, 2.0]},
+                                                     'price': 10})), [2])
+        self.assertEqual(self.replica.find({'_id': True}), [])
+        self.assertEqual(self.replica.find({'_id': {'a': 1}}), [])
+        self.assertTrue(all(plan.index is engine.primary
+                            for plan in engine.plans.values()))
+
+    def test_plan_cache_is_bounded(self):
+        engine = QueryEngine(self.replica.collection, {}, cache_size=2)
+        for path in ('a', 'b', 'c'):
+            engine.find({path: 1}, projection={path: 1})
+
+        self.assertEqual(len(engine.plans), 2)
+        self.assertEqual(len(engine.projections), 2)
@@ -0,0 +1,39 @@
+from asynctest import TestCase, patch
+
+from mongo_observer.reconnect import ReconnectScheduler
+
+
+class ReconnectSchedulerTests(TestCase):
+    def setUp(self):
+        self.scheduler = ReconnectScheduler(base_delay=1, max_delay=10, factor=2)
+
+    def test_delay_grows_exponentially_with_jitter(self):
+        for attempts, delay in enumerate((1, 2, 4, 8)):
+            self.scheduler.attempts = attempts
+            for _ in range(10):
+                self.assertTrue(delay / 2 <= self.scheduler.next_delay() <= delay)
+
+    def test_delay_is_capped(self):
+        self.scheduler.attempts = 10
+        self.assertLessEqual(self.scheduler.next_delay(), 10)
+        self.assertGreaterEqual(self.scheduler.next_delay(), 5)
+
+    def test_delay_doesnt_overflow_on_long_outages(self):
+        self.scheduler.attempts = 100000
+        self.assertTrue(5 <= self.scheduler.next_delay() <= 10)
+
+        self.scheduler.base_delay = 0
+        self.assertEqual(self.scheduler.next_delay(), 0)
+
+    async def test_wait_counts_attempts(self):
+        with patch('mongo_observer.reconnect.asyncio.sleep') as sleep:
+            await self.scheduler.wait()
+            await self.scheduler.wait()
+
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.scheduler.attempts, 2)
+        self.assertEqual(self.scheduler.reconnects, 2)
+
+        self.scheduler.reset()
+        self.assertEqual(self.scheduler.attempts, 0)
+        self.assertEqual(self.scheduler.reconnects, 2)
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import tempfile
+
+import asynctest
+
+from mongo_observer.operation_handlers import OperationHandler
+from mongo_observer.sharding import ShardedOperationHandler, partition_of
+
+
+class FileRecorderHandler(OperationHandler):
+    """
+    Appends the `ts` of handled operations to a file per partition
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    async def on_insert(self, operation):
+        if operation['o'].get('fail'):
+            raise ValueError('Xablau')
+        with open(self.path, 'a') as f:
+            f.write(f"{operation['o']['_id']}:{operation['ts']}\n")
+
+    on_update = on_insert
+    on_delete = on_insert
+
+
+def recorder_factory(index, partitions):
+    return FileRecorderHandler(os.path.join(os.environ['SHARDING_TEST_DIR'],
+                                            f'{index}-of-{partitions}'))
+
+
+class PartitionOfTests(asynctest.TestCase):
+    def test_partitions_are_stable_and_in_range(self):
+        for key in range(100):
+            partition = partition_of(key, 3)
+            self.assertIn(partition, range(3))
+            self.assertEqual(partition, partition_of(key, 3))
+
+
+class ShardedOperationHandlerTests(asynctest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        os.environ['SHARDING_TEST_DIR'] = self.dir.name
+        self.handler = ShardedOperationHandler(recorder_factory, processes=2)
+
+    async def tearDown(self):
+        await self.handler.stop()
+        self.dir.cleanup()
+
+    def read_partition(self, index):
+        path = os.path.join(self.dir.name, f'{index}-of-2')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return f.read().split()
+
+    async def test_operations_are_handled_by_their_partition_in_order(self):
+        operations = [{'op': 'i', 'ts': ts, 'o': {'_id': ts % 4}}
+                      for ts in range(1, 9)]
+        await self.handler.handle_batch(operations[:4])
+        await self.handler.handle_batch(operations[4:])
+        await self.handler.join()
+
+        for index in range(2):
+            expected = [f"{operation['o']['_id']}:{operation['ts']}"
+                        for operation in operations
+                        if partition_of(operation['o']['_id'], 2) == index]
+            self.assertEqual(self.read_partition(index), expected)
+        self.assertEqual(self.handler.last_timestamp, 8)
+
+    async def test_worker_errors_are_raised_on_the_parent(self):
+        await self.handler.handle_batch([
+            {'op': 'i', 'ts': 1, 'o': {'_id': 1, 'fail': True}}
+        ])
+
+        with self.assertRaises(ChildProcessError):
+            await self.handler.join()
+        self.assertIsNone(self.handler.last_timestamp)
+
+    async def test_stopping_doesnt_block_the_event_loop(self):
+        await self.handler.handle_batch([{'op': 'i', 'ts': 1, 'o': {'_id': 1}}])
+        await self.handler.join()
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        ticker = asyncio.ensure_future(tick())
+        await self.handler.stop()
+        ticker.cancel()
+
+        self.assertGreater(ticks, 0)
+        self.assertEqual(self.handler.workers, [])
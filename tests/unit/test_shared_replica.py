@@ -0,0 +1,154 @@
+import os
+import tempfile
+
+import bson
+from asynctest import TestCase, Mock, patch
+from bson import Timestamp
+
+from mongo_observer.models import Operations, Document
+from mongo_observer.shared_replica import SharedMemoryStore, \
+    SharedReplicaReader, SharedReactiveCollection, \
+    MIN_READ_BACKOFF_IN_SECONDS, MAX_READ_BACKOFF_IN_SECONDS
+
+
+class SharedMemoryStoreTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'replica')
+        self.store = SharedMemoryStore(self.path, slots=4, data_capacity=64)
+        self.reader = SharedReplicaReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.store.close()
+        self.dir.cleanup()
+
+    def test_put_documents_are_read_by_a_reader(self):
+        with self.store.writing():
+            self.store.put(1, bson.encode({'_id': 1, 'xablau': 'a'}))
+            self.store.put('2', bson.encode({'_id': '2', 'xablau': 'b'}))
+
+        self.assertEqual(self.reader.get(1)['xablau'], 'a')
+        self.assertEqual(self.reader.get('2')['xablau'], 'b')
+        self.assertIsNone(self.reader.get(3))
+        self.assertEqual(len(self.reader), 2)
+
+    def test_overwritten_and_deleted_documents(self):
+        with self.store.writing():
+            self.store.put(1, bson.encode({'_id': 1, 'v': 1}))
+            self.store.put(1, bson.encode({'_id': 1, 'v': 2}))
+            self.store.put(2, bson.encode({'_id': 2}))
+            self.store.delete(2)
+
+        self.assertEqual(self.reader.get(1)['v'], 2)
+        self.assertIsNone(self.reader.get(2))
+        self.assertEqual(len(self.reader), 1)
+
+    def test_write_sections_bump_the_sequence(self):
+        self.assertEqual(self.reader.sequence, 0)
+        with self.store.writing():
+            self.assertEqual(self.reader.sequence, 1)
+        self.assertEqual(self.reader.sequence, 2)
+
+    def test_nested_write_sections_are_part_of_the_outermost_one(self):
+        with self.store.writing():
+            with self.store.writing():
+                self.store.put(1, bson.encode({'_id': 1}))
+            self.assertEqual(self.reader.sequence, 1)
+        self.assertEqual(self.reader.sequence, 2)
+
+    def test_readers_back_off_while_a_write_is_in_progress(self):
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 20:
+                self.store.sequence += 1
+                self.store._write_header(self.store.mm)
+
+        self.store.sequence += 1
+        self.store._write_header(self.store.mm)
+        with patch('mongo_observer.shared_replica.time.sleep', sleep):
+            self.assertIsNone(self.reader.get(1))
+
+        self.assertEqual(sleeps[:3], [0, MIN_READ_BACKOFF_IN_SECONDS,
+                                      2 * MIN_READ_BACKOFF_IN_SECONDS])
+        self.assertEqual(max(sleeps), MAX_READ_BACKOFF_IN_SECONDS)
+
+    def test_reader_reopens_the_store_after_it_grows(self):
+        with self.store.writing():
+            for _id in range(100):
+                self.store.put(_id, bson.encode({'_id': _id, 'v': _id}))
+            self.store.delete(50)
+
+        self.assertGreater(self.store.slots, 4)
+        self.assertEqual(self.reader.get(99)['v'], 99)
+        self.assertIsNone(self.reader.get(50))
+        self.assertEqual(len(self.reader), 99)
+        self.assertFalse(os.path.exists(f'{self.path}.tmp'))
+
+    def test_get_many_raw_is_consistent_with_a_sequence(self):
+        with self.store.writing():
+            self.store.put(1, bson.encode({'_id': 1}))
+
+        sequence, documents = self.reader.get_many_raw([1, 2])
+        self.assertEqual(sequence, 2)
+        self.assertEqual(bson.decode(documents[0]), {'_id': 1})
+        self.assertIsNone(documents[1])
+        documents[0].release()
+
+
+class SharedReactiveCollectionTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'replica')
+        self.store = SharedMemoryStore(self.path)
+        self.replica = SharedReactiveCollection(
+            {1: Document({'_id': 1, 'tags': ['a']})},
+            Mock(),
+            self.store
+        )
+        self.reader = SharedReplicaReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.store.close()
+        self.dir.cleanup()
+
+    async def test_initial_documents_are_published(self):
+        self.assertEqual(self.reader.get(1)['tags'], ['a'])
+
+    async def test_handled_batches_are_published(self):
+        await self.replica.handle_batch([
+            {'op': Operations.INSERT, 'ts': Timestamp(1, 1),
+             'o': {'_id': 2, 'v': 1}},
+            {'op': Operations.UPDATE, 'ts': Timestamp(1, 2),
+             'o': {'$set': {'v': 2}}, 'o2': {'_id': 2}},
+            {'op': Operations.DELETE, 'ts': Timestamp(1, 3),
+             'o': {'_id': 1}},
+        ])
+
+        self.assertEqual(self.reader.get(2)['v'], 2)
+        self.assertIsNone(self.reader.get(1))
+        self.assertEqual(self.reader.sequence, 4)
+        self.assertEqual(self.reader.last_timestamp, Timestamp(1, 3))
+
+    async def test_overridden_handlers_are_awaited_outside_write_sections(self):
+        sequences = []
+
+        class NotifyingReplica(SharedReactiveCollection):
+            async def on_update(replica, operation):
+                sequences.append(self.reader.sequence)
+                return replica.apply_update(operation)
+
+        replica = NotifyingReplica({}, Mock(), self.store)
+        await replica.handle_batch([
+            {'op': Operations.INSERT, 'ts': Timestamp(1, 1),
+             'o': {'_id': 2, 'v': 1}},
+            {'op': Operations.UPDATE, 'ts': Timestamp(1, 2),
+             'o': {'$set': {'v': 2}}, 'o2': {'_id': 2}},
+        ])
+
+        self.assertEqual(sequences[0] % 2, 0)
+        self.assertEqual(self.reader.get(2)['v'], 2)
+        self.assertEqual(self.reader.last_timestamp, Timestamp(1, 2))
@@ -0,0 +1,88 @@
+import os
+import tempfile
+
+from asynctest import TestCase, Mock, CoroutineMock
+from bson import Timestamp
+
+from mongo_observer.models import Document
+from mongo_observer.operation_handlers import ReactiveCollection
+from mongo_observer.snapshots import SnapshotFile
+from tests.unit.utils import AsyncIterMockCursor
+
+
+class SnapshotFileTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'snapshot.bson')
+        self.snapshot = SnapshotFile(self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_saved_snapshots_are_loaded(self):
+        replica = ReactiveCollection({1: Document({'_id': 1, 'tags': ['a']}),
+                                      2: Document({'_id': 2, 'a': {'b': 1}})},
+                                     Mock())
+        replica.last_timestamp = Timestamp(666, 1)
+
+        await self.snapshot.save(replica)
+        collection, last_timestamp = await self.snapshot.load()
+
+        self.assertEqual(last_timestamp, Timestamp(666, 1))
+        self.assertEqual({_id: dict(doc) for _id, doc in collection.items()},
+                         {1: {'_id': 1, 'tags': ['a']},
+                          2: {'_id': 2, 'a': {'b': 1}}})
+        self.assertIsInstance(collection[1], Document)
+        self.assertFalse(os.path.exists(f'{self.path}.tmp'))
+
+    async def test_load_returns_none_without_a_valid_snapshot(self):
+        self.assertIsNone(await self.snapshot.load())
+
+        with open(self.path, 'wb') as f:
+            f.write(b'xablau')
+        self.assertIsNone(await self.snapshot.load())
+
+
+class ReactiveCollectionInitAsyncFromSnapshotTests(TestCase):
+    async def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.snapshot = SnapshotFile(os.path.join(self.dir.name, 'snapshot'))
+        replica = ReactiveCollection({1: Document({'_id': 1, 'v': 1})}, Mock())
+        replica.last_timestamp = Timestamp(10, 1)
+        await self.snapshot.save(replica)
+
+        self.remote = Mock(
+            find=Mock(return_value=AsyncIterMockCursor([{'_id': 1, 'v': 2}])),
+            estimated_document_count=CoroutineMock(return_value=1)
+        )
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def mock_oplog(self, oldest: Timestamp, newest: Timestamp) -> Mock:
+        async def find_one(sort, **kwargs):
+            return {'ts': oldest if sort[0][1] == 1 else newest}
+        return Mock(find_one=find_one)
+
+    async def test_it_replays_from_the_snapshot_timestamp(self):
+        oplog = self.mock_oplog(oldest=Timestamp(5, 1), newest=Timestamp(20, 1))
+
+        replica = await ReactiveCollection.init_async(self.remote,
+                                                      oplog=oplog,
+                                                      partitions=1,
+                                                      snapshot=self.snapshot)
+
+        self.assertEqual(replica.last_timestamp, Timestamp(10, 1))
+        self.assertEqual(dict(replica.collection[1]), {'_id': 1, 'v': 1})
+        self.remote.find.assert_not_called()
+
+    async def test_it_syncs_if_the_snapshot_fell_off_the_oplog(self):
+        oplog = self.mock_oplog(oldest=Timestamp(11, 1), newest=Timestamp(20, 1))
+
+        replica = await ReactiveCollection.init_async(self.remote,
+                                                      oplog=oplog,
+                                                      partitions=1,
+                                                      snapshot=self.snapshot)
+
+        self.assertEqual(replica.last_timestamp, Timestamp(20, 1))
+        self.assertEqual(dict(replica.collection[1]), {'_id': 1, 'v': 2})
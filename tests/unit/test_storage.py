@@ -0,0 +1,122 @@
+import asynctest
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from mongo_observer.models import Document
+from mongo_observer.operation_handlers import ReactiveCollection
+from mongo_observer.storage import BSONStorage, RecordStorage, \
+    bytes_per_document, deep_sizeof
+
+
+def documents(count):
+    return {_id: Document({'_id': _id,
+                           'price': _id * 10,
+                           'seller': {'id': 'xablau', 'name': 'Xablau'},
+                           'tags': ['dog', 'cat']})
+            for _id in range(count)}
+
+
+class StorageTests(asynctest.TestCase):
+    storage_classes = (BSONStorage, RecordStorage)
+
+    def test_documents_are_stored_and_iterated(self):
+        for storage_class in self.storage_classes:
+            with self.subTest(storage_class.__name__):
+                storage = storage_class()
+                storage.update(documents(3))
+                del storage[1]
+
+                self.assertEqual(list(storage), [0, 2])
+                self.assertEqual(len(storage), 2)
+                self.assertIn(2, storage)
+                self.assertNotIn(1, storage)
+                self.assertIsNone(storage.get(1))
+                self.assertIsInstance(storage[2], Document)
+                self.assertEqual(storage[2], documents(3)[2])
+                self.assertEqual(dict(storage.items()),
+                                 {0: documents(3)[0], 2: documents(3)[2]})
+
+    def test_documents_are_copied(self):
+        for storage_class in self.storage_classes:
+            with self.subTest(storage_class.__name__):
+                storage = storage_class()
+                storage[1] = documents(2)[1]
+                storage[1]['seller.id'] = 'xena'
+
+                self.assertEqual(storage[1]['seller']['id'], 'xablau')
+
+    def test_raw_bson_documents_are_stored_as_they_are(self):
+        raw = bson.encode({'_id': 1, 'price': 10})
+        storage = BSONStorage()
+        storage[1] = RawBSONDocument(
+            raw, CodecOptions(document_class=RawBSONDocument)
+        )
+
+        self.assertIs(storage.raw(1), raw)
+
+    def test_records_share_the_class_of_their_schema(self):
+        storage = RecordStorage()
+        storage.update(documents(3))
+        storage[3] = {'_id': 3}
+
+        self.assertEqual(len(storage.classes), 2)
+        self.assertIs(type(storage.records[0]), type(storage.records[2]))
+
+    def test_schemas_beyond_max_classes_are_kept_as_dicts(self):
+        storage = RecordStorage(max_classes=1)
+        storage.update(documents(2))
+        storage[2] = {'_id': 2, 'price': 20}
+        storage[2]['price'] = 30
+
+        self.assertEqual(len(storage.classes), 1)
+        self.assertIsInstance(storage.records[2], dict)
+        self.assertIsInstance(storage[2], Document)
+        self.assertEqual(storage[2], {'_id': 2, 'price': 20})
+        self.assertEqual(storage[1], documents(2)[1])
+
+    def test_compact_storages_use_less_memory(self):
+        docs = documents(100)
+        bson_storage, record_storage = BSONStorage(), RecordStorage()
+        bson_storage.update(docs)
+        record_storage.update(docs)
+
+        self.assertLess(bytes_per_document(bson_storage),
+                        bytes_per_document(docs))
+        self.assertLess(bytes_per_document(record_storage),
+                        bytes_per_document(docs))
+        self.assertEqual(bytes_per_document({}), 0.0)
+
+    def test_shared_objects_are_counted_once(self):
+        item = [1, 2, 3]
+        self.assertEqual(deep_sizeof([item, item]),
+                         deep_sizeof([item]) + 8)
+
+
+class ReactiveCollectionStorageTests(asynctest.TestCase):
+    async def test_operations_are_applied_to_the_storage(self):
+        for storage_class in StorageTests.storage_classes:
+            with self.subTest(storage_class.__name__):
+                storage = storage_class()
+                storage.update(documents(2))
+                replica = ReactiveCollection(storage, asynctest.Mock())
+                replica.create_index('seller.id')
+
+                await replica.handle_batch([
+                    {'op': 'u', 'ts': 1, 'o2': {'_id': 0},
+                     'o': {'$set': {'seller.id': 'xena'},
+                           '$unset': {'tags': 1}}},
+                    {'op': 'i', 'ts': 2, 'o': {'_id': 2, 'price': 1}},
+                    {'op': 'd', 'ts': 3, 'o': {'_id': 1}},
+                ])
+
+                self.assertEqual(storage[0], {'_id': 0,
+                                              'price': 0,
+                                              'seller': {'id': 'xena',
+                                                         'name': 'Xablau'}})
+                self.assertEqual(list(storage), [0, 2])
+                self.assertEqual(replica.lookup('seller.id', 'xena'),
+                                 [storage[0]])
+                self.assertEqual(replica.find({'price': {'$lt': 5}},
+                                              sort=[('price', -1)]),
+                                 [storage[2], storage[0]])
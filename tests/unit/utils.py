@@ -1,14 +1,59 @@
+from collections import deque
+
+from asynctest import Mock, CoroutineMock
+
+
 class AsyncIterMockCursor:
     alive = True
 
-    def __init__(self, seq):
-        self.iter = iter(seq)
+    def __init__(self, seq, batch_size=None):
+        self.pending = deque(seq)
+        self.batch_size = batch_size or len(self.pending) or 1
+        self.buffer = deque()
 
-    async def __aiter__(self):
+    def __aiter__(self):
         return self
 
     async def __anext__(self):
-        try:
-            return next(self.iter)
-        except StopIteration:
-            raise StopAsyncIteration
+        if self._buffer_size() or await self.fetch_next:
+            return self.next_object()
+        raise StopAsyncIteration
+
+    @property
+    def fetch_next(self):
+        return self._get_more()
+
+    async def _get_more(self):
+        if not self.buffer:
+            for _ in range(min(self.batch_size, len(self.pending))):
+                self.buffer.append(self.pending.popleft())
+        return len(self.buffer)
+
+    def next_object(self):
+        if not self.buffer:
+            return None
+        return self.buffer.popleft()
+
+    def _buffer_size(self):
+        return len(self.buffer)
+
+    async def close(self):
+        self.alive = False
+
+
+def mock_handler(**kwargs) -> Mock:
+    """
+    An operation handler mock, without query push down requirements by default
+    """
+    kwargs.setdefault('operation_types', None)
+    kwargs.setdefault('oplog_fields', None)
+    return Mock(handle_batch=CoroutineMock(), check=CoroutineMock(),
+                stop=CoroutineMock(), **kwargs)
+
+
+def mock_oplog(**kwargs) -> Mock:
+    """
+    An oplog collection mock, empty unless `find_one` is given
+    """
+    kwargs.setdefault('find_one', CoroutineMock(return_value=None))
+    return Mock(**kwargs)